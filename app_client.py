@@ -0,0 +1,157 @@
+"""
+a client for the app protocol that can have many requests in flight on one connection
+
+every request is sent with a new request id (see APP_REQUEST_FIELDS in
+protocol.py) and returns a concurrent.futures.Future right away. a thread reads
+the replies and finishes the future of each one by its id, in whatever order the
+peer answers them: a vote once its block is accepted or rejected, a tally as
+soon as it is sent. so a front end can submit the votes of many voters without
+waiting for the block of each one before sending the next
+
+    client = AppClient(app_port)
+    futures = [client.cast_vote(vote) for vote in votes]
+    accepted = [future.result() for future in futures]
+
+if the peer leaves the network or the connection closes, every request still
+waiting fails with a ConnectionError
+
+"""
+import itertools
+import json
+import socket
+import threading
+from concurrent.futures import Future
+from protocol import *
+from tally import VoteTally
+
+
+class AppClient:
+    def __init__(self, app_port, host="127.0.0.1"):
+        """
+        Initializes an AppClient and connects it to a peer.
+
+        Parameters:
+        - app_port (int): The port the peer listens for applications on.
+        - host (str): The address of the peer.
+        """
+        self.socket = socket.create_connection((host, app_port))
+        self.send_lock = threading.Lock()
+        self.lock = threading.Lock() #guards pending and closed
+        self.pending = {} #request id -> (Future, VoteTally of a TALLY_VOTE being streamed or None)
+        self.request_ids = itertools.count()
+        self.closed = None #why the connection closed, once it has
+        reader = threading.Thread(target=self.read_replies)
+        reader.daemon = True
+        reader.start()
+
+
+    def cast_vote(self, vote, attack=False):
+        """
+        send a vote (a dict of user_id, vote, timestamp and name) to go into the peer's blockchain
+        returns a Future of whether the block it went into was accepted
+        """
+        return self.request([CAST_VOTE, vote, attack])
+
+
+    def tally(self):
+        """
+        returns a Future of the number of votes for each candidate, as the peer counts them
+        """
+        return self.request([TALLY_COUNT])
+
+
+    def count_blockchain(self):
+        """
+        returns a Future of a VoteTally of the votes in the peer's blockchain, counted here as each part of it arrives
+        """
+        return self.request([TALLY_VOTE], VoteTally())
+
+
+    def stats(self):
+        """
+        returns a Future of a snapshot of the peer's metrics (see metrics.py)
+        """
+        return self.request([STATS])
+
+
+    def request(self, message, tally=None):
+        """
+        send a request ended with a new request id, returns the Future of its reply
+        """
+        future = Future()
+        with self.lock:
+            if self.closed:
+                future.set_exception(ConnectionError(self.closed))
+                return future
+            request_id = next(self.request_ids)
+            self.pending[request_id] = (future, tally)
+        try:
+            with self.send_lock:
+                send_wrapper(self.socket, json.dumps(message + [request_id]))
+        except OSError as e:
+            self.fail(request_id, ConnectionError(f"failed to send the request: {e}"))
+        return future
+
+
+    def read_replies(self):
+        """
+        finish the future of every reply until the connection closes, then fail the ones still waiting
+        """
+        reason = "the connection to the peer closed"
+        try:
+            while True:
+                raw_data = recv_wrapper(self.socket)
+                if raw_data is None:
+                    break
+                data = json.loads(raw_data)
+                if data[0] == APP_LEAVE_NETWORK:
+                    reason = "the peer left the network"
+                    break
+                self.handle_reply(data)
+        except OSError as e:
+            reason = f"the connection to the peer failed: {e}"
+        with self.lock:
+            self.closed = reason
+            pending = list(self.pending)
+        for request_id in pending:
+            self.fail(request_id, ConnectionError(reason))
+
+
+    def handle_reply(self, data):
+        """
+        finish the future a reply is for, every part of a streamed RETURNED_BLOCKCHAIN is counted but only the last one finishes it
+        """
+        request_id = data[-1]
+        with self.lock:
+            future, tally = self.pending.get(request_id, (None, None))
+        if future is None:
+            print(f"reply to a request that isn't waiting: {data[0]} {request_id}")
+            return
+        if data[0] == RETURNED_BLOCKCHAIN:
+            tally.add_blocks(data[1])
+            if data[2]:
+                return
+            result = tally
+        else:
+            result = data[1]
+        with self.lock:
+            del self.pending[request_id]
+        future.set_result(result)
+
+
+    def fail(self, request_id, error):
+        with self.lock:
+            future, _ = self.pending.pop(request_id, (None, None))
+        if future is not None:
+            future.set_exception(error)
+
+
+    def close(self):
+        """
+        close the connection, requests still waiting fail with a ConnectionError
+        """
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
@@ -6,6 +6,7 @@ from protocol import *
 import signal
 import sys
 from block import *
+from tally import leaders, tally_chain_reply
 import uuid
 import time
 
@@ -59,16 +60,21 @@ class BlockchainVoting:
         self.peer_connection_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.peer_connection_socket.connect(("127.0.0.1", self.app_port))
 
-    def ask_for_tally(self):
+    def ask_for_tally(self, count_blockchain=False):
         """
-        ask the peer for its local blockchain
+        ask the peer for the number of votes for each candidate, which it keeps up to date as blocks are added
+
+        Parameters:
+        - count_blockchain (bool): Ask for the blockchain instead and count its votes here.
         """
-        message = json.dumps([TALLY_VOTE])
-        self.peer_connection_socket.sendall(message.encode('utf-8'))
+        message = json.dumps([TALLY_VOTE if count_blockchain else TALLY_COUNT])
+        send_wrapper(self.peer_connection_socket, message)
         raw_data = recv_wrapper(self.peer_connection_socket)
         data = json.loads(raw_data)
-        if data[0] == RETURNED_BLOCKCHAIN:
-            self.tally_votes(data[1])
+        if data[0] == RETURNED_TALLY:
+            self.display_results(data[1])
+        elif data[0] == RETURNED_BLOCKCHAIN:
+            self.tally_votes(data)
         elif data[0] == APP_LEAVE_NETWORK:
             messagebox.showinfo("Info", "Peer is leaving the network, exiting...")
             self.peer_connection_socket.close()
@@ -93,7 +99,7 @@ class BlockchainVoting:
         timestamp = time.time()
         vote_obj = Vote(self.user_id, vote, timestamp, self.name)
         message = json.dumps([CAST_VOTE, vote_obj.__dict__, staged_attack])
-        self.peer_connection_socket.sendall(message.encode('utf-8'))
+        send_wrapper(self.peer_connection_socket, message)
 
         raw_data = recv_wrapper(self.peer_connection_socket)
 
@@ -112,25 +118,23 @@ class BlockchainVoting:
         else:
             messagebox.showinfo("Info", "invalid message from a peer")
 
-    def tally_votes(self, raw_blockchain):
+    def tally_votes(self, data):
         """
-        Print out the current statistics of the votes based on the provided blockchain.
+        Count the votes in the blockchain the peer sent, one part at a time as the parts arrive, and show the results.
 
         Parameters:
-        - raw_blockchain (list of dict): A list of dictionaries representing blocks in the blockchain.
-        """
-        blockchain = []
-        for block_dict in raw_blockchain:
-            block = from_dict(block_dict)
-            blockchain.append(block)
-        votes = {}
-        for block in blockchain:
-            if block.data:
-                voted_for = block.data['vote']
-                if voted_for in votes:
-                    votes[voted_for] += 1
-                else:
-                    votes[voted_for] = 1
+        - data (list): The first RETURNED_BLOCKCHAIN message, which holds a list of dictionaries representing blocks.
+        """
+        tally = tally_chain_reply(data, self.peer_connection_socket)
+        self.display_results(tally.counts)
+
+    def display_results(self, votes):
+        """
+        Show the current statistics of the votes.
+
+        Parameters:
+        - votes (dict): The number of votes for each candidate.
+        """
         result = "----------------------\nCurrent Voting Results:\n"
         if votes:
             for key, num_votes in votes.items():
@@ -138,8 +142,7 @@ class BlockchainVoting:
                     result += f"{key} has {num_votes} votes\n"
                 else:
                     result += f"{key} has {num_votes} vote\n"
-            max_votes = max(votes.values())
-            leading_candidates = [candidate for candidate, votes in votes.items() if votes == max_votes]
+            leading_candidates = leaders(votes)
             if len(leading_candidates) == 1:
                 result += f"{leading_candidates[0]} is in the lead\n"
             else:
@@ -208,6 +211,8 @@ class VotingAppGUI:
         vote_button.pack(pady=5)
         tally_button = tk.Button(self.voting_frame, text="Tally Votes", command=self.ask_for_tally, font=("Helvetica", 12), width=button_width)
         tally_button.pack(pady=5)
+        count_button = tk.Button(self.voting_frame, text="Count Blockchain", command=self.count_blockchain, font=("Helvetica", 12), width=button_width)
+        count_button.pack(pady=5)
         attack_button = tk.Button(self.voting_frame, text="Stage Attack", command=self.stage_attack, font=("Helvetica", 12), width=button_width)
         attack_button.pack(pady=5)
         quit_button = tk.Button(self.voting_frame, text="Quit", command=self.quit_app, font=("Helvetica", 12), width=button_width)
@@ -227,6 +232,13 @@ class VotingAppGUI:
         if self.voting_app:
             self.voting_app.ask_for_tally()
 
+    def count_blockchain(self):
+        """
+        Requests the blockchain and counts the votes in it.
+        """
+        if self.voting_app:
+            self.voting_app.ask_for_tally(True)
+
     def stage_attack(self):
         """
         Initiates the process of staging an attack.
@@ -250,6 +262,6 @@ if __name__ == "__main__":
     app_port = args.app_port
 
     app = VotingAppGUI(app_port)
-    app.root.geometry("400x300") 
+    app.root.geometry("400x340") 
     app.root.resizable(False, False) 
     app.root.mainloop()
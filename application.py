@@ -5,6 +5,7 @@ from protocol import *
 import signal
 import sys
 from block import *
+from tally import leaders, tally_chain_reply
 import uuid
 import time
 
@@ -62,18 +63,23 @@ class BlockchainVoting:
         self.peer_connection_socket.connect(("127.0.0.1", self.app_port))
 
 
-    def ask_for_tally(self):
+    def ask_for_tally(self, count_blockchain=False):
         """
-        ask the peer for its local blockchain
+        ask the peer for the number of votes for each candidate, which it keeps up to date as blocks are added
+
+        Parameters:
+        - count_blockchain (bool): Ask for the blockchain instead and count its votes here.
         """
-        message = json.dumps([TALLY_VOTE])
-        self.peer_connection_socket.sendall(message.encode('utf-8'))
+        message = json.dumps([TALLY_VOTE if count_blockchain else TALLY_COUNT])
+        send_wrapper(self.peer_connection_socket, message)
 
         raw_data = recv_wrapper(self.peer_connection_socket)
         data = json.loads(raw_data)
 
-        if data[0] == RETURNED_BLOCKCHAIN:
-            self.tally_votes(data[1])
+        if data[0] == RETURNED_TALLY:
+            self.display_results(data[1])
+        elif data[0] == RETURNED_BLOCKCHAIN:
+            self.tally_votes(data)
         elif data[0] == APP_LEAVE_NETWORK:
             print("peer is leaving the network, exiting...")
             self.peer_connection_socket.close()
@@ -99,7 +105,7 @@ class BlockchainVoting:
         timestamp = time.time()
         vote_obj = Vote(self.user_id, vote, timestamp, self.name)
         message = json.dumps([CAST_VOTE, vote_obj.__dict__, staged_attack])
-        self.peer_connection_socket.sendall(message.encode('utf-8'))
+        send_wrapper(self.peer_connection_socket, message)
 
         raw_data = recv_wrapper(self.peer_connection_socket)
 
@@ -119,28 +125,24 @@ class BlockchainVoting:
             print("invalid message from a peer")
 
 
-    def tally_votes(self, raw_blockchain):
+    def tally_votes(self, data):
         """
-        Print out the current statistics of the votes based on the provided blockchain.
+        Count the votes in the blockchain the peer sent, one part at a time as the parts arrive, and show the results.
 
         Parameters:
-        - raw_blockchain (list of dict): A list of dictionaries representing blocks in the blockchain.
-        """
-        #parse the blockchain
-        blockchain = []
-        for block_dict in raw_blockchain:
-            block = from_dict(block_dict)
-            blockchain.append(block)
-
-        votes = {}
-        for block in blockchain:
-            if block.data:
-                voted_for = block.data['vote']
-                if voted_for in votes:
-                    votes[voted_for] += 1
-                else:
-                    votes[voted_for] = 1
+        - data (list): The first RETURNED_BLOCKCHAIN message, which holds a list of dictionaries representing blocks.
+        """
+        tally = tally_chain_reply(data, self.peer_connection_socket)
+        self.display_results(tally.counts)
+
 
+    def display_results(self, votes):
+        """
+        Print out the current statistics of the votes.
+
+        Parameters:
+        - votes (dict): The number of votes for each candidate.
+        """
         print("----------------------")
         print("Current Voting Results:")
         if votes:
@@ -149,8 +151,7 @@ class BlockchainVoting:
                     print(f"   {key} has {num_votes} votes")
                 else:
                     print(f"   {key} has {num_votes} vote")
-            max_votes = max(votes.values())
-            leading_candidates = [candidate for candidate, votes in votes.items() if votes == max_votes]
+            leading_candidates = leaders(votes)
 
             if len(leading_candidates) == 1:
                 print(f"{leading_candidates[0]} is in the lead")
@@ -182,6 +183,7 @@ if __name__ == "__main__":
         print("\nMenu Options:")
         print("   C: cast a vote")
         print("   T: tally votes")
+        print("   B: count the votes in the blockchain")
         print("   S: stage attack")
         print("   Q: quit")
 
@@ -191,6 +193,8 @@ if __name__ == "__main__":
             voting_app.cast_a_vote(False)
         elif option == "T":
             voting_app.ask_for_tally()
+        elif option == "B":
+            voting_app.ask_for_tally(True)
         elif option == "S":
             print("This will stage an attack by creating an invalid block that other peers will then reject.")
             voting_app.cast_a_vote(True)
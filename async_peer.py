@@ -0,0 +1,309 @@
+"""
+asyncio runtime for a Peer, started with python3 peer.py ... --async
+
+the threaded Peer uses a thread per listener, a thread per incoming peer
+connection, and a thread per broadcast send. AsyncPeer serves the tracker,
+peer, and app connections on one event loop instead, so the number of threads
+stays the same no matter how many peers are in the network. sealing blocks
+(mining and waiting for the other peers) still blocks, so it runs on a
+single executor thread off the event loop. handling a peer message can block
+too (verifying and appending a range of blocks, or waiting for the chain while
+a block is being sealed), so peer messages are handled one at a time on
+another executor thread, and the loop keeps serving the tracker, the other
+peers, and the apps meanwhile
+
+the message handling itself (handle_peer_message, handle_app_message, handle_tracker_message,
+validate_block, create_new_block, ...) is shared with Peer, only the way
+messages are sent and received is different
+
+"""
+import asyncio
+import concurrent.futures
+import json
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from protocol import *
+from block_codec import decode_message
+from metrics import APP_LINK, PEER_LINK, TRACKER_LINK, serve_metrics
+from peer import Peer
+
+#seconds an outgoing connection to a peer can go unused before it is closed
+IDLE_TIMEOUT = 60
+
+
+class AsyncPeer(Peer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = None
+        self.stopped = None
+        self.tracker_reader = None
+        self.tracker_writer = None
+        self.app_clients = {} #StreamWriter of every connected application -> None, writes happen on the event loop so they need no lock
+        self.app_slots = None #applications served at once, like in Peer
+        self.peer_queues = {} #peer_address -> asyncio.Queue of (message, future or None) waiting to be sent to that peer
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.peer_executor = ThreadPoolExecutor(max_workers=1) #handles peer messages in the order they arrive, off the event loop
+
+
+    def run(self):
+        """
+        run the peer until it is interrupted by Ctrl-C
+        """
+        asyncio.run(self.main())
+        sys.exit(0)
+
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.app_slots = asyncio.Semaphore(self.max_apps)
+        self.loop.add_signal_handler(signal.SIGINT, lambda: self.loop.create_task(self.shutdown()))
+
+        print("connecting to tracker")
+        self.tracker_reader, self.tracker_writer = await asyncio.open_connection(self.tracker_ip, self.tracker_port)
+        print("joining the network")
+        self.send_to_tracker(json.dumps([JOIN_NETWORK, self.my_address]))
+        self.send_to_tracker(json.dumps([SUBSCRIBE, self.my_address]))
+        self.handle_tracker_message(self.receive_from_tracker(await recv_wrapper_async(self.tracker_reader)))
+        self.loop.create_task(self.listen_for_tracker_async())
+
+        if self.metrics_port:
+            serve_metrics(self.metrics, self.metrics_port)
+        peer_server = await asyncio.start_server(self.handle_peer_stream, sock=self.peer_socket)
+        print("listening for incoming messages from peers...")
+        await self.request_blockchain_async()
+
+        app_server = await asyncio.start_server(self.handle_app_stream, sock=self.app_socket)
+        print("listening for incoming messages from apps...")
+        self.loop.run_in_executor(self.executor, self.mempool.run)
+
+        async with peer_server, app_server:
+            await self.stopped.wait()
+
+
+    async def shutdown(self):
+        """
+        tell the application and the tracker we are leaving, then stop the event loop
+        """
+        print("\nterminating...")
+        for writer in list(self.app_clients):
+            self.write_to_app(writer, json.dumps([APP_LEAVE_NETWORK]))
+        print("leave the network...")
+        self.tracker_writer.write(frame(json.dumps([LEAVE_NETWORK, self.my_address])))
+        await self.tracker_writer.drain()
+        self.tracker_writer.close()
+        self.mempool.stop()
+        self.executor.shutdown(wait=False)
+        self.peer_executor.shutdown(wait=False)
+        self.miner.close()
+        self.chain_verifier.close()
+        self.blockchain.close()
+        self.stopped.set()
+
+
+    def send_to_tracker(self, data):
+        """
+        write data to the tracker connection, safe to call from any thread
+        """
+        self.loop.call_soon_threadsafe(self.tracker_writer.write, frame(data))
+        self.metrics.sent(TRACKER_LINK, data)
+
+
+    async def listen_for_tracker_async(self):
+        """
+        receive membership updates from the tracker until the connection is closed
+        """
+        try:
+            while True:
+                raw_data = await recv_wrapper_async(self.tracker_reader)
+                if not raw_data:
+                    break
+                self.handle_tracker_message(self.receive_from_tracker(raw_data))
+        except (OSError, asyncio.CancelledError):
+            pass
+
+
+    async def request_blockchain_async(self):
+        """
+        requests the blocks we are missing from a few peers when joining the network
+        """
+        peers = self.get_peers()
+        if len(peers) == 0:
+            if len(self.blockchain) == 0:
+                await self.loop.run_in_executor(self.executor, self.create_genesis_block)
+            return
+
+        if len(self.blockchain) == 0:
+            self.request_chain(peers[0])
+        else:
+            self.chain_sync.start(peers)
+
+
+    def broadcast_data(self, data, peers=None):
+        """
+        send data to all peers in the network, or to the given list of peers
+        sends are queued on the event loop, so no thread is needed per peer
+        """
+        if peers is None:
+            peers = self.get_peers()
+        for peer_address in peers:
+            self.send_data(peer_address, data)
+
+
+    def send_data(self, peer_address, data):
+        """
+        queue data to be sent to a specific peer, safe to call from any thread
+        """
+        self.loop.call_soon_threadsafe(self.queue_peer_message, peer_address, data)
+
+
+    def send_data_and_wait(self, peer_address, data):
+        """
+        send_data() that blocks the calling thread until the data has been written, raises OSError if it couldn't be
+        a background thread streaming many messages uses it so they don't all pile up in the peer's queue
+        """
+        sent = concurrent.futures.Future()
+        self.loop.call_soon_threadsafe(self.queue_peer_message, peer_address, data, sent)
+        sent.result()
+
+
+    def queue_peer_message(self, peer_address, data, sent=None):
+        queue = self.peer_queues.get(peer_address)
+        if queue is None:
+            queue = asyncio.Queue()
+            self.peer_queues[peer_address] = queue
+            self.loop.create_task(self.peer_sender(peer_address, queue))
+        queue.put_nowait((data, sent))
+
+
+    async def peer_sender(self, peer_address, queue):
+        """
+        owns the connection to one peer and writes its queued messages in order
+        a broken connection is reopened and the message is sent again once
+        the connection is closed once nothing has been sent to the peer for IDLE_TIMEOUT seconds
+        a message queued by send_data_and_wait() has its future set once it is written, or failed
+        """
+        reader = writer = None
+        sent = None
+        try:
+            while True:
+                try:
+                    data, sent = await asyncio.wait_for(queue.get(), IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    if writer is not None:
+                        print(f"closing idle connection to peer {peer_address}")
+                    return
+
+                for attempt in range(2):
+                    try:
+                        if writer is not None and reader.at_eof():
+                            writer.close()
+                            writer = None
+                        if writer is None:
+                            reader, writer = await asyncio.open_connection(*parse_address(peer_address))
+                            writer.write(frame(self.connection_pool.hello))
+                        writer.write(frame(data))
+                        await writer.drain()
+                        self.metrics.sent(PEER_LINK, data)
+                        if sent is not None:
+                            sent.set_result(None)
+                        break
+                    except OSError as e:
+                        if writer is not None:
+                            writer.close()
+                            writer = None
+                        if attempt == 1:
+                            print(f"could not send data to peer {peer_address}: {e}")
+                            if sent is not None:
+                                sent.set_exception(e)
+        finally:
+            #nothing left in the queue will be sent, don't leave a thread waiting on it
+            stranded = [sent] + [queue.get_nowait()[1] for _ in range(queue.qsize())]
+            for future in stranded:
+                if future is not None and not future.done():
+                    future.set_exception(ConnectionError(f"stopped sending to peer {peer_address}"))
+            del self.peer_queues[peer_address]
+            if writer is not None:
+                writer.close()
+
+
+    async def handle_peer_stream(self, reader, writer):
+        """
+        receive messages from one peer's connection until it is closed
+        the peer's PEER_HELLO says which peer it is, a peer that doesn't send one is taken to listen on our peer port
+        a message that can't be decoded or handled is logged and skipped, like in Peer.handle_peer_connection()
+        """
+        peer_address = format_address(writer.get_extra_info('peername')[0], self.peer_port)
+        try:
+            while True:
+                raw_data = await recv_wrapper_async(reader)
+                if not raw_data:
+                    break
+                try:
+                    data = decode_message(raw_data)
+                    self.metrics.received(PEER_LINK, data[0], len(raw_data))
+                    if data[0] == PEER_HELLO:
+                        peer_address = data[1]
+                        continue
+                except Exception as error:
+                    print(f"could not decode a message from peer {peer_address}: {error!r}")
+                    continue
+                #the next message from this connection is read once this one is handled
+                await self.loop.run_in_executor(self.peer_executor, self.handle_peer_message_logged, data, peer_address)
+        except (OSError, asyncio.CancelledError, RuntimeError):
+            pass #closed by the peer, or cancelled (or its executor shut down) because we are shutting down
+        finally:
+            writer.close()
+
+    def run_in_background(self, function, *args):
+        """
+        run a blocking function, like relay_block()'s wait for its subtree, on the event loop's default executor
+        safe to call from any thread, peer messages are handled off the event loop
+        """
+        self.loop.call_soon_threadsafe(self.loop.run_in_executor, None, function, *args)
+
+
+    def send_message_to_app(self, data, client_socket):
+        """
+        send data to an application, safe to call from any thread
+        client_socket is the StreamWriter of the application
+        """
+        self.loop.call_soon_threadsafe(self.write_to_app, client_socket, data)
+
+
+    def write_to_app(self, writer, data):
+        if writer.is_closing():
+            print("application disconnected before it got a reply")
+            return
+        writer.write(frame(data))
+        self.metrics.sent(APP_LINK, data)
+
+
+    async def handle_app_stream(self, reader, writer):
+        """
+        handle communication with a connected application, up to max_apps are served at once and the rest wait here
+        """
+        async with self.app_slots:
+            self.app_clients[writer] = None
+            print(f"new application connected, {len(self.app_clients)} connected")
+            try:
+                while True:
+                    raw_data = await recv_wrapper_async(reader)
+                    if not raw_data:
+                        break
+                    data = json.loads(raw_data)
+                    self.metrics.received(APP_LINK, data[0], len(raw_data))
+                    if data[0] == TALLY_VOTE and app_request_id(data) is None:
+                        #building the whole chain's dicts would block the loop, and the reply has to come before the next request's
+                        await self.loop.run_in_executor(None, self.send_chain_to_app, writer)
+                    else:
+                        self.handle_app_message(data, writer)
+            except ConnectionResetError:
+                print(f"Connection reset by peer: {writer.get_extra_info('peername')}")
+            except asyncio.CancelledError:
+                pass #we are shutting down
+            finally:
+                del self.app_clients[writer]
+                writer.close()
+                print("application has disconnected")
@@ -0,0 +1,86 @@
+"""
+compares the json encoding of blocks that peers used to send against the binary block records (block_codec.py)
+
+every block holds a batch of votes like the ones the app sends. for each
+encoding this measures the bytes per block, the time to encode a block, the
+time to parse one back into a Block (what from_dict(json.loads()) did), the
+time to also read its data, and the time to recompute its hash
+
+USAGE (from the repo root): python3 -m benchmarks.block_encoding [--blocks 2000] [--votes 32]
+
+"""
+import argparse
+import json
+import time
+import uuid
+from block import Block, BLOCK_VERSION, LEGACY_VERSION, from_dict
+from block_codec import encode_block, decode_block
+
+
+def vote_batch(num_votes):
+    return {"votes": [{"user_id": str(uuid.uuid4()), "vote": "alice" if i % 2 else "bob",
+                       "name": f"voter{i}", "timestamp": 1715000000.123 + i} for i in range(num_votes)]}
+
+
+def make_blocks(num_blocks, num_votes, version):
+    """
+    a chain of blocks with random nonces, the hashes are computed but not mined, only their format matters here
+    """
+    blocks = []
+    for _ in range(num_blocks):
+        block = Block(data=vote_batch(num_votes), blockchain=blocks, version=version)
+        block.hash = block.calculate_hash()
+        blocks.append(block)
+    return blocks
+
+
+def per_block(function, items):
+    """
+    microseconds per item of calling function on every item
+    """
+    start = time.perf_counter()
+    for item in items:
+        function(item)
+    return (time.perf_counter() - start) / len(items) * 1e6
+
+
+def json_encode(block):
+    return json.dumps(block.to_dict()).encode('utf-8')
+
+
+def json_decode(raw):
+    return from_dict(json.loads(raw))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='block encoding benchmark')
+    parser.add_argument('--blocks', type=int, default=2000, help='blocks encoded and decoded')
+    parser.add_argument('--votes', type=int, default=32, help='votes in every block')
+    args = parser.parse_args()
+
+    legacy_blocks = make_blocks(args.blocks, args.votes, LEGACY_VERSION)
+    blocks = make_blocks(args.blocks, args.votes, BLOCK_VERSION)
+    json_raw = [json_encode(block) for block in legacy_blocks]
+    records = [encode_block(block) for block in blocks]
+    assert all(decode_block(record).calculate_hash() == block.hash for record, block in zip(records, blocks))
+
+    results = {
+        "json (version 1 blocks)": (
+            sum(map(len, json_raw)) / len(json_raw),
+            per_block(json_encode, legacy_blocks),
+            per_block(json_decode, json_raw),
+            per_block(lambda raw: json_decode(raw).data, json_raw),
+            per_block(Block.calculate_hash, legacy_blocks),
+        ),
+        "block records (version 2)": (
+            sum(map(len, records)) / len(records),
+            per_block(encode_block, blocks),
+            per_block(decode_block, records),
+            per_block(lambda record: decode_block(record).data, records),
+            per_block(Block.calculate_hash, blocks),
+        ),
+    }
+    print(f"{args.blocks} blocks of {args.votes} votes:")
+    print(f"  {'':28s} {'bytes/block':>12s} {'encode us':>10s} {'parse us':>10s} {'parse+data us':>14s} {'hash us':>8s}")
+    for name, (size, encode, decode, decode_data, hash) in results.items():
+        print(f"  {name:28s} {size:12.0f} {encode:10.1f} {decode:10.1f} {decode_data:14.1f} {hash:8.1f}")
@@ -0,0 +1,80 @@
+"""
+compares the memory used by a list of the original dict-based Blocks against a Blockchain of the same blocks
+
+USAGE (from the repo root): python3 -m benchmarks.chain_memory [--blocks 100000 1000000]
+
+"""
+import argparse
+import hashlib
+import tracemalloc
+import uuid
+from block import Block
+from blockchain import Blockchain
+
+
+class LegacyBlock:
+    """
+    the Block before it was made compact: a __dict__ holding the uuid string, hex hashes, and the data dict
+    """
+    def __init__(self, data, id, nonce, prev_hash, hash):
+        self.id = id
+        self.nonce = nonce
+        self.prev_hash = prev_hash
+        self.data = data
+        self.hash = hash
+
+
+def block_fields(height, prev_hash):
+    """
+    the fields of a block with one vote, like a block received from another peer
+    the hash is not mined, only its size matters here
+    """
+    vote = {"user_id": str(uuid.uuid4()), "vote": "alice" if height % 2 else "bob", "timestamp": 1715000000.123 + height, "name": f"voter{height}"}
+    hash = hashlib.sha256(b'%d' % height).hexdigest()
+    return {"votes": [vote]}, str(uuid.uuid4()), height, prev_hash, hash
+
+
+def legacy_chain(num_blocks):
+    chain = []
+    prev_hash = "0" * 64
+    for height in range(num_blocks):
+        block = LegacyBlock(*block_fields(height, prev_hash))
+        chain.append(block)
+        prev_hash = block.hash
+    return chain
+
+
+def compact_chain(num_blocks):
+    chain = Blockchain()
+    prev_hash = "0" * 64
+    for height in range(num_blocks):
+        data, id, nonce, prev_hash, hash = block_fields(height, prev_hash)
+        chain.append(Block(data=data, id=id, nonce=nonce, prev_hash=prev_hash, hash=hash))
+        prev_hash = hash
+    return chain
+
+
+def measure(build, num_blocks):
+    """
+    returns the bytes still allocated once the chain is built
+    """
+    tracemalloc.start()
+    chain = build(num_blocks)
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del chain
+    return used
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='blockchain memory benchmark')
+    parser.add_argument('--blocks', type=int, nargs='+', default=[100000, 1000000], help='chain lengths to measure')
+    args = parser.parse_args()
+
+    for num_blocks in args.blocks:
+        legacy = measure(legacy_chain, num_blocks)
+        compact = measure(compact_chain, num_blocks)
+        print(f"{num_blocks:8d} blocks:")
+        print(f"  dict-based blocks in a list:    {legacy / 2**20:8.1f} MiB ({legacy / num_blocks:6.0f} bytes/block)")
+        print(f"  Blockchain (block columns):     {compact / 2**20:8.1f} MiB ({compact / num_blocks:6.0f} bytes/block)")
+        print(f"  {legacy / compact:.2f}x less memory")
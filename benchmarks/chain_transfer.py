@@ -0,0 +1,89 @@
+"""
+compares the peak memory of receiving a whole chain as one RECV_CHAIN message against receiving it as a stream
+
+both receivers decode the messages, verify the blocks and append them to an
+empty Blockchain, like Peer.receive_chain(). the one-message receiver holds the
+whole message, and every decoded Block, before it appends the first one. the
+streaming receiver only holds one CHAIN_CHUNK_SIZE part at a time. the
+blocks are only checked for their links, so they don't need to be mined (a
+peer hashes every received block again, see chain_verify.py)
+
+USAGE (from the repo root): python3 -m benchmarks.chain_transfer [--blocks 20000] [--votes 32]
+
+"""
+import argparse
+import tracemalloc
+from block import Block, GENESIS_PREV_HASH
+from block_codec import encode_message, decode_message
+from blockchain import Blockchain
+from peer import CHAIN_CHUNK_SIZE
+from protocol import RECV_CHAIN
+from benchmarks.block_encoding import vote_batch
+
+
+def check_links(blocks, prev_hash):
+    """
+    only checks that every block links to the block before it
+    returns the index of the first bad block, or None if every block is good
+    """
+    for i, block in enumerate(blocks):
+        if block.prev_hash != prev_hash:
+            return i
+        prev_hash = block.hash
+    return None
+
+
+def make_chain(num_blocks, num_votes):
+    chain = Blockchain()
+    for _ in range(num_blocks):
+        block = Block(data=vote_batch(num_votes), blockchain=chain)
+        block.hash = block.calculate_hash()
+        chain.append(block)
+    return chain
+
+
+def receive(receiver, message):
+    _, start, blocks = decode_message(message)
+    prev_hash = receiver.hash_at(-1) if start else GENESIS_PREV_HASH
+    bad = check_links(blocks, prev_hash)
+    for block in blocks[:bad]:
+        receiver.append(block)
+
+
+def one_message(chain):
+    receiver = Blockchain()
+    receive(receiver, encode_message([RECV_CHAIN, 0, chain.raw_blocks()]))
+    return receiver
+
+
+def streamed(chain):
+    receiver = Blockchain()
+    for start in range(0, len(chain), CHAIN_CHUNK_SIZE):
+        receive(receiver, encode_message([RECV_CHAIN, start, chain.raw_blocks(start, start + CHAIN_CHUNK_SIZE)]))
+    return receiver
+
+
+def measure(transfer, chain):
+    """
+    returns (peak bytes allocated during the transfer, bytes the received chain still holds)
+    """
+    tracemalloc.start()
+    receiver = transfer(chain)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(receiver) == len(chain)
+    return peak, current
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='chain transfer memory benchmark')
+    parser.add_argument('--blocks', type=int, default=20000, help='length of the chain sent')
+    parser.add_argument('--votes', type=int, default=32, help='votes in every block')
+    args = parser.parse_args()
+
+    chain = make_chain(args.blocks, args.votes)
+    print(f"{args.blocks} blocks of {args.votes} votes, {CHAIN_CHUNK_SIZE} blocks per streamed message:")
+    for name, transfer in (("one RECV_CHAIN message", one_message), ("streamed RECV_CHAIN", streamed)):
+        peak, chain_bytes = measure(transfer, chain)
+        print(f"  {name:24s} peak {peak / 2**20:7.1f} MiB, received chain {chain_bytes / 2**20:6.1f} MiB, "
+              f"{peak / chain_bytes:5.2f}x the chain")
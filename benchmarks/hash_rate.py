@@ -0,0 +1,73 @@
+"""
+compares the hashes per second of the original mining loop against the midstate kernel
+
+USAGE (from the repo root): python3 -m benchmarks.hash_rate [--nonces N]
+
+"""
+import argparse
+import hashlib
+import time
+from block import Block, midstate, find_nonce
+
+VOTE = {"user_id": "3f1c2a9e-8d4b-4c52-9a57-0b6f3e2d1c4a", "vote": "alice", "timestamp": 1715000000.123, "name": "bob"}
+
+
+def legacy_loop(block, count):
+    """
+    the loop Block.mine() used before the kernel: rebuild and encode the whole content per nonce
+    """
+    nonce = block.nonce
+    id, prev_hash, data = block.id, block.prev_hash, block.data
+    for _ in range(count):
+        block_content = f"{id}{prev_hash}{data}{nonce}"
+        hashlib.sha256(block_content.encode()).hexdigest()
+        nonce += 1
+
+
+def kernel_loop(block, count):
+    """
+    the midstate kernel, carrying on past any nonce that meets the difficulty so it tries exactly count nonces
+    """
+    state = midstate(block.hash_prefix())
+    nonce = block.nonce
+    end = nonce + count
+    while nonce < end:
+        result = find_nonce(state, nonce, 1, end - nonce)
+        if result is None:
+            break
+        nonce = result[0] + 1
+
+
+def check_identical(block, count=1000):
+    """
+    the kernel must produce byte-for-byte the same hashes as calculate_hash()
+    """
+    state = midstate(block.hash_prefix())
+    start = block.nonce
+    for nonce in range(start, start + count):
+        h = state.copy()
+        h.update(b'%d' % nonce)
+        block.nonce = nonce
+        assert h.hexdigest() == block.calculate_hash(), f"hash mismatch at nonce {nonce}"
+    block.nonce = start
+
+
+def rate(loop, block, count):
+    start = time.perf_counter()
+    loop(block, count)
+    return count / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='mining hash rate benchmark')
+    parser.add_argument('--nonces', type=int, default=500000, help='nonces hashed per loop')
+    args = parser.parse_args()
+
+    block = Block(data=VOTE)
+    check_identical(block)
+
+    legacy = rate(legacy_loop, block, args.nonces)
+    kernel = rate(kernel_loop, block, args.nonces)
+    print(f"legacy loop:      {legacy:12,.0f} hashes/sec")
+    print(f"midstate kernel:  {kernel:12,.0f} hashes/sec")
+    print(f"speedup:          {kernel / legacy:12.2f}x")
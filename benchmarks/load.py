@@ -0,0 +1,340 @@
+"""
+load generator: starts a tracker and N peers on this machine and drives votes and tallies through app clients
+
+every process runs from the repo root with its output in --log-dir. they all
+listen on 127.0.0.1: the tracker on --port, and peer i (from 0) on the two ports
+after the ones of the peer before it, --port + 1 + 2i for peers and
+--port + 2 + 2i for apps (peers are told apart by their "host:port" address).
+the first peer creates the genesis block, and the others are started once the
+peer before them has a chain
+
+--clients app clients per peer (voting terminals, each on its own connection)
+send CAST_VOTE at --vote-rate votes a second across all clients, and TALLY_VOTE
+at --tally-rate tallies a second, each vote from a new voter. a client (app_client.py) has up
+to --in-flight requests waiting for a reply, so a request is sent when it is
+due or when one of those is answered, whichever is later. latency is measured
+from when the request was due, which includes any time it waited for a free
+slot, so an overloaded network shows up as latency and not only as fewer votes.
+with --vote-rate 0 every client sends votes as fast as they are answered
+
+the results (votes/sec, p50/p95/p99 latency of vote confirmations and tallies,
+and the configuration and commit they came from) are printed and written to
+--output as json, with where the votes of each peer spent their time (waiting in
+the mempool, mining, waiting for the other peers, and the whole block) from the peer's STATS
+
+USAGE (from the repo root): python3 -m benchmarks.load [--peers 3] [--clients 1] [--duration 20] [--vote-rate 20]
+                            [--tally-rate 0.5] [--in-flight 1] [--block-size 32] [--block-interval 0.25] [--workers 1] [--async]
+                            [--output load_results.json]
+
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from protocol import *
+from app_client import AppClient
+from metrics import BLOCK_SECONDS, MEMPOOL_WAIT_SECONDS, MINING_SECONDS, QUORUM_SECONDS, VOTE_SECONDS, HASH_RATE, MESSAGES_SENT, BYTES_SENT
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOST = "127.0.0.1"
+CANDIDATES = ["alice", "bob", "carol"]
+#seconds to wait for a process to start listening, or for a peer to get its chain
+START_TIMEOUT = 30
+
+
+def peer_ports(port, index):
+    """
+    the peer port and the app port of peer index, when the tracker listens on port
+    """
+    return port + 1 + 2 * index, port + 2 + 2 * index
+
+
+def wait_for_port(host, port, process):
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"process listening on {host}:{port} exited with code {process.returncode}")
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing is listening on {host}:{port} after {START_TIMEOUT} seconds")
+
+
+def chain_height(app_socket):
+    """
+    the number of blocks in the chain of the peer an app socket is connected to
+    """
+    send_wrapper(app_socket, json.dumps([TALLY_VOTE]))
+    data = json.loads(recv_wrapper(app_socket))
+    height = len(data[1])
+    while len(data) > 2 and data[2]:
+        data = json.loads(recv_wrapper(app_socket))
+        height += len(data[1])
+    return height
+
+
+def wait_for_chain(host, app_port):
+    deadline = time.monotonic() + START_TIMEOUT
+    with socket.create_connection((host, app_port)) as app_socket:
+        while chain_height(app_socket) == 0:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"peer with app port {app_port} has no blockchain after {START_TIMEOUT} seconds")
+            time.sleep(0.1)
+
+
+def start_network(args, log_dir):
+    """
+    starts the tracker and the peers, returns their processes once every peer has a chain
+    """
+    processes = []
+    def start(name, command):
+        log = open(os.path.join(log_dir, f"{name}.log"), "w")
+        processes.append(subprocess.Popen([sys.executable, "-u"] + command, cwd=REPO_DIR, stdout=log, stderr=subprocess.STDOUT))
+        log.close()
+        return processes[-1]
+
+    try:
+        tracker = start("tracker", ["tracker.py", str(args.port), "--host", HOST])
+        wait_for_port(HOST, args.port, tracker)
+        peer_options = ["--workers", str(args.workers), "--block-size", str(args.block_size),
+                        "--block-interval", str(args.block_interval), "--fanout", str(args.fanout)]
+        if args.async_mode:
+            peer_options.append("--async")
+        for index in range(args.peers):
+            peer_port, app_port = peer_ports(args.port, index)
+            peer = start(f"peer{index + 1}", ["peer.py", HOST, str(args.port), str(peer_port), str(app_port),
+                                              "--host", HOST] + peer_options)
+            wait_for_port(HOST, app_port, peer)
+            wait_for_chain(HOST, app_port)
+    except BaseException:
+        stop_network(processes)
+        raise
+    return processes
+
+
+def stop_network(processes):
+    """
+    interrupts the peers, then the tracker, like Ctrl-C, and kills whatever has not exited after a few seconds
+    """
+    for process in reversed(processes):
+        if process.poll() is None:
+            process.send_signal(signal.SIGINT)
+    for process in reversed(processes):
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def new_vote(number):
+    """
+    a vote from a new voter
+    """
+    return {"user_id": str(uuid.uuid4()), "vote": random.choice(CANDIDATES), "name": f"voter{number}", "timestamp": time.time()}
+
+
+def drive(app_port, duration, vote_interval, tally_interval, in_flight, result):
+    """
+    one app client: sends votes every vote_interval seconds (as fast as they are answered if None) and tallies every
+    tally_interval seconds (never if None) for duration seconds, with at most in_flight requests waiting for a reply,
+    and records the results in result
+    """
+    client = AppClient(app_port, HOST)
+    slots = threading.BoundedSemaphore(in_flight)
+    lock = threading.Lock()
+
+    def on_reply(kind, due, future):
+        with lock:
+            if future.exception() is not None:
+                result["errors"] += 1
+            elif kind == "tally":
+                result["votes_tallied"] = sum(future.result().counts.values())
+                result["tally_latencies"].append(time.monotonic() - due)
+            elif future.result() is True:
+                result["vote_latencies"].append(time.monotonic() - due)
+            else:
+                result["votes_rejected"] += 1
+        slots.release()
+
+    try:
+        start = time.monotonic()
+        end = start + duration
+        next_vote = start
+        next_tally = start + tally_interval if tally_interval else math.inf
+        while True:
+            slots.acquire()
+            now = time.monotonic()
+            if vote_interval is None:
+                next_vote = max(next_vote, now)
+            if next_tally <= next_vote:
+                kind, due = "tally", next_tally
+            else:
+                kind, due = "vote", next_vote
+            if due >= end:
+                slots.release()
+                break
+            if due > now:
+                time.sleep(due - now)
+            if kind == "vote":
+                future = client.cast_vote(new_vote(result["votes_sent"]))
+                result["votes_sent"] += 1
+                next_vote += vote_interval or 0
+            else:
+                future = client.count_blockchain()
+                next_tally += tally_interval
+            future.add_done_callback(lambda future, kind=kind, due=due: on_reply(kind, due, future))
+        #wait for the replies still in flight
+        for _ in range(in_flight):
+            slots.acquire()
+        result["elapsed"] = time.monotonic() - start
+    finally:
+        client.close()
+
+
+def latency_summary(latencies):
+    """
+    p50, p95, p99, mean and max of a list of seconds, in milliseconds (nearest rank)
+    """
+    if not latencies:
+        return None
+    ordered = sorted(latencies)
+    def percentile(p):
+        return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)] * 1000
+    return {"p50": percentile(50), "p95": percentile(95), "p99": percentile(99),
+            "mean": sum(ordered) / len(ordered) * 1000, "max": ordered[-1] * 1000, "count": len(ordered)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    log_dir = args.log_dir or tempfile.mkdtemp(prefix="blockchain-voting-load-")
+    os.makedirs(log_dir, exist_ok=True)
+    print(f"starting a tracker and {args.peers} peers, logs in {log_dir}")
+    processes = start_network(args, log_dir)
+    try:
+        num_clients = args.peers * args.clients
+        vote_interval = num_clients / args.vote_rate if args.vote_rate else None
+        tally_interval = num_clients / args.tally_rate if args.tally_rate else None
+        results = [{"peer": format_address(HOST, peer_ports(args.port, index)[0]), "app_port": peer_ports(args.port, index)[1],
+                    "votes_sent": 0, "votes_rejected": 0, "errors": 0, "votes_tallied": None,
+                    "vote_latencies": [], "tally_latencies": [], "elapsed": None}
+                   for index in range(args.peers) for _ in range(args.clients)]
+        print(f"driving load for {args.duration} seconds")
+        clients = [threading.Thread(target=drive, args=(result["app_port"], args.duration, vote_interval, tally_interval, args.in_flight, result))
+                   for result in results]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        counter = AppClient(peer_ports(args.port, 0)[1], HOST)
+        votes_in_chain = sum(counter.tally().result().values())
+        counter.close()
+        peer_stats = []
+        for index in range(args.peers):
+            stats_client = AppClient(peer_ports(args.port, index)[1], HOST)
+            peer_stats.append(stats_breakdown(format_address(HOST, peer_ports(args.port, index)[0]), stats_client.stats().result()))
+            stats_client.close()
+    finally:
+        stop_network(processes)
+
+    elapsed = max(result["elapsed"] or args.duration for result in results)
+    confirmed = sum(len(result["vote_latencies"]) for result in results)
+    return {
+        "started_at": args.started_at,
+        "commit": git_commit(),
+        "config": {name: value for name, value in vars(args).items() if name not in ("output", "log_dir", "started_at")},
+        "elapsed_s": elapsed,
+        "votes_sent": sum(result["votes_sent"] for result in results),
+        "votes_confirmed": confirmed,
+        "votes_rejected": sum(result["votes_rejected"] for result in results),
+        "errors": sum(result["errors"] for result in results),
+        "votes_in_chain": votes_in_chain,
+        "votes_per_sec": confirmed / elapsed,
+        "vote_latency_ms": latency_summary([latency for result in results for latency in result["vote_latencies"]]),
+        "tallies": sum(len(result["tally_latencies"]) for result in results),
+        "tally_latency_ms": latency_summary([latency for result in results for latency in result["tally_latencies"]]),
+        "per_client": [{"peer": result["peer"], "votes_sent": result["votes_sent"], "votes_rejected": result["votes_rejected"],
+                        "votes_tallied": result["votes_tallied"], "vote_latency_ms": latency_summary(result["vote_latencies"])}
+                       for result in results],
+        "peer_stats": peer_stats,
+        "log_dir": log_dir,
+    }
+
+
+def stats_breakdown(peer, snapshot):
+    """
+    the mean milliseconds a peer's votes spent in each stage, its hash rate, and its traffic, from its STATS snapshot
+    """
+    def mean_ms(name, **labels):
+        count = total = 0
+        for sample_labels, value in snapshot.get(name, []):
+            if all(sample_labels.get(label) == wanted for label, wanted in labels.items()):
+                count += value["count"]
+                total += value["sum"]
+        return total / count * 1000 if count else None
+
+    def total(name):
+        return sum(value for _, value in snapshot.get(name, []))
+
+    return {"peer": peer, "mempool_wait_ms": mean_ms(MEMPOOL_WAIT_SECONDS), "mining_ms": mean_ms(MINING_SECONDS),
+            "quorum_ms": mean_ms(QUORUM_SECONDS, outcome="accepted"), "block_ms": mean_ms(BLOCK_SECONDS), "vote_ms": mean_ms(VOTE_SECONDS, outcome="accepted"),
+            "blocks_mined": sum(value["count"] for _, value in snapshot.get(MINING_SECONDS, [])),
+            "hash_rate": total(HASH_RATE), "messages_sent": total(MESSAGES_SENT), "bytes_sent": total(BYTES_SENT)}
+
+
+def print_summary(report):
+    print(f"{report['votes_confirmed']} of {report['votes_sent']} votes confirmed in {report['elapsed_s']:.1f} s "
+          f"({report['votes_per_sec']:.1f} votes/sec), {report['votes_in_chain']} votes in the chain")
+    for name in ("vote_latency_ms", "tally_latency_ms"):
+        summary = report[name]
+        if summary:
+            print(f"  {name[:-11]:5s} latency ms: p50 {summary['p50']:8.1f}  p95 {summary['p95']:8.1f}  "
+                  f"p99 {summary['p99']:8.1f}  max {summary['max']:8.1f}  ({summary['count']} requests)")
+    for stats in report["peer_stats"]:
+        stages = "  ".join(f"{stage[:-3]} {stats[stage]:7.1f}" if stats[stage] is not None else f"{stage[:-3]}       -"
+                           for stage in ("mempool_wait_ms", "mining_ms", "quorum_ms", "block_ms", "vote_ms"))
+        print(f"  peer {stats['peer']} mean ms: {stages}  ({stats['blocks_mined']} blocks, {stats['hash_rate']:.0f} hashes/sec)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='loopback load generator for a network of peers')
+    parser.add_argument('--peers', type=int, default=3, help='number of peers started')
+    parser.add_argument('--clients', type=int, default=1, help='app clients connected to each peer')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of load')
+    parser.add_argument('--vote-rate', type=float, default=20, help='votes a second across all clients, 0 sends votes as fast as they are answered')
+    parser.add_argument('--in-flight', type=int, default=1, help='most requests each client has waiting for a reply')
+    parser.add_argument('--tally-rate', type=float, default=0.5, help='TALLY_VOTE requests a second across all clients, 0 for none')
+    parser.add_argument('--port', type=int, default=47000, help='tracker port, each peer uses the next two ports after the ones before it')
+    parser.add_argument('--workers', type=int, default=1, help='peer.py --workers')
+    parser.add_argument('--block-size', type=int, default=32, help='peer.py --block-size')
+    parser.add_argument('--block-interval', type=float, default=0.25, help='peer.py --block-interval')
+    parser.add_argument('--fanout', type=int, default=0, help='peer.py --fanout')
+    parser.add_argument('--async', dest='async_mode', action='store_true', help='peer.py --async')
+    parser.add_argument('--log-dir', type=str, default=None, help='directory for the output of every process, a new temporary one by default')
+    parser.add_argument('--output', type=str, default='load_results.json', help='file the json results are written to')
+    args = parser.parse_args()
+    args.started_at = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+
+    report = run(args)
+    print_summary(report)
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+    print(f"results written to {args.output}")
@@ -0,0 +1,85 @@
+"""
+compares the apps' old tally of a RETURNED_BLOCKCHAIN against the tally engine (tally.py)
+
+the old tally built a Block with from_dict() for every block dict, read its data
+back, and counted the votes in a dict loop. the engine counts the votes
+straight from the block dicts, or from block records without decoding them.
+the json of the message is parsed before either tally, and is timed on its own
+
+USAGE (from the repo root): python3 -m benchmarks.tally [--votes 1000000] [--votes-per-block 32]
+
+"""
+import argparse
+import json
+import time
+from block import Block, block_votes, from_dict
+from block_codec import encode_block, decode_block
+from tally import VoteTally
+from benchmarks.block_encoding import vote_batch
+
+
+def old_tally(raw_blockchain):
+    votes = {}
+    for block in [from_dict(block_dict) for block_dict in raw_blockchain]:
+        for vote in block_votes(block.data):
+            voted_for = vote['vote']
+            if voted_for in votes:
+                votes[voted_for] += 1
+            else:
+                votes[voted_for] = 1
+    return votes
+
+
+def old_record_tally(records):
+    votes = {}
+    for record in records:
+        for vote in block_votes(decode_block(record).data):
+            votes[vote['vote']] = votes.get(vote['vote'], 0) + 1
+    return votes
+
+
+def engine_tally(raw_blockchain):
+    tally = VoteTally()
+    tally.add_blocks(raw_blockchain)
+    return tally.counts
+
+
+def engine_record_tally(records):
+    tally = VoteTally()
+    tally.add_records(records)
+    return tally.counts
+
+
+def timed(function, argument):
+    start = time.process_time()
+    result = function(argument)
+    return result, (time.process_time() - start) * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='vote tally benchmark')
+    parser.add_argument('--votes', type=int, default=1000000, help='votes in the chain')
+    parser.add_argument('--votes-per-block', type=int, default=32, help='votes in every block')
+    args = parser.parse_args()
+
+    blocks = []
+    for _ in range(args.votes // args.votes_per_block):
+        block = Block(data=vote_batch(args.votes_per_block), blockchain=blocks)
+        block.hash = block.calculate_hash()
+        blocks.append(block)
+    message = json.dumps([[block.to_dict() for block in blocks]])
+    records = [encode_block(block) for block in blocks]
+
+    raw_blockchain, parse_ms = timed(json.loads, message)
+    raw_blockchain = raw_blockchain[0]
+    print(f"{len(blocks) * args.votes_per_block} votes in {len(blocks)} blocks, CPU ms:")
+    print(f"  {'parsing the json message':40s} {parse_ms:8.0f}")
+    results = []
+    for name, function, chain in (("old tally of the block dicts", old_tally, raw_blockchain),
+                                  ("VoteTally.add_blocks", engine_tally, raw_blockchain),
+                                  ("decode_block().data of the records", old_record_tally, records),
+                                  ("VoteTally.add_records", engine_record_tally, records)):
+        counts, ms = timed(function, chain)
+        results.append(dict(counts))
+        print(f"  {name:40s} {ms:8.0f}")
+    assert all(counts == results[0] for counts in results)
@@ -0,0 +1,121 @@
+"""
+measures how fast the tracker answers LIST_PEERS with thousands of peers connected
+
+the tracker runs on its event loop in this process. a child process opens one
+connection per peer, joins each with its own made-up host:port address (several
+peers to a host, like peers sharing a machine), then times LIST_PEERS round
+trips over one more connection. the peers stay connected while the requests are
+timed, then disconnect, and the tracker must drop every one of them
+
+USAGE (from the repo root): python3 -m benchmarks.tracker_load [--peers 1000 10000] [--requests N]
+
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import statistics
+import threading
+import time
+from protocol import *
+from tracker import Tracker
+
+#connections opened at once by the load generator
+CONNECT_BATCH = 500
+#peers advertised on each made-up host, and the peer port of the first of them
+PEERS_PER_HOST = 8
+FIRST_PEER_PORT = 50001
+
+
+def fake_address(i):
+    """
+    the made-up "host:port" address peer i advertises, like the one it would send in PEER_HELLO
+    PEERS_PER_HOST peers share each host, on every other port from FIRST_PEER_PORT like benchmarks/load.py
+    """
+    host = i // PEERS_PER_HOST
+    return format_address(f"10.{host >> 16 & 255}.{host >> 8 & 255}.{host & 255}", FIRST_PEER_PORT + 2 * (i % PEERS_PER_HOST))
+
+
+async def list_peers(reader, writer, requester_address):
+    writer.write(frame(json.dumps([LIST_PEERS, requester_address])))
+    return json.loads(await recv_wrapper_async(reader))
+
+
+async def load(port, num_peers, num_requests):
+    """
+    connect and join num_peers peers, then time num_requests LIST_PEERS round trips
+    """
+    async def join(i):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(frame(json.dumps([JOIN_NETWORK, fake_address(i)])))
+        return writer
+
+    start = time.perf_counter()
+    writers = []
+    for batch_start in range(0, num_peers, CONNECT_BATCH):
+        batch = range(batch_start, min(batch_start + CONNECT_BATCH, num_peers))
+        writers += await asyncio.gather(*(join(i) for i in batch))
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    probe_address = fake_address(num_peers)
+    while len(await list_peers(reader, writer, probe_address)) < num_peers:
+        await asyncio.sleep(0.01)
+    join_seconds = time.perf_counter() - start
+
+    latencies = []
+    for _ in range(num_requests):
+        request_start = time.perf_counter()
+        peers = await list_peers(reader, writer, probe_address)
+        latencies.append(time.perf_counter() - request_start)
+        assert len(peers) == num_peers
+
+    for peer_writer in writers + [writer]:
+        peer_writer.close()
+    return join_seconds, latencies
+
+
+def run_load(port, num_peers, num_requests, results):
+    results.send(asyncio.run(load(port, num_peers, num_requests)))
+
+
+async def measure(tracker, port, num_peers, num_requests):
+    """
+    run one load generator against the tracker and wait for it without blocking the tracker's loop
+    """
+    results, child_results = multiprocessing.Pipe(duplex=False)
+    child = multiprocessing.get_context('spawn').Process(target=run_load, args=(port, num_peers, num_requests, child_results))
+    child.start()
+    loop = asyncio.get_running_loop()
+    join_seconds, latencies = await loop.run_in_executor(None, results.recv)
+    threads = threading.active_count()
+    await loop.run_in_executor(None, child.join)
+
+    deadline = time.monotonic() + 10
+    while tracker.peers and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    return join_seconds, latencies, threads, len(tracker.peers)
+
+
+async def main(args):
+    tracker = Tracker(args.port)
+    server = await asyncio.start_server(tracker.peer_handler, '127.0.0.1', args.port, backlog=1024)
+    async with server:
+        for num_peers in args.peers:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                join_seconds, latencies, threads, left = await measure(tracker, args.port, num_peers, args.requests)
+            latencies.sort()
+            p50 = statistics.median(latencies) * 1000
+            p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+            print(f"{num_peers:6d} peers: joined in {join_seconds:6.2f}s, LIST_PEERS p50 {p50:7.2f} ms, p99 {p99:7.2f} ms, "
+                  f"tracker threads {threads}, peers left after disconnect {left}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='tracker LIST_PEERS load test')
+    parser.add_argument('--peers', type=int, nargs='+', default=[1000, 10000], help='numbers of connected peers to test with')
+    parser.add_argument('--requests', type=int, default=200, help='LIST_PEERS requests timed per run')
+    parser.add_argument('--port', type=int, default=52000, help='port the tracker listens on')
+    args = parser.parse_args()
+    asyncio.run(main(args))
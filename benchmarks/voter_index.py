@@ -0,0 +1,60 @@
+"""
+compares the voter index with a set of every voter against the one with a bloom filter in front (voter_index.py)
+
+both indexes get the same random voter keys, 32 per block. this measures the
+memory each one holds, and the time to check a voter that has not voted (the
+usual case for a new vote) and one that has
+
+USAGE (from the repo root): python3 -m benchmarks.voter_index [--voters 1000000] [--checks 10000]
+
+"""
+import argparse
+import os
+import time
+import tracemalloc
+from voter_index import VoterIndex
+
+VOTES_PER_BLOCK = 32
+
+
+def build(keys, bloom_capacity):
+    """
+    returns (the index, bytes it holds)
+    """
+    tracemalloc.start()
+    index = VoterIndex(bloom_capacity)
+    for start in range(0, len(keys), VOTES_PER_BLOCK):
+        #new key objects, like the ones read from each block, so the set is charged for them
+        index.append([bytes(bytearray(key)) for key in keys[start:start + VOTES_PER_BLOCK]])
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return index, size
+
+
+def per_check(index, keys):
+    """
+    microseconds per key of checking whether it is in the index
+    """
+    start = time.perf_counter()
+    for key in keys:
+        key in index
+    return (time.perf_counter() - start) / len(keys) * 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='voter index benchmark')
+    parser.add_argument('--voters', type=int, default=1000000, help='voters in the chain')
+    parser.add_argument('--checks', type=int, default=10000, help='new and repeat voters checked')
+    args = parser.parse_args()
+
+    keys = [os.urandom(16) for _ in range(args.voters)]
+    new_voters = [os.urandom(16) for _ in range(args.checks)]
+    repeat_voters = keys[::max(1, args.voters // args.checks)][:args.checks]
+    print(f"{args.voters} voters:")
+    print(f"  {'':28s} {'MB held':>8s} {'new voter us':>13s} {'repeat voter us':>16s} {'false positives':>16s}")
+    for name, bloom_capacity in (("set of every voter", None), ("bloom filter and column", args.voters)):
+        index, size = build(keys, bloom_capacity)
+        false_positives = sum(key in index.bloom for key in new_voters) if index.bloom else 0
+        assert not any(key in index for key in new_voters) and all(key in index for key in repeat_voters)
+        print(f"  {name:28s} {size / 1e6:8.1f} {per_check(index, new_voters):13.2f} "
+              f"{per_check(index, repeat_voters[:100]):16.0f} {false_positives / len(new_voters):16.2%}")
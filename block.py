@@ -1,15 +1,126 @@
 """
 class definition for a Block in blockchain
 
+a Block keeps its fields in a compact form: the id as the uuid's 16 raw bytes,
+the hashes as their 32 raw bytes, and the data as encoded bytes. the
+id, prev_hash, hash and data attributes still read and write the usual uuid
+string, hex strings and dict, converted when they are used. values that would
+not convert back exactly (e.g. an id that isn't a uuid) are kept as they are
+
+blocks have a version. version 1 blocks (every block made before there were
+versions) keep their data as compact json and are hashed from the python str()
+of their fields, like they always were, so existing chains still validate. new
+blocks are version 2: their data is in the canonical encoding (encoding.py) and
+they are hashed from BLOCK_HEAD and that data, a byte string that doesn't
+depend on dict key order or the python version. a version 2 block's record on
+the wire and on disk (block_codec.py) starts with exactly those bytes
+
 """
 import hashlib 
+import json
+import struct
 import uuid
 import random
+from encoding import encode_value, decode_value, uuid_bytes
 
 DIFFICULTY = 3
 
+#a hash meets the difficulty when its first DIFFICULTY hex digits are zero,
+#which is the same as the raw 32-byte digest being below this value
+DIFFICULTY_TARGET = (1 << (256 - 4 * DIFFICULTY)).to_bytes(32, 'big')
+
+#prev_hash of the genesis block
+GENESIS_PREV_HASH = "0" * 64
+
+LEGACY_VERSION = 1
+BLOCK_VERSION = 2
+
+#a version 2 block hashes this (version, raw id, raw prev_hash, data length), then its
+#encoded data, then its nonce in decimal; a block record ends with BLOCK_TAIL (nonce, raw hash)
+BLOCK_HEAD = struct.Struct('!B16s32sI')
+BLOCK_TAIL = struct.Struct('!Q32s')
+
+
+def midstate(prefix):
+    """
+    hashes the part of a block's content that does not change while mining
+    copies of the returned state only need the nonce appended
+    """
+    return hashlib.sha256(prefix)
+
+
+def find_nonce(state, start, step=1, count=None):
+    """
+    mining kernel: tries nonces start, start + step, ... on copies of a midstate
+    returns (nonce, hash) for the first hash that meets the difficulty,
+    or None if count nonces were tried without a match
+    """
+    target = DIFFICULTY_TARGET
+    copy = state.copy
+    nonce = start
+    tried = 0
+    while count is None or tried < count:
+        h = copy()
+        h.update(b'%d' % nonce)
+        if h.digest() < target:
+            return nonce, h.hexdigest()
+        nonce += step
+        tried += 1
+    return None
+
+
+def compact_id(id):
+    """
+    the 16 raw bytes of a uuid string, or the id itself if it isn't a uuid in its usual form
+    """
+    raw = uuid_bytes(id) if isinstance(id, str) else None
+    return id if raw is None else raw
+
+
+def compact_hash(hash):
+    """
+    the 32 raw bytes of a lowercase hex hash, or the hash itself if it isn't one
+    """
+    if isinstance(hash, str) and len(hash) == 64:
+        try:
+            raw = bytes.fromhex(hash)
+        except ValueError:
+            return hash
+        if raw.hex() == hash:
+            return raw
+    return hash
+
+
+def compact_data(data):
+    """
+    block data as compact json bytes, or the data itself if it would not decode back to an equal value
+    """
+    if data is None:
+        return None
+    try:
+        encoded = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    except (TypeError, ValueError):
+        return data
+    if json.loads(encoded) != data:
+        return data
+    return encoded
+
+
+def canonical_data(data):
+    """
+    block data in the canonical encoding, or the data itself if it can't be encoded
+    """
+    try:
+        return encode_value(data)
+    except (TypeError, ValueError):
+        return data
+
+
 class Block:
-    def __init__(self, data=None, blockchain=None, id=None, nonce=None, prev_hash=None, hash=None):
+    __slots__ = ('version', '_id', 'nonce', '_prev_hash', '_data', '_hash')
+
+    def __init__(self, data=None, blockchain=None, id=None, nonce=None, prev_hash=None, hash=None, version=BLOCK_VERSION):
+        self.version = version #set first, it decides how the data is stored
         self.id = id if id is not None else str(uuid.uuid4())
         self.nonce = nonce if nonce is not None else random.randint(0, 2**32)
         if prev_hash:
@@ -18,26 +129,98 @@ class Block:
             if blockchain:
                 self.prev_hash = blockchain[-1].hash
             else:
-                self.prev_hash = "0000000000000000000000000000000000000000000000000000000000000000"
+                self.prev_hash = GENESIS_PREV_HASH
         self.data = data
         self.hash = hash
-    
+
+
+    @property
+    def id(self):
+        return str(uuid.UUID(bytes=self._id)) if isinstance(self._id, bytes) else self._id
+
+
+    @id.setter
+    def id(self, id):
+        self._id = compact_id(id)
+
+
+    @property
+    def prev_hash(self):
+        return self._prev_hash.hex() if isinstance(self._prev_hash, bytes) else self._prev_hash
+
+
+    @prev_hash.setter
+    def prev_hash(self, prev_hash):
+        self._prev_hash = compact_hash(prev_hash)
+
+
+    @property
+    def hash(self):
+        return self._hash.hex() if isinstance(self._hash, bytes) else self._hash
+
+
+    @hash.setter
+    def hash(self, hash):
+        self._hash = compact_hash(hash)
+
+
+    def raw_fields(self):
+        """
+        the fields as they are stored: (version, id, nonce, prev_hash, data, hash), with bytes for every field that converted
+        """
+        return self.version, self._id, self.nonce, self._prev_hash, self._data, self._hash
+
+
+    @property
+    def data(self):
+        """
+        a new copy of the block's data, changing it does not change the block
+        """
+        if not isinstance(self._data, bytes):
+            return self._data
+        if self.version == LEGACY_VERSION:
+            return json.loads(self._data)
+        return decode_value(self._data)
+
+
+    @data.setter
+    def data(self, data):
+        self._data = compact_data(data) if self.version == LEGACY_VERSION else canonical_data(data)
+
+
+    def hash_prefix(self):
+        """
+        the encoded block content that comes before the nonce
+        raises ValueError for a block that can't be hashed (a version 2 block needs a uuid id, a hex prev_hash, and data that encodes)
+        """
+        if self.version == LEGACY_VERSION:
+            return f"{self.id}{self.prev_hash}{self.data}".encode()
+        if self.version != BLOCK_VERSION:
+            raise ValueError(f"unknown block version {self.version}")
+        if not (isinstance(self._id, bytes) and isinstance(self._prev_hash, bytes) and isinstance(self._data, bytes)):
+            raise ValueError("a version 2 block needs a uuid id, a hex prev_hash, and data that encodes")
+        return BLOCK_HEAD.pack(self.version, self._id, self._prev_hash, len(self._data)) + self._data
+
 
     def calculate_hash(self):
         """
         creates a hash of everything in the block
         """
-        block_content = f"{self.id}{self.prev_hash}{self.data}{self.nonce}"
-        return hashlib.sha256(block_content.encode()).hexdigest()
+        return midstate(self.hash_prefix() + str(self.nonce).encode()).hexdigest()
     
 
-    def mine(self):
+    def mine(self, miner=None):
         """
         mines for the correct nonce to match the difficulty
+        the prefix is hashed once and only the nonce is hashed for each try
+        if a Miner is given, the nonce search is split across its worker processes
         """
-        while not self.is_valid():
-            self.nonce += 1
-            self.hash = self.calculate_hash()
+        if self.is_valid():
+            return
+        if miner is not None:
+            self.nonce, self.hash = miner.search(self.hash_prefix(), self.nonce + 1)
+        else:
+            self.nonce, self.hash = find_nonce(midstate(self.hash_prefix()), self.nonce + 1)
 
 
     def is_valid(self):
@@ -55,6 +238,7 @@ class Block:
         used for sending over the network
         """
         return {
+            "version": self.version,
             "id": self.id,
             "nonce": self.nonce,
             "prev_hash": self.prev_hash,
@@ -76,4 +260,48 @@ def from_dict(block_dict):
     prev_hash = block_dict.get('prev_hash')
     data = block_dict.get('data')
     hash = block_dict.get('hash')
-    return Block(data=data, blockchain=None, id=id, nonce=nonce, prev_hash=prev_hash, hash=hash)
\ No newline at end of file
+    version = block_dict.get('version', LEGACY_VERSION) #dicts from before blocks had versions
+    return Block(data=data, blockchain=None, id=id, nonce=nonce, prev_hash=prev_hash, hash=hash, version=version)
+
+
+def block_from_raw(version, id, nonce, prev_hash, data, hash):
+    """
+    creates a Block straight from the compact form of its fields (see Block.raw_fields())
+    """
+    block = Block.__new__(Block)
+    block.version = version
+    block._id = id
+    block.nonce = nonce
+    block._prev_hash = prev_hash
+    block._data = data
+    block._hash = hash
+    return block
+
+
+def block_votes(data):
+    """
+    returns the list of votes stored in a block's data
+    blocks hold {"votes": [...]}, older blocks hold a single vote dict, and the genesis block holds None
+    """
+    if not data:
+        return []
+    if 'votes' in data:
+        return data['votes']
+    return [data]
+
+
+def is_vote(vote):
+    """
+    whether a vote can be counted: a dict with a vote string
+    """
+    return isinstance(vote, dict) and isinstance(vote.get('vote'), str)
+
+
+def countable_votes(data):
+    """
+    whether every vote in a block's data can be counted, a block with one that can't is rejected
+    """
+    try:
+        return all(map(is_vote, block_votes(data)))
+    except TypeError:
+        return False
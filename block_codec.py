@@ -0,0 +1,125 @@
+"""
+binary encoding of Blocks, used for blocks sent between peers and blocks kept in a chain store
+
+a block record is a Block's fields in a fixed order, with fixed sizes except for
+the data, which has its length in front:
+
+    version (1 byte) | id (16 raw uuid bytes) | prev_hash (32 raw bytes) | data length (4 bytes) | data | nonce (8 bytes) | hash (32 raw bytes)
+
+a version 2 block's data is its canonical encoding (encoding.py), and the part of
+the record before the nonce is exactly what the block's hash covers. a version 1
+(legacy) block's data is compact json (no data at all for None), and it is still
+hashed from the str() of its fields. a block whose fields don't fit a record
+(e.g. an id that isn't a uuid) is sent as a version 0 record instead: the 0 byte
+followed by the json of Block.to_dict()
+
+decoding a record only splits it into fields, the data is decoded when the
+Block's data is read
+
+peer messages that carry blocks (NEW_BLOCK, RECV_CHAIN, RECV_BLOCKS) are block
+messages instead of json:
+
+    BLOCK_MESSAGE (1 byte) | index of the blocks in the message (1 byte) | SINGLE_BLOCK or BLOCK_LIST (1 byte) | json length (4 bytes)
+    | json of the message with None at that index | record length (4 bytes) | record | record length | record | ...
+
+every other message is still json, which always starts with '['
+
+"""
+import json
+import struct
+from block import BLOCK_HEAD, BLOCK_TAIL, BLOCK_VERSION, LEGACY_VERSION, Block, block_from_raw, from_dict
+
+JSON_RECORD = 0
+BLOCK_MESSAGE = 0
+SINGLE_BLOCK = 0
+BLOCK_LIST = 1
+MESSAGE_HEAD = struct.Struct('!BBBI')
+RECORD_LENGTH = struct.Struct('!I')
+
+
+def encode_block(block):
+    """
+    the block record of a Block
+    """
+    version, id, nonce, prev_hash, data, hash = block.raw_fields()
+    if version == LEGACY_VERSION and data is None:
+        data = b''
+    if version in (LEGACY_VERSION, BLOCK_VERSION) and isinstance(data, bytes):
+        try:
+            return BLOCK_HEAD.pack(version, id, prev_hash, len(data)) + data + BLOCK_TAIL.pack(nonce, hash)
+        except struct.error:
+            pass #a field isn't in its compact form
+    return bytes([JSON_RECORD]) + json.dumps(block.to_dict()).encode('utf-8')
+
+
+def decode_block(record):
+    """
+    the Block from a block record (bytes or a memoryview)
+    raises ValueError if the record is malformed
+    """
+    try:
+        if record[0] == JSON_RECORD:
+            return from_dict(json.loads(bytes(record[1:])))
+        version, id, prev_hash, data_length = BLOCK_HEAD.unpack_from(record, 0)
+        data_end = BLOCK_HEAD.size + data_length
+        nonce, hash = BLOCK_TAIL.unpack_from(record, data_end)
+    except (IndexError, AttributeError, struct.error):
+        raise ValueError("malformed block record")
+    if version not in (LEGACY_VERSION, BLOCK_VERSION) or data_end + BLOCK_TAIL.size != len(record):
+        raise ValueError("malformed block record")
+    data = bytes(record[BLOCK_HEAD.size:data_end])
+    if version == LEGACY_VERSION and not data:
+        data = None
+    return block_from_raw(version, id, nonce, prev_hash, data, hash)
+
+
+def encode_message(parts):
+    """
+    encodes a message to another peer
+    a message with a Block, or a list of block records, in it is sent as a block message, any other message as json
+    """
+    for index, part in enumerate(parts):
+        if isinstance(part, Block):
+            kind, records = SINGLE_BLOCK, [encode_block(part)]
+        elif isinstance(part, list) and part and isinstance(part[0], bytes):
+            kind, records = BLOCK_LIST, part
+        else:
+            continue
+        header = json.dumps(parts[:index] + [None] + parts[index + 1:]).encode('utf-8')
+        chunks = [MESSAGE_HEAD.pack(BLOCK_MESSAGE, index, kind, len(header)), header]
+        for record in records:
+            chunks.append(RECORD_LENGTH.pack(len(record)))
+            chunks.append(record)
+        return b''.join(chunks)
+    return json.dumps(parts)
+
+
+def decode_message(raw):
+    """
+    decodes a message from another peer, with Blocks in place of the records of a block message
+    raises ValueError if the message is malformed
+    """
+    if raw[:1] != bytes([BLOCK_MESSAGE]):
+        return json.loads(raw)
+    try:
+        _, index, kind, header_length = MESSAGE_HEAD.unpack_from(raw, 0)
+    except struct.error:
+        raise ValueError("truncated block message")
+    view = memoryview(raw)
+    position = MESSAGE_HEAD.size + header_length
+    parts = json.loads(bytes(view[MESSAGE_HEAD.size:position]))
+    blocks = []
+    while position < len(raw):
+        try:
+            (record_length,) = RECORD_LENGTH.unpack_from(raw, position)
+        except struct.error:
+            raise ValueError("truncated block message")
+        position += RECORD_LENGTH.size
+        if position + record_length > len(raw):
+            raise ValueError("truncated block message")
+        blocks.append(decode_block(view[position:position + record_length]))
+        position += record_length
+    if not isinstance(parts, list) or index >= len(parts) or (kind == SINGLE_BLOCK and len(blocks) != 1):
+        raise ValueError("malformed block message")
+    parts[index] = blocks[0] if kind == SINGLE_BLOCK else blocks
+    return parts
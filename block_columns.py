@@ -0,0 +1,127 @@
+"""
+columnar in-memory storage for the blocks of a Blockchain
+
+instead of one Block object per height, every field is kept in its own flat
+column: 16 raw bytes of id, 32 of prev_hash and 32 of hash per block, the nonces
+and versions in arrays, and every block's encoded data one after another. a
+block costs about the size of its fields, with no per-object overhead, and a
+Block is only built when one is asked for. a dictionary of raw hash -> height
+finds a block by its hash without scanning the hash column
+
+a block with a field that has no compact form (e.g. an id that isn't a uuid)
+is kept as a Block on the side, with zeros in the columns at its height
+
+"""
+from array import array
+from block import block_from_raw, compact_hash
+
+ID_SIZE = 16
+HASH_SIZE = 32
+MAX_NONCE = 2**64 - 1
+
+
+class BlockColumns:
+    def __init__(self):
+        """
+        Initializes an empty BlockColumns.
+        """
+        self.ids = bytearray()
+        self.prev_hashes = bytearray()
+        self.hashes = bytearray()
+        self.nonces = array('Q')
+        self.versions = array('B')
+        self.data = bytearray() #every block's encoded data, one after another
+        self.data_ends = array('Q') #where each block's data ends in self.data, a block with no data has none
+        self.irregular = {} #height -> Block, for blocks that don't fit the columns
+        self.heights = {} #raw 32-byte hash -> height, for the blocks in the columns
+
+
+    def __len__(self):
+        return len(self.nonces)
+
+
+    def append(self, block):
+        version, id, nonce, prev_hash, data, hash = block.raw_fields()
+        regular = (isinstance(id, bytes) and isinstance(prev_hash, bytes) and isinstance(hash, bytes)
+                   and isinstance(nonce, int) and 0 <= nonce <= MAX_NONCE and (data is None or isinstance(data, bytes))
+                   and isinstance(version, int) and 0 <= version <= 255)
+        if not regular:
+            self.irregular[len(self)] = block
+            version, id, nonce, prev_hash, data, hash = 0, bytes(ID_SIZE), 0, bytes(HASH_SIZE), None, bytes(HASH_SIZE)
+        else:
+            self.heights.setdefault(hash, len(self))
+        self.versions.append(version)
+        self.ids += id
+        self.prev_hashes += prev_hash
+        self.hashes += hash
+        self.nonces.append(nonce)
+        if data is not None:
+            self.data += data
+        self.data_ends.append(len(self.data))
+
+
+    def pop(self):
+        """
+        remove the last block and return it
+        """
+        block = self[len(self) - 1]
+        height = len(self) - 1
+        if height not in self.irregular:
+            raw = bytes(self.hashes[height * HASH_SIZE:])
+            if self.heights.get(raw) == height:
+                del self.heights[raw]
+        del self.ids[height * ID_SIZE:]
+        del self.prev_hashes[height * HASH_SIZE:]
+        del self.hashes[height * HASH_SIZE:]
+        self.nonces.pop()
+        self.versions.pop()
+        self.data_ends.pop()
+        del self.data[self.data_ends[-1] if self.data_ends else 0:]
+        self.irregular.pop(height, None)
+        return block
+
+
+    def __getitem__(self, height):
+        """
+        builds the Block at a height, negative heights count from the tip
+        """
+        if height < 0:
+            height += len(self)
+        if not 0 <= height < len(self):
+            raise IndexError("block height out of range")
+        if height in self.irregular:
+            return self.irregular[height]
+        data_start = self.data_ends[height - 1] if height else 0
+        data_end = self.data_ends[height]
+        return block_from_raw(self.versions[height],
+                              bytes(self.ids[height * ID_SIZE:(height + 1) * ID_SIZE]),
+                              self.nonces[height],
+                              bytes(self.prev_hashes[height * HASH_SIZE:(height + 1) * HASH_SIZE]),
+                              bytes(self.data[data_start:data_end]) if data_end > data_start else None,
+                              bytes(self.hashes[height * HASH_SIZE:(height + 1) * HASH_SIZE]))
+
+
+    def hash_at(self, height):
+        """
+        returns the hex hash of the block at a height without building the Block
+        """
+        if height < 0:
+            height += len(self)
+        if height in self.irregular:
+            return self.irregular[height].hash
+        if not 0 <= height < len(self):
+            raise IndexError("block height out of range")
+        return self.hashes[height * HASH_SIZE:(height + 1) * HASH_SIZE].hex()
+
+
+    def find(self, hash):
+        """
+        returns the height of the block with this hex hash, or None if it is not in the chain
+        """
+        for height, block in self.irregular.items():
+            if block.hash == hash:
+                return height
+        raw = compact_hash(hash)
+        if not isinstance(raw, bytes):
+            return None
+        return self.heights.get(raw)
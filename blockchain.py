@@ -0,0 +1,266 @@
+"""
+the local copy of the blockchain held by a peer
+
+a Blockchain can be used like the list of Blocks it replaces (len(), indexing,
+iteration), but every append and pop also updates indexes over the chain, so a
+peer can answer queries without walking the whole chain each time
+
+the blocks are kept in memory in BlockColumns, or in a ChainStore on disk
+when the peer is given a chain directory. either way a Block is only built when
+one is asked for, and a store-backed chain reads it from disk then, so
+reopening it does not build the whole chain (the voter index is read back from
+the voter keys the store keeps). blocks are stored as block records
+(block_codec.py), the same bytes that are sent to other peers
+
+"""
+import json
+import threading
+from block import block_votes, from_dict
+from block_codec import encode_block, decode_block
+from block_columns import BlockColumns
+from tally import VoteTally
+from vote_fields import VOTERS, CANDIDATES, voter_key, block_field, record_field
+from voter_index import VoterIndex
+
+#a store-backed chain saves its vote counts every this many appends
+META_SAVE_INTERVAL = 100
+#blocks read from the store at once when counting votes or indexing voters from the stored bytes
+RECOUNT_BATCH = 4000
+
+
+class Blockchain:
+    def __init__(self, blocks=None, store=None, voter_bloom=None):
+        """
+        Initializes a Blockchain.
+
+        Parameters:
+        - blocks (list of Block): The blocks to start the chain with, in order.
+        - store (ChainStore): Keeps the blocks on disk instead of in memory.
+        - voter_bloom (int): Index the voters behind a bloom filter sized for this many voters instead of a set.
+        """
+        self.columns = BlockColumns() #in-memory chains only
+        self.store = store
+        self.vote_counts = {} #candidate -> number of votes in the chain
+        self.voters = VoterIndex(voter_bloom) #the user_id of every vote in the chain
+        self.tip = None #the last block, so it isn't rebuilt for every new block
+        self.saved_height = 0 #the height the store's meta.json was saved at, every block below it was verified before it was stored
+        self.lock = threading.RLock()
+        if store is not None:
+            self.load_vote_counts()
+            self.load_voters()
+        for block in blocks or []:
+            self.append(block)
+
+
+    def load_vote_counts(self):
+        """
+        restore the vote counts saved in the store, then count the blocks appended after they were saved
+        those are counted from the stored bytes, RECOUNT_BATCH blocks at a time, without building Blocks
+        """
+        meta = self.store.load_meta()
+        saved_height = meta['height'] if meta else 0
+        if saved_height > len(self.store):
+            saved_height = 0 #the chain was cut back below the save
+        if saved_height:
+            self.vote_counts = meta['vote_counts']
+        self.saved_height = saved_height
+        tally = VoteTally()
+        for start in range(saved_height, len(self.store), RECOUNT_BATCH):
+            stored = self.store.read_range(start, start + RECOUNT_BATCH)
+            if self.store.binary:
+                tally.add_records(stored)
+            else:
+                tally.add_blocks([json.loads(raw) for raw in stored])
+        for candidate, votes in tally.counts.items():
+            self.vote_counts[candidate] = self.vote_counts.get(candidate, 0) + votes
+
+
+    def load_voters(self):
+        """
+        restore the voter index from the voter keys kept in the store, then index the blocks whose keys it doesn't have
+        (a store from before it kept them, or an append that was interrupted) from the stored bytes, RECOUNT_BATCH blocks at a time
+        """
+        keys, ends = self.store.read_voters()
+        self.voters.restore(keys, ends, self.store.load_bloom())
+        for start in range(len(ends), len(self.store), RECOUNT_BATCH):
+            for raw in self.store.read_range(start, start + RECOUNT_BATCH):
+                voter_keys = record_field(raw, VOTERS) if self.store.binary else block_field(from_dict(json.loads(raw)), VOTERS)
+                self.voters.append(voter_keys)
+                self.store.append_voters(b''.join(voter_keys))
+
+
+    def count_votes(self, candidates, change):
+        for voted_for in candidates:
+            self.vote_counts[voted_for] = self.vote_counts.get(voted_for, 0) + change
+            if self.vote_counts[voted_for] == 0:
+                del self.vote_counts[voted_for]
+
+
+    def append(self, block):
+        """
+        add a block to the end of the chain, count its votes and index its voters
+        """
+        #read before the block is stored, so a block whose votes can't be read is not left in the chain
+        candidates = block_field(block, CANDIDATES)
+        voter_keys = block_field(block, VOTERS)
+        with self.lock:
+            if self.store is not None:
+                self.store.append(self.store_bytes(block), block.hash)
+                self.store.append_voters(b''.join(voter_keys))
+            else:
+                self.columns.append(block)
+            self.tip = block
+            self.count_votes(candidates, 1)
+            self.voters.append(voter_keys)
+            #saved after this block's votes are counted, so the counts match the height they are saved at
+            if self.store is not None and len(self.store) % META_SAVE_INTERVAL == 0:
+                self.save_vote_counts()
+
+
+    def pop(self):
+        """
+        remove the last block of the chain, uncount its votes and drop its voters from the index
+        """
+        with self.lock:
+            if self.store is not None:
+                block = self[-1]
+                self.store.truncate(len(self.store) - 1)
+            else:
+                block = self.columns.pop()
+            self.tip = None
+            self.count_votes(block_field(block, CANDIDATES), -1)
+            self.voters.pop()
+            #counts saved above the tip would be reloaded on restart for blocks that may have been replaced since
+            if self.store is not None and len(self.store) < self.saved_height:
+                self.save_vote_counts()
+            return block
+
+
+    def tally(self):
+        """
+        returns a copy of the number of votes for each candidate, without walking the chain
+        """
+        with self.lock:
+            return dict(self.vote_counts)
+
+
+    def first_votes(self, votes):
+        """
+        whether each vote is the first from its voter: no block in the chain and no earlier vote in the list has its user_id
+        a vote without a user_id is never a repeat
+        """
+        with self.lock:
+            seen = set()
+            first = []
+            for vote in votes:
+                key = voter_key(vote)
+                first.append(key is None or (key not in seen and key not in self.voters))
+                seen.add(key)
+            return first
+
+
+    def holds_vote(self, vote):
+        """
+        whether this very vote, not only one from the same voter, is in the chain
+        """
+        key = voter_key(vote)
+        with self.lock:
+            height = None if key is None else self.voters.block_of(key)
+            return height is not None and vote in block_votes(self[height].data)
+
+
+    def repeats_voter(self, block):
+        """
+        whether a block has a vote from a voter already in the chain, or two votes from the same voter
+        """
+        keys = block_field(block, VOTERS)
+        with self.lock:
+            return len(set(keys)) < len(keys) or any(key in self.voters for key in keys)
+
+
+    def height_of(self, hash):
+        """
+        returns the height of the block with this hash, or None if it is not in the chain
+        """
+        with self.lock:
+            if self.store is not None:
+                return self.store.find(hash)
+            return self.columns.find(hash)
+
+
+    def hash_at(self, height):
+        """
+        returns the hash of the block at a height without reading the whole block from disk
+        """
+        with self.lock:
+            if self.store is not None:
+                return self.store.hash_at(height)
+            return self.columns.hash_at(height)
+
+
+    def raw_blocks(self, start=0, end=None):
+        """
+        returns the block records of the blocks at heights start to end - 1
+        a store-backed chain returns them straight from the file without building Blocks
+        """
+        with self.lock:
+            if end is None:
+                end = len(self)
+            if self.store is not None and self.store.binary:
+                return self.store.read_range(start, end)
+            return [encode_block(block) for block in self[start:end]]
+
+
+    def store_bytes(self, block):
+        return encode_block(block) if self.store.binary else json.dumps(block.to_dict()).encode('utf-8')
+
+
+    def stored_block(self, raw):
+        return decode_block(raw) if self.store.binary else from_dict(json.loads(raw))
+
+
+    def save_vote_counts(self):
+        self.store.save_meta({"height": len(self.store), "vote_counts": self.vote_counts})
+        self.saved_height = len(self.store)
+
+
+    def close(self):
+        """
+        save the vote counts and close the store, if there is one
+        """
+        with self.lock:
+            if self.store is not None:
+                self.save_vote_counts()
+                if self.voters.bloom is not None:
+                    self.store.save_bloom(self.voters.saved_bloom())
+                self.store.close()
+                self.store = None
+
+
+    def __len__(self):
+        if self.store is not None:
+            return len(self.store)
+        return len(self.columns)
+
+
+    def __getitem__(self, index):
+        with self.lock:
+            if isinstance(index, slice):
+                start, stop, step = index.indices(len(self))
+                if self.store is not None and step == 1:
+                    return [self.stored_block(raw) for raw in self.store.read_range(start, stop)]
+                return [self[height] for height in range(start, stop, step)]
+            is_tip = index in (-1, len(self) - 1)
+            if is_tip and self.tip is not None:
+                return self.tip
+            if self.store is not None:
+                block = self.stored_block(self.store.read(index))
+            else:
+                block = self.columns[index]
+            if is_tip:
+                self.tip = block
+            return block
+
+
+    def __iter__(self):
+        return (self[height] for height in range(len(self)))
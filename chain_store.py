@@ -0,0 +1,255 @@
+"""
+durable append-only storage for a peer's blockchain
+
+a chain directory holds:
+- blocks.log: every block's record (block_codec.py) appended one after another.
+  stores made before block records hold the json of Block.to_dict() instead
+  (their header has JSON_MAGIC), and are still read and appended to as json
+- blocks.idx: a 16-byte header (magic, block count) followed by one fixed-width
+  record per height: (offset in blocks.log, length, raw 32-byte block hash).
+  the index is memory-mapped, so finding a block by height is one array lookup.
+  a dictionary of raw hash -> height, built from the records on open, finds a
+  block by hash without reading the log
+- meta.json: small state that is expensive to rebuild (e.g. the vote counts) and
+  the height it was saved at
+- voters.keys and voters.ends: the 16-byte voter keys (voter_index.py) of every
+  block one after another, and the length of voters.keys after each block. they
+  are appended and truncated with the blocks, so a reopened chain reads its
+  voter index instead of scanning every block's votes for it
+- voters.bloom: the voter index's bloom filter, if it has one, saved when the
+  store is closed and removed when it is read back
+
+reopening a store only maps the index and reads its hashes and voter keys, no block is parsed
+
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+MAGIC = b'BVCHAIN2'
+JSON_MAGIC = b'BVCHAIN1'
+HEADER = struct.Struct('!8sQ') #magic, number of blocks
+RECORD = struct.Struct('!QI32s') #offset, length, block hash
+VOTER_END = struct.Struct('!Q') #length of voters.keys after a block
+INITIAL_CAPACITY = 1024 #records
+
+
+class ChainStore:
+    def __init__(self, path):
+        """
+        Opens (or creates) the chain store in a directory.
+
+        Parameters:
+        - path (str): The directory holding the store's files.
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.log_fd = os.open(os.path.join(path, 'blocks.log'), os.O_RDWR | os.O_CREAT, 0o644)
+        self.index_fd = os.open(os.path.join(path, 'blocks.idx'), os.O_RDWR | os.O_CREAT, 0o644)
+
+        if os.fstat(self.index_fd).st_size < HEADER.size:
+            os.ftruncate(self.index_fd, HEADER.size + INITIAL_CAPACITY * RECORD.size)
+            os.pwrite(self.index_fd, HEADER.pack(MAGIC, 0), 0)
+        self.index = mmap.mmap(self.index_fd, 0)
+        self.magic, self.count = HEADER.unpack_from(self.index, 0)
+        if self.magic not in (MAGIC, JSON_MAGIC):
+            raise ValueError(f"{path} does not contain a chain store")
+        self.binary = self.magic == MAGIC #whether the log holds block records or json
+
+        #anything written to the log after the last indexed block is from an interrupted append
+        self.log_size = self.end_of(self.count - 1) if self.count else 0
+        os.ftruncate(self.log_fd, self.log_size)
+
+        self.heights = {} #raw 32-byte hash -> height of every stored block
+        for height in range(self.count):
+            self.heights.setdefault(self.record(height)[2], height)
+
+        #the voters of the first voter_count blocks are stored, anything after them is from an interrupted append
+        self.voter_keys_fd = os.open(os.path.join(path, 'voters.keys'), os.O_RDWR | os.O_CREAT, 0o644)
+        self.voter_ends_fd = os.open(os.path.join(path, 'voters.ends'), os.O_RDWR | os.O_CREAT, 0o644)
+        self.cut_voters(min(os.fstat(self.voter_ends_fd).st_size // VOTER_END.size, self.count))
+        if os.fstat(self.voter_keys_fd).st_size < self.voters_size:
+            self.cut_voters(0)
+
+
+    def __len__(self):
+        return self.count
+
+
+    def record(self, height):
+        """
+        returns (offset, length, raw hash) of the block at a height, negative heights count from the tip
+        """
+        if height < 0:
+            height += self.count
+        if not 0 <= height < self.count:
+            raise IndexError("block height out of range")
+        return RECORD.unpack_from(self.index, HEADER.size + height * RECORD.size)
+
+
+    def end_of(self, height):
+        offset, length, _ = self.record(height)
+        return offset + length
+
+
+    def read(self, height):
+        """
+        returns the stored bytes of the block at a height
+        """
+        offset, length, _ = self.record(height)
+        return os.pread(self.log_fd, length, offset)
+
+
+    def read_range(self, start, end):
+        """
+        returns the stored bytes of the blocks at heights start to end - 1 with one read from the log
+        """
+        end = min(end, self.count)
+        if start >= end:
+            return []
+        first_offset = self.record(start)[0]
+        data = os.pread(self.log_fd, self.end_of(end - 1) - first_offset, first_offset)
+        blocks = []
+        for height in range(start, end):
+            offset, length, _ = self.record(height)
+            blocks.append(data[offset - first_offset:offset - first_offset + length])
+        return blocks
+
+
+    def hash_at(self, height):
+        """
+        returns the hex hash of the block at a height, straight from the index
+        """
+        return self.record(height)[2].hex()
+
+
+    def find(self, hash):
+        """
+        returns the height of the block with this hex hash, or None if it is not in the store
+        """
+        try:
+            digest = bytes.fromhex(hash)
+        except (TypeError, ValueError):
+            return None
+        return self.heights.get(digest)
+
+
+    def append(self, block_bytes, hash):
+        """
+        append a block's record (or json, in an old store) with its hex hash
+        the block is written to the log before the index counts it, so an interrupted append is dropped on reopen
+        """
+        os.pwrite(self.log_fd, block_bytes, self.log_size)
+        record_offset = HEADER.size + self.count * RECORD.size
+        if record_offset + RECORD.size > len(self.index):
+            self.index.resize(HEADER.size + 2 * (len(self.index) - HEADER.size))
+        digest = bytes.fromhex(hash)
+        RECORD.pack_into(self.index, record_offset, self.log_size, len(block_bytes), digest)
+        self.heights.setdefault(digest, self.count)
+        self.log_size += len(block_bytes)
+        self.count += 1
+        HEADER.pack_into(self.index, 0, self.magic, self.count)
+
+
+    def truncate(self, height):
+        """
+        drop every block at or above a height
+        """
+        if height >= self.count:
+            return
+        for dropped in range(height, self.count):
+            digest = self.record(dropped)[2]
+            if self.heights.get(digest) == dropped:
+                del self.heights[digest]
+        self.count = height
+        HEADER.pack_into(self.index, 0, self.magic, self.count)
+        self.log_size = self.end_of(height - 1) if height else 0
+        os.ftruncate(self.log_fd, self.log_size)
+        if self.voter_count > height:
+            self.cut_voters(height)
+
+
+    def append_voters(self, keys):
+        """
+        append the voter keys of the block at height voter_count, as one bytes of 16-byte keys
+        the keys are written before their end, so an interrupted append is dropped on reopen
+        """
+        os.pwrite(self.voter_keys_fd, keys, self.voters_size)
+        self.voters_size += len(keys)
+        os.pwrite(self.voter_ends_fd, VOTER_END.pack(self.voters_size), self.voter_count * VOTER_END.size)
+        self.voter_count += 1
+
+
+    def read_voters(self):
+        """
+        returns (keys, ends) of the stored voters: every key in one bytes, and an array of the length of keys after each block
+        """
+        ends = array('Q', os.pread(self.voter_ends_fd, self.voter_count * VOTER_END.size, 0))
+        if sys.byteorder == 'little':
+            ends.byteswap()
+        return os.pread(self.voter_keys_fd, self.voters_size, 0), ends
+
+
+    def cut_voters(self, count):
+        """
+        keep only the stored voters of the first count blocks
+        """
+        self.voter_count = count
+        self.voters_size = VOTER_END.unpack(os.pread(self.voter_ends_fd, VOTER_END.size, (count - 1) * VOTER_END.size))[0] if count else 0
+        os.ftruncate(self.voter_ends_fd, count * VOTER_END.size)
+        os.ftruncate(self.voter_keys_fd, self.voters_size)
+
+
+    def load_meta(self):
+        try:
+            with open(os.path.join(self.path, 'meta.json')) as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+
+
+    def save_meta(self, meta):
+        meta_path = os.path.join(self.path, 'meta.json')
+        with open(meta_path + '.tmp', 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(meta_path + '.tmp', meta_path)
+
+
+    def load_bloom(self):
+        """
+        returns the bloom filter saved by save_bloom() and removes it, it is stale once the chain changes
+        returns None if there isn't one
+        """
+        bloom_path = os.path.join(self.path, 'voters.bloom')
+        try:
+            with open(bloom_path, 'rb') as bloom_file:
+                saved = bloom_file.read()
+            os.remove(bloom_path)
+            return saved
+        except OSError:
+            return None
+
+
+    def save_bloom(self, saved):
+        bloom_path = os.path.join(self.path, 'voters.bloom')
+        with open(bloom_path + '.tmp', 'wb') as bloom_file:
+            bloom_file.write(saved)
+        os.replace(bloom_path + '.tmp', bloom_path)
+
+
+    def close(self):
+        """
+        flush everything to disk and close the files
+        """
+        self.index.flush()
+        os.fsync(self.log_fd)
+        os.fsync(self.voter_keys_fd)
+        os.fsync(self.voter_ends_fd)
+        self.index.close()
+        os.close(self.index_fd)
+        os.close(self.log_fd)
+        os.close(self.voter_keys_fd)
+        os.close(self.voter_ends_fd)
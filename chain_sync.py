@@ -0,0 +1,248 @@
+"""
+incremental chain sync between peers
+
+a peer that joins, or that finds out it is behind, sends REQ_SYNC to a few
+peers with a block locator: the (height, hash) of its tip, then of blocks
+further and further back down to the genesis block. each peer answers with
+the height of the last block both chains share:
+- if the requester's tip is that block and the gap is small, the reply is just
+  the missing suffix (RECV_BLOCKS)
+- otherwise the reply is SYNC_INFO with the common height (the divergence
+  point when it is below the requester's tip) and the responder's height
+
+when the chains diverged below our tip, nothing is rolled back on the peer's
+word. the blocks of its branch above the common block are fetched and verified
+first, without touching our chain, and once all of them are in the peer
+reorganizes onto the branch (Peer.reorganize) if it is still longer than our
+chain, the same way it switches to a longer side branch of its fork pool
+
+for a large gap the requester splits the missing heights into ranges of
+SYNC_BATCH_SIZE and asks the peers it synced with for them in parallel
+(REQ_BLOCKS), then appends the ranges in order as they arrive, once a ChainVerifier
+has checked every block in them. only SYNC_WINDOW ranges are requested ahead of
+the tip at a time, and the next one is requested as each is appended, so a long
+download holds at most SYNC_WINDOW ranges in memory and verifies them while the
+rest are still arriving
+
+"""
+import json
+import time
+from protocol import *
+from block import GENESIS_PREV_HASH
+from block_codec import encode_message
+
+#most blocks sent in one RECV_BLOCKS message
+SYNC_BATCH_SIZE = 500
+#how many peers are asked at once
+SYNC_PEERS = 3
+#most ranges requested and not yet appended at once
+SYNC_WINDOW = 2 * SYNC_PEERS
+#a sync that has not finished after this many seconds can be started over
+SYNC_TIMEOUT = 10
+
+
+def block_locator(blockchain):
+    """
+    (height, hash) pairs of the tip, the 10 blocks below it, then every 2nd, 4th, 8th, ... block down to the genesis block
+    """
+    locator = []
+    height = len(blockchain) - 1
+    step = 1
+    while height > 0:
+        locator.append([height, blockchain.hash_at(height)])
+        if len(locator) >= 10:
+            step *= 2
+        height -= step
+    if len(blockchain) > 0:
+        locator.append([0, blockchain.hash_at(0)])
+    return locator
+
+
+class ChainSync:
+    def __init__(self, peer):
+        """
+        Initializes a ChainSync.
+
+        Parameters:
+        - peer (Peer): The peer whose blockchain is synced, used to send messages to other peers.
+        """
+        self.peer = peer
+        self.started = None #when the current sync started, None if there isn't one
+        self.sync_peers = []
+        self.source_peer = None #the peer whose height we are catching up to
+        self.target_height = None
+        self.range_peers = [] #the peers ranges are requested from, in turn
+        self.next_range = None #start height of the next range to request
+        self.ranges_requested = 0
+        self.requested_ranges = {} #start height -> end height of each REQ_BLOCKS sent and not yet appended
+        self.pending_ranges = {} #start height -> (sender, list of Blocks) received out of order
+        self.fork_height = None #the common block of a chain that diverged from ours, None if the blocks go on our tip
+        self.branch = [] #the verified blocks of that chain after fork_height, fetched before we switch to it
+
+
+    def is_syncing(self):
+        return self.started is not None and time.monotonic() - self.started < SYNC_TIMEOUT
+
+
+    def start(self, peers):
+        """
+        ask up to SYNC_PEERS peers which blocks we are missing
+        """
+        if self.is_syncing() or not peers:
+            return
+        self.started = time.monotonic()
+        self.sync_peers = list(peers[:SYNC_PEERS])
+        self.target_height = None
+        self.next_range = None
+        self.requested_ranges = {}
+        self.pending_ranges = {}
+        self.fork_height = None
+        self.branch = []
+        message = json.dumps([REQ_SYNC, block_locator(self.peer.blockchain)])
+        for peer_address in self.sync_peers:
+            print(f"sending data to peer {peer_address}: requesting blocks after our tip")
+            self.peer.send_data(peer_address, message)
+
+
+    def finish(self):
+        print(f"chain sync finished at height {len(self.peer.blockchain) - 1}")
+        self.started = None
+        self.target_height = None
+        self.next_range = None
+        self.requested_ranges = {}
+        self.pending_ranges = {}
+        self.fork_height = None
+        self.branch = []
+
+
+    def next_height(self):
+        """
+        the height the next received block goes at: after our tip, or after the diverged branch fetched so far
+        """
+        if self.fork_height is None:
+            return len(self.peer.blockchain)
+        return self.fork_height + 1 + len(self.branch)
+
+
+    def tip_hash(self):
+        """
+        the hash the next received block has to build on
+        """
+        if self.branch:
+            return self.branch[-1].hash
+        height = self.next_height() - 1
+        return self.peer.blockchain.hash_at(height) if height >= 0 else GENESIS_PREV_HASH
+
+
+    def common_height(self, locator):
+        """
+        the height of the highest block in the locator that is also in our chain, -1 if there is none
+        """
+        blockchain = self.peer.blockchain
+        for height, hash in locator:
+            if height < len(blockchain) and blockchain.hash_at(height) == hash:
+                return height
+        return -1
+
+
+    def handle_req_sync(self, peer_address, locator):
+        """
+        answer a REQ_SYNC with the missing suffix if it is small, otherwise with SYNC_INFO
+        """
+        blockchain = self.peer.blockchain
+        common = self.common_height(locator)
+        requester_tip = locator[0][0] if locator else -1
+        my_height = len(blockchain) - 1
+        if common == requester_tip and my_height - common <= SYNC_BATCH_SIZE:
+            self.send_blocks(peer_address, common + 1, my_height + 1)
+        else:
+            print(f"sending data to peer {peer_address}: chains share heights up to {common}, ours is {my_height}")
+            self.peer.send_data(peer_address, json.dumps([SYNC_INFO, common, my_height]))
+
+
+    def send_blocks(self, peer_address, start, end):
+        """
+        send the blocks at heights start to end - 1 (whatever part of it we have)
+        """
+        blocks = self.peer.blockchain.raw_blocks(start, end)
+        print(f"sending data to peer {peer_address}: {len(blocks)} blocks from height {start}")
+        self.peer.send_data(peer_address, encode_message([RECV_BLOCKS, start, blocks]))
+
+
+    def handle_sync_info(self, peer_address, common, their_height):
+        """
+        a peer has more blocks than it could send at once, or our chains diverged
+        if their chain is longer, start fetching the missing ranges in parallel. a diverged chain's blocks are
+        fetched into self.branch, our chain is only changed once all of them are in and verified
+        """
+        blockchain = self.peer.blockchain
+        my_height = len(blockchain) - 1
+        if not self.is_syncing() or self.target_height is not None or their_height <= my_height:
+            return
+
+        if common < my_height:
+            print(f"chain diverged from peer {peer_address} after height {common}, fetching its {their_height - common} blocks before switching")
+            self.fork_height = common
+            self.branch = []
+
+        self.target_height = their_height
+        self.source_peer = peer_address
+        #the peer that told us the height goes first, it is known to have every range
+        self.range_peers = [peer_address] + [p for p in self.sync_peers if p != peer_address]
+        self.next_range = common + 1
+        self.ranges_requested = 0
+        self.request_ranges()
+
+
+    def request_ranges(self):
+        """
+        request the next ranges, round-robin from the range peers, until SYNC_WINDOW are requested and not yet appended
+        """
+        while self.next_range <= self.target_height and len(self.requested_ranges) < SYNC_WINDOW:
+            start = self.next_range
+            end = min(start + SYNC_BATCH_SIZE, self.target_height + 1)
+            self.request_range(self.range_peers[self.ranges_requested % len(self.range_peers)], start, end)
+            self.ranges_requested += 1
+            self.next_range = end
+
+
+    def request_range(self, peer_address, start, end):
+        print(f"sending data to peer {peer_address}: requesting blocks {start} to {end - 1}")
+        self.requested_ranges[start] = end
+        self.peer.send_data(peer_address, json.dumps([REQ_BLOCKS, start, end]))
+
+
+    def handle_recv_blocks(self, peer_address, start, blocks):
+        """
+        store a received range and append every range that now follows our tip (or the diverged branch being fetched)
+        """
+        blockchain = self.peer.blockchain
+        if start < self.next_height():
+            return #already have these
+        self.pending_ranges[start] = (peer_address, blocks)
+
+        while self.next_height() in self.pending_ranges:
+            next_height = self.next_height()
+            sender, blocks = self.pending_ranges.pop(next_height)
+            end = self.requested_ranges.pop(next_height, next_height + len(blocks))
+            if len(blocks) < end - next_height and sender != self.source_peer:
+                #that peer did not have all of the range, ask the peer we got the height from for the rest
+                self.request_range(self.source_peer, next_height + len(blocks), end)
+            valid = self.peer.chain_verifier.verify(blocks, next_height, self.tip_hash())
+            if self.fork_height is None:
+                for block in blocks[:valid]:
+                    blockchain.append(block)
+            else:
+                self.branch.extend(blocks[:valid])
+            if valid < len(blocks):
+                print(f"block {next_height + valid} from peer {sender} fails verification, stopping the sync")
+                self.finish() #a diverged branch is dropped, our chain was never changed for it
+                return
+        if self.next_range is not None:
+            self.request_ranges()
+
+        if self.target_height is None or self.next_height() > self.target_height:
+            if self.fork_height is not None and self.branch:
+                self.peer.reorganize(self.fork_height, self.branch, verified=True)
+            if self.started is not None:
+                self.finish()
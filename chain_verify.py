@@ -0,0 +1,143 @@
+"""
+verifies blocks from other peers before they are added to the chain
+
+every block's hash is recomputed, it must meet DIFFICULTY, its prev_hash
+must be the hash of the block before it, and its data must decode to votes that
+can be counted. long runs of blocks (a whole chain from RECV_CHAIN, or a large
+sync) are split into chunks that are hashed in parallel on a pool of worker
+processes. a chunk can be checked on its own because the hash of the block
+before it is in the message, and that hash is checked by the chunk it belongs to
+
+a trusted checkpoint is a (height, hash) pair given with --checkpoints. blocks
+from the network that contradict a checkpoint are rejected, and every other
+block from the network is hashed again, a matching hash at a checkpoint height
+says nothing about the data of the blocks below it
+
+a chain store is only verified above the height its meta.json was saved at
+when it is reopened. every block this peer stores was verified (or made by it)
+before it was stored, so the blocks below the saved height are trusted, and so
+are the blocks up to the highest checkpoint the store matches. only the blocks
+appended after the last save are hashed again
+
+"""
+import json
+from concurrent.futures import ProcessPoolExecutor
+from block import DIFFICULTY, GENESIS_PREV_HASH, countable_votes
+from miner import init_worker
+
+#blocks hashed by one worker task
+CHUNK_SIZE = 2000
+
+
+def verify_chunk(blocks, prev_hash):
+    """
+    recomputes every block's hash and checks its proof of work, its link to the block before it, and its data
+    returns the index of the first bad block, or None if every block is good
+    """
+    prefix = '0' * DIFFICULTY
+    for i, block in enumerate(blocks):
+        try:
+            hash = block.hash
+            if block.prev_hash != prev_hash or not hash.startswith(prefix) or block.calculate_hash() != hash:
+                return i
+            if not countable_votes(block.data): #the votes are counted when the block is appended
+                return i
+        except (TypeError, ValueError, AttributeError):
+            return i
+        prev_hash = hash
+    return None
+
+
+def load_checkpoints(path):
+    """
+    reads trusted checkpoints from a json file of {"height": "hash", ...}
+    """
+    with open(path) as checkpoint_file:
+        return {int(height): hash for height, hash in json.load(checkpoint_file).items()}
+
+
+class ChainVerifier:
+    def __init__(self, workers=1, checkpoints=None):
+        """
+        Initializes a ChainVerifier.
+
+        Parameters:
+        - workers (int): The number of processes used to hash long runs of blocks.
+        - checkpoints (dict of int to str): Trusted block hashes by height.
+        """
+        self.workers = workers
+        self.checkpoints = checkpoints or {}
+        self.executor = None
+
+
+    def verify(self, blocks, start_height, prev_hash):
+        """
+        checks Blocks that are to be appended at start_height, after the block with hash prev_hash
+        returns how many of them, from the first, are valid
+        every block is hashed again, a checkpoint can only reject the blocks from the one that contradicts it
+        """
+        valid_end = len(blocks)
+        for height, hash in self.checkpoints.items():
+            index = height - start_height
+            if 0 <= index < len(blocks) and blocks[index].hash != hash:
+                print(f"block at height {height} does not match the trusted checkpoint")
+                valid_end = min(valid_end, index)
+
+        bad = self.verify_blocks(blocks[:valid_end], prev_hash)
+        if bad is not None:
+            return bad
+        return valid_end
+
+
+    def verify_stored(self, blockchain):
+        """
+        checks the blocks of a chain reopened from a chain store, which this peer verified when it stored them
+        the blocks below the store's saved height, or up to the highest checkpoint the chain matches, are not checked again
+        returns how many of the stored blocks, from the first, are valid
+        """
+        height = len(blockchain)
+        trusted_end = min(blockchain.saved_height, height)
+        valid_end = height
+        for checkpoint, hash in self.checkpoints.items():
+            if checkpoint < height:
+                if blockchain.hash_at(checkpoint) == hash:
+                    trusted_end = max(trusted_end, checkpoint + 1)
+                else:
+                    print(f"stored block at height {checkpoint} does not match the trusted checkpoint")
+                    valid_end = min(valid_end, checkpoint)
+        trusted_end = min(trusted_end, valid_end)
+
+        prev_hash = blockchain.hash_at(trusted_end - 1) if trusted_end else GENESIS_PREV_HASH
+        batch = CHUNK_SIZE * max(1, self.workers)
+        for start in range(trusted_end, valid_end, batch):
+            blocks = blockchain[start:min(start + batch, valid_end)]
+            bad = self.verify_blocks(blocks, prev_hash)
+            if bad is not None:
+                return start + bad
+            prev_hash = blocks[-1].hash
+        return valid_end
+
+
+    def verify_blocks(self, blocks, prev_hash):
+        """
+        verify_chunk() over all of the blocks, split into chunks across the worker processes if there are enough
+        """
+        if self.workers <= 1 or len(blocks) < 2 * CHUNK_SIZE:
+            return verify_chunk(blocks, prev_hash)
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker)
+        starts = range(0, len(blocks), CHUNK_SIZE)
+        chunks = [blocks[start:start + CHUNK_SIZE] for start in starts]
+        #the block before each chunk is checked by the chunk before it
+        prev_hashes = [prev_hash] + [blocks[start - 1].hash for start in starts[1:]]
+        for start, bad in zip(starts, self.executor.map(verify_chunk, chunks, prev_hashes)):
+            if bad is not None:
+                return start + bad
+        return None
+
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
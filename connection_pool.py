@@ -0,0 +1,115 @@
+"""
+pool of long-lived connections from this peer to other peers
+
+instead of connecting, sending one message, and closing for every message, a
+peer keeps one connection open to each remote peer and sends every message
+type to it over that connection, one framed message after another. broken
+connections are reopened on the next send and idle ones are closed. every
+connection starts with a PEER_HELLO that tells the other peer our address
+
+"""
+import json
+import select
+import socket
+import threading
+import time
+from protocol import PEER_HELLO, parse_address, send_wrapper
+
+
+class PooledConnection:
+    def __init__(self):
+        self.socket = None
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock() #one message at a time on the socket
+
+
+class ConnectionPool:
+    def __init__(self, my_address, idle_timeout=60):
+        """
+        Initializes a ConnectionPool.
+
+        Parameters:
+        - my_address (str): The "host:port" address other peers know us by, sent when a connection opens.
+        - idle_timeout (float): Seconds a connection can go unused before it is closed.
+        """
+        self.hello = json.dumps([PEER_HELLO, my_address])
+        self.idle_timeout = idle_timeout
+        self.connections = {} #peer_address -> PooledConnection
+        self.lock = threading.Lock()
+
+
+    def start(self):
+        """
+        start the thread that closes idle connections
+        """
+        reaper_thread = threading.Thread(target=self.close_idle_connections)
+        reaper_thread.daemon = True
+        reaper_thread.start()
+
+
+    def send(self, peer_address, data):
+        """
+        send a message to a peer over its pooled connection, connecting if there isn't one yet
+        a connection found broken is reopened and the message is sent again once
+        """
+        with self.lock:
+            connection = self.connections.setdefault(peer_address, PooledConnection())
+
+        with connection.lock:
+            for attempt in range(2):
+                if connection.socket is not None and self.is_closed_by_peer(connection.socket):
+                    self.close_connection(connection)
+                try:
+                    if connection.socket is None:
+                        connection.socket = socket.create_connection(parse_address(peer_address))
+                        connection.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                        send_wrapper(connection.socket, self.hello)
+                    send_wrapper(connection.socket, data)
+                    connection.last_used = time.monotonic()
+                    return
+                except OSError:
+                    self.close_connection(connection)
+                    if attempt == 1:
+                        raise
+
+
+    def is_closed_by_peer(self, peer_socket):
+        """
+        pooled connections only carry messages out, so if the socket is readable the other side has closed it
+        """
+        readable, _, _ = select.select([peer_socket], [], [], 0)
+        return bool(readable)
+
+
+    def close_connection(self, connection):
+        if connection.socket is not None:
+            connection.socket.close()
+            connection.socket = None
+
+
+    def close_idle_connections(self):
+        """
+        periodically close connections that have not been used for idle_timeout seconds
+        """
+        while True:
+            time.sleep(self.idle_timeout / 2)
+            now = time.monotonic()
+            with self.lock:
+                connections = list(self.connections.items())
+            for peer_address, connection in connections:
+                with connection.lock:
+                    if connection.socket is not None and now - connection.last_used > self.idle_timeout:
+                        print(f"closing idle connection to peer {peer_address}")
+                        self.close_connection(connection)
+
+
+    def close(self):
+        """
+        close every pooled connection
+        """
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections = {}
+        for connection in connections:
+            with connection.lock:
+                self.close_connection(connection)
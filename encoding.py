@@ -0,0 +1,243 @@
+"""
+canonical binary encoding of block data and vote payloads
+
+every value has exactly one encoding, so the encoding can be hashed: a one-byte
+tag, then the value's fields in a fixed order, with a length before anything
+whose size varies. dict keys are sorted by their utf-8 bytes, so two equal
+dicts encode the same no matter what order their keys were added in
+
+a vote from the app (a dict of exactly user_id, vote, name and timestamp, with a
+uuid user_id and a float timestamp) has its own tag, and is written as the
+uuid's 16 raw bytes, the vote and name strings, and the timestamp, without the
+key names
+
+tags:
+- N: None, T: True, F: False
+- i: int as 8 signed bytes, I: a larger int as a 4-byte length and its decimal digits
+- d: float as 8 bytes (ieee 754)
+- s: string of up to 255 utf-8 bytes with a 1-byte length, S: longer string with a 4-byte length
+- L: list, a 4-byte count and then the items
+- M: dict, a 4-byte count and then key, value, key, value, ... with every key a string
+- V: vote, 16 bytes of user_id, then the vote and name strings, then the timestamp as a float
+
+"""
+import struct
+import uuid
+
+INT = struct.Struct('!q')
+FLOAT = struct.Struct('!d')
+LENGTH = struct.Struct('!I')
+MIN_INT = -2**63
+MAX_INT = 2**63 - 1
+
+#the keys of a vote, in the order a decoded vote has them (the order of the app's Vote)
+VOTE_KEYS = ('user_id', 'vote', 'name', 'timestamp')
+#how the encoding of a block's {"votes": [...]} starts, up to the count of the list
+VOTES_PREFIX = b'M' + LENGTH.pack(1) + b's\x05votes' + b'L'
+
+
+def uuid_bytes(text):
+    """
+    the 16 raw bytes of a uuid string in its usual lowercase form, or None if it isn't one
+    """
+    if len(text) != 36:
+        return None
+    try:
+        raw = uuid.UUID(text)
+    except ValueError:
+        return None
+    return raw.bytes if str(raw) == text else None
+
+
+def uuid_string(raw):
+    h = raw.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+def encode_value(value):
+    """
+    the canonical encoding of a value made of None, bools, ints, floats, strings, lists, and dicts with string keys
+    raises TypeError for anything else
+    """
+    out = bytearray()
+    write_value(out, value)
+    return bytes(out)
+
+
+def write_value(out, value):
+    if value is None:
+        out += b'N'
+    elif value is True:
+        out += b'T'
+    elif value is False:
+        out += b'F'
+    elif isinstance(value, str):
+        write_string(out, value)
+    elif isinstance(value, float):
+        out += b'd'
+        out += FLOAT.pack(value)
+    elif isinstance(value, int):
+        if MIN_INT <= value <= MAX_INT:
+            out += b'i'
+            out += INT.pack(value)
+        else:
+            digits = str(int(value)).encode()
+            out += b'I'
+            out += LENGTH.pack(len(digits))
+            out += digits
+    elif isinstance(value, list):
+        out += b'L'
+        out += LENGTH.pack(len(value))
+        for item in value:
+            write_value(out, item)
+    elif isinstance(value, dict):
+        if not write_vote(out, value):
+            if not all(isinstance(key, str) for key in value):
+                raise TypeError("only dicts with string keys can be encoded")
+            out += b'M'
+            out += LENGTH.pack(len(value))
+            for key, item in sorted(value.items(), key=lambda entry: entry[0].encode('utf-8')):
+                write_string(out, key)
+                write_value(out, item)
+    else:
+        raise TypeError(f"cannot encode a value of type {type(value).__name__}")
+
+
+def write_string(out, text):
+    encoded = text.encode('utf-8')
+    if len(encoded) < 256:
+        out += b's'
+        out.append(len(encoded))
+    else:
+        out += b'S'
+        out += LENGTH.pack(len(encoded))
+    out += encoded
+
+
+def write_vote(out, value):
+    """
+    writes a dict with the V tag if it is a vote from the app, returns whether it was one
+    """
+    if len(value) != len(VOTE_KEYS) or not all(key in value for key in VOTE_KEYS):
+        return False
+    user_id, vote, name, timestamp = (value[key] for key in VOTE_KEYS)
+    if not (isinstance(user_id, str) and isinstance(vote, str) and isinstance(name, str) and type(timestamp) is float):
+        return False
+    raw_id = uuid_bytes(user_id)
+    if raw_id is None:
+        return False
+    out += b'V'
+    out += raw_id
+    write_string(out, vote)
+    write_string(out, name)
+    out += FLOAT.pack(timestamp)
+    return True
+
+
+def decode_value(data):
+    """
+    the value from encode_value()
+    raises ValueError if the data is not exactly one encoded value
+    """
+    try:
+        value, end = read_value(data, 0)
+    except (IndexError, struct.error):
+        raise ValueError("truncated encoded value")
+    if end != len(data):
+        raise ValueError("extra bytes after the encoded value")
+    return value
+
+
+def read_value(data, position):
+    """
+    reads the value that starts at position, returns (value, position after it)
+    """
+    tag = data[position]
+    position += 1
+    if tag == 0x73: #s
+        return read_string(data, position + 1, data[position])
+    if tag == 0x56: #V
+        if position + 16 > len(data):
+            raise ValueError("truncated vote")
+        user_id = uuid_string(bytes(data[position:position + 16]))
+        vote, position = read_value(data, position + 16)
+        name, position = read_value(data, position)
+        if not (isinstance(vote, str) and isinstance(name, str)):
+            raise ValueError("a vote's vote and name must be strings")
+        (timestamp,) = FLOAT.unpack_from(data, position)
+        return {'user_id': user_id, 'vote': vote, 'name': name, 'timestamp': timestamp}, position + 8
+    if tag == 0x4E: #N
+        return None, position
+    if tag == 0x54: #T
+        return True, position
+    if tag == 0x46: #F
+        return False, position
+    if tag == 0x69: #i
+        return INT.unpack_from(data, position)[0], position + 8
+    if tag == 0x64: #d
+        return FLOAT.unpack_from(data, position)[0], position + 8
+    if tag == 0x53: #S
+        return read_string(data, position + 4, LENGTH.unpack_from(data, position)[0])
+    if tag == 0x49: #I
+        digits, position = read_string(data, position + 4, LENGTH.unpack_from(data, position)[0])
+        return int(digits), position
+    if tag == 0x4C: #L
+        (count,) = LENGTH.unpack_from(data, position)
+        position += 4
+        items = []
+        for _ in range(count):
+            item, position = read_value(data, position)
+            items.append(item)
+        return items, position
+    if tag == 0x4D: #M
+        (count,) = LENGTH.unpack_from(data, position)
+        position += 4
+        entries = {}
+        for _ in range(count):
+            key, position = read_value(data, position)
+            if not isinstance(key, str):
+                raise ValueError("dict keys must be strings")
+            entries[key], position = read_value(data, position)
+        return entries, position
+    raise ValueError(f"unknown tag {tag} in encoded value")
+
+
+def scan_votes(data):
+    """
+    the user_id and vote of every vote in the encoding of a block's {"votes": [...]}, read without decoding the rest of each vote
+    returns (list of 16-byte raw user_ids, list of votes), or None if the data isn't a list of V-tagged votes with
+    short vote strings, it has to be decoded then
+    """
+    if data[:len(VOTES_PREFIX)] != VOTES_PREFIX:
+        return None
+    try:
+        (count,) = LENGTH.unpack_from(data, len(VOTES_PREFIX))
+        position = len(VOTES_PREFIX) + 4
+        user_ids = []
+        candidates = []
+        for _ in range(count):
+            #V, the 16 bytes of the user_id, then the vote with the s tag
+            if data[position] != 0x56 or data[position + 17] != 0x73:
+                return None
+            user_ids.append(bytes(data[position + 1:position + 17]))
+            start = position + 19
+            end = start + data[position + 18]
+            candidates.append(str(data[start:end], 'utf-8'))
+            #then the name, with either string tag, and the timestamp
+            if data[end] == 0x73:
+                position = end + 2 + data[end + 1]
+            elif data[end] == 0x53:
+                position = end + 5 + LENGTH.unpack_from(data, end + 1)[0]
+            else:
+                return None
+            position += 8
+    except (IndexError, struct.error):
+        return None
+    return (user_ids, candidates) if position == len(data) else None
+
+
+def read_string(data, start, length):
+    end = start + length
+    if end > len(data):
+        raise ValueError("truncated string")
+    return bytes(data[start:end]).decode('utf-8'), end
@@ -0,0 +1,129 @@
+"""
+the blocks a peer holds that are not in its chain: side branches and orphans
+
+when two peers create a block on the same tip at once, every other peer gets
+both, and only one of them can go on its chain. the other one is kept here,
+indexed by its prev_hash, instead of being rejected, along with blocks that
+build on it. when a branch here becomes longer than the chain it forks from (the
+heaviest chain, since every block is mined at the same DIFFICULTY), the peer
+reorganizes onto it (see Peer.reorganize) and the blocks it drops from its chain
+are kept here in turn
+
+a block whose parent is neither in the chain nor here is an orphan. it waits
+here until its parent arrives (e.g. by a chain sync), and then joins the branch
+of its parent
+
+the pool keeps at most max_blocks blocks, the oldest are dropped first
+
+"""
+from collections import OrderedDict
+
+#blocks kept in a ForkPool
+MAX_SIDE_BLOCKS = 1024
+
+
+class ForkPool:
+    def __init__(self, max_blocks=MAX_SIDE_BLOCKS):
+        """
+        Initializes a ForkPool.
+
+        Parameters:
+        - max_blocks (int): The most blocks kept, the oldest are dropped first.
+        """
+        self.max_blocks = max_blocks
+        self.blocks = OrderedDict() #hash -> Block, in the order they were added
+        self.children = {} #prev_hash -> hashes of the blocks here that build on it
+        self.ids = {} #id -> hash
+
+
+    def add(self, block):
+        if block.hash in self.blocks:
+            return
+        self.blocks[block.hash] = block
+        self.children.setdefault(block.prev_hash, []).append(block.hash)
+        self.ids[block.id] = block.hash
+        while len(self.blocks) > self.max_blocks:
+            self.discard(next(iter(self.blocks)))
+
+
+    def discard(self, hash):
+        """
+        drop one block, the blocks that build on it stay (as orphans if nothing else links them)
+        """
+        block = self.blocks.pop(hash, None)
+        if block is None:
+            return None
+        siblings = self.children[block.prev_hash]
+        siblings.remove(hash)
+        if not siblings:
+            del self.children[block.prev_hash]
+        del self.ids[block.id]
+        return block
+
+
+    def remove_branch(self, hash):
+        """
+        drop a block and every block here that builds on it, e.g. a rejected block, returns them
+        """
+        removed = []
+        pending = [hash]
+        while pending:
+            hash = pending.pop()
+            pending.extend(self.children.get(hash, []))
+            block = self.discard(hash)
+            if block is not None:
+                removed.append(block)
+        return removed
+
+
+    def hash_of(self, id):
+        return self.ids.get(id)
+
+
+    def roots(self):
+        """
+        the first block of every branch here, the ones whose parent is not here
+        """
+        return [block for block in self.blocks.values() if block.prev_hash not in self.blocks]
+
+
+    def root_of(self, block):
+        """
+        the blocks here from the first one of block's branch down to block itself, in chain order
+        the first block's parent is in the chain, or unknown if the branch is orphaned
+        """
+        branch = [block]
+        while branch[-1].prev_hash in self.blocks:
+            branch.append(self.blocks[branch[-1].prev_hash])
+        branch.reverse()
+        return branch
+
+
+    def longest_after(self, hash):
+        """
+        the longest run of blocks here that builds on hash, in chain order (the first one added wins a tie)
+        """
+        best = []
+        pending = [(hash, [])]
+        while pending:
+            hash, run = pending.pop()
+            if len(run) > len(best):
+                best = run
+            for child in reversed(self.children.get(hash, [])):
+                pending.append((child, run + [self.blocks[child]]))
+        return best
+
+
+    def branch_through(self, block):
+        """
+        the longest branch here that holds block, from the first block of the branch to its tip
+        """
+        return self.root_of(block) + self.longest_after(block.hash)
+
+
+    def __contains__(self, hash):
+        return hash in self.blocks
+
+
+    def __len__(self):
+        return len(self.blocks)
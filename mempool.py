@@ -0,0 +1,178 @@
+"""
+pool of pending votes waiting to be sealed into a block
+
+votes from CAST_VOTE messages are queued here instead of each one being mined
+and broadcast on its own. a background thread seals the queued votes into one
+block as soon as max_votes are waiting, or the oldest vote has waited max_wait
+seconds, and then reports the result of that block to every waiting voter (a
+vote that was left out of the block, e.g. a second vote from the same voter,
+is reported as rejected)
+
+each client (an app connection) has its own queue, and a block is filled by
+taking one vote from each client in turn, starting after the last client the
+block before it took from. so a terminal that sends votes in bulk can't delay
+the votes of the others by more than its share of each block
+
+a vote whose block lost a race with another peer's block (it was rejected, or
+went on a side branch, see fork_pool.py) is not reported. it goes back to the
+front of its client's queue for the next block, up to max_attempts blocks
+
+"""
+import threading
+import time
+from collections import OrderedDict, deque
+from metrics import Metrics, BLOCK_SECONDS, MEMPOOL_WAIT_SECONDS, VOTE_SECONDS, VOTES_RETRIED
+
+
+class Mempool:
+    def __init__(self, seal_votes, max_votes=32, max_wait=0.25, max_attempts=10, metrics=None):
+        """
+        Initializes a Mempool.
+
+        Parameters:
+        - seal_votes (function): Called with (votes, attack) to create a block, returns whether each vote was accepted, or None to try it again.
+        - max_votes (int): The most votes sealed into one block.
+        - max_wait (float): The longest a vote waits, in seconds, before its block is sealed anyway.
+        - max_attempts (int): The most blocks a vote is sealed into before it is reported as rejected.
+        - metrics (Metrics): Records how long votes wait to be sealed and answered.
+        """
+        self.seal_votes = seal_votes
+        self.max_votes = max_votes
+        self.max_wait = max_wait
+        self.max_attempts = max_attempts
+        self.metrics = metrics or Metrics()
+        self.queues = OrderedDict() #client -> deque of its pending (vote, attack, reply, time added, attempts), in the order clients are served
+        self.size = 0 #votes pending across every client
+        self.condition = threading.Condition()
+        self.stopped = False
+
+
+    def start(self):
+        """
+        start the thread that seals pending votes into blocks
+        """
+        sealing_thread = threading.Thread(target=self.run)
+        sealing_thread.daemon = True
+        sealing_thread.start()
+
+
+    def stop(self):
+        """
+        make run() return once the block being sealed, if any, is finished
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+
+    def add(self, vote, attack, reply, client=None):
+        """
+        queue a vote from a client to go into the next block
+        reply is called with True or False once that block is accepted or rejected, a reply of None is not called
+        """
+        with self.condition:
+            if client not in self.queues:
+                self.queues[client] = deque()
+            self.queues[client].append((vote, attack, reply, time.monotonic(), 0))
+            self.size += 1
+            self.condition.notify()
+
+
+    def retry(self, entries):
+        """
+        put the (client, entry) of votes taken by next_batch() back at the front of their clients' queues, in order
+        """
+        with self.condition:
+            for client, (vote, attack, reply, added, attempts) in reversed(entries):
+                if client not in self.queues:
+                    self.queues[client] = deque()
+                    self.queues.move_to_end(client, last=False)
+                self.queues[client].appendleft((vote, attack, reply, added, attempts + 1))
+                self.size += 1
+            self.condition.notify()
+
+
+    def take(self, client):
+        """
+        take the oldest vote of a client out of the pool, the client goes to the back of the line if it has more
+        """
+        queue = self.queues.pop(client)
+        entry = queue.popleft()
+        if queue:
+            self.queues[client] = queue
+        self.size -= 1
+        return client, entry
+
+
+    def next_batch(self):
+        """
+        wait until a block's worth of votes is ready and take them out of the pool
+        a staged attack corrupts its whole block, so attack votes are always sealed on their own
+        returns the (client, entry) of each vote and whether it is an attack, or None once the mempool is stopped
+        """
+        with self.condition:
+            while True:
+                if self.stopped:
+                    return None
+                if not self.queues:
+                    self.condition.wait()
+                    continue
+
+                for client, queue in self.queues.items():
+                    if queue[0][1]:
+                        return [self.take(client)], True
+
+                oldest = min(queue[0][3] for queue in self.queues.values())
+                time_left = oldest + self.max_wait - time.monotonic()
+                if self.size < self.max_votes and time_left > 0:
+                    self.condition.wait(time_left)
+                    continue
+
+                entries = []
+                waiting = [] #clients whose next vote is an attack, left for the next block
+                while self.queues and len(entries) < self.max_votes:
+                    client = next(iter(self.queues))
+                    if self.queues[client][0][1]:
+                        waiting.append((client, self.queues.pop(client)))
+                        continue
+                    entries.append(self.take(client))
+                for client, queue in reversed(waiting):
+                    self.queues[client] = queue
+                    self.queues.move_to_end(client, last=False)
+                return entries, False
+
+
+    def run(self):
+        """
+        seal batches of votes into blocks, one block at a time
+        """
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            entries, attack = batch
+            votes = [entry[0] for _, entry in entries]
+            sealed = time.monotonic()
+            for _, entry in entries:
+                if entry[4] == 0:
+                    self.metrics.observe(MEMPOOL_WAIT_SECONDS, sealed - entry[3])
+            try:
+                accepted = self.seal_votes(votes, attack)
+            except OSError as e:
+                print(f"failed to create a block for {len(votes)} votes: {e}")
+                accepted = [False] * len(votes)
+            retries = []
+            answered = time.monotonic()
+            self.metrics.observe(BLOCK_SECONDS, answered - sealed)
+            for (client, entry), vote_accepted in zip(entries, accepted):
+                reply, added, attempts = entry[2], entry[3], entry[4]
+                if vote_accepted is None and attempts + 1 < self.max_attempts:
+                    retries.append((client, entry))
+                    continue
+                if reply is not None:
+                    self.metrics.observe(VOTE_SECONDS, answered - added, outcome="accepted" if vote_accepted else "rejected")
+                    reply(bool(vote_accepted))
+            if retries:
+                print(f"trying {len(retries)} votes again in the next block")
+                self.metrics.count(VOTES_RETRIED, len(retries))
+                self.retry(retries)
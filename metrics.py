@@ -0,0 +1,314 @@
+"""
+runtime metrics of a peer or the tracker: counters, gauges and histograms
+
+every message in and out is counted by its type and the link it is on (peer,
+app, or tracker), with its bytes on the wire (the length header included). a
+peer also records how long each block took to mine and how many hashes that
+took, how long each quorum round took from sending the block to its outcome,
+how long votes waited in the mempool and until they were answered, and how long
+each tally query took. so the time a slow vote took can be split into its wait
+in the mempool, mining, and waiting for the other peers
+
+the metrics are read two ways:
+- a STATS message on a peer's app port or on the tracker's port is answered with
+  [RETURNED_STATS, snapshot], a snapshot of every metric as json
+- with --metrics-port, a peer or the tracker serves every metric as Prometheus
+  text at http://127.0.0.1:PORT/metrics
+
+    python3 metrics.py <host> <port>
+
+prints the snapshot of the peer (at its app port) or tracker (at its port) there
+
+"""
+import http.server
+import json
+import socket
+import sys
+import threading
+import time
+from block_codec import BLOCK_MESSAGE, MESSAGE_HEAD
+from protocol import *
+
+#upper bounds, in seconds, of the buckets of every histogram
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+#the links a message can be on, from the side that counts it
+PEER_LINK = "peer"
+APP_LINK = "app"
+TRACKER_LINK = "tracker"
+
+MESSAGES_RECEIVED = "voting_messages_received_total"
+MESSAGES_SENT = "voting_messages_sent_total"
+BYTES_RECEIVED = "voting_received_bytes_total"
+BYTES_SENT = "voting_sent_bytes_total"
+MINING_SECONDS = "voting_mining_seconds"
+HASHES = "voting_mining_hashes_total"
+HASH_RATE = "voting_hash_rate"
+QUORUM_SECONDS = "voting_quorum_seconds"
+BLOCK_SECONDS = "voting_block_seconds"
+MEMPOOL_WAIT_SECONDS = "voting_mempool_wait_seconds"
+VOTE_SECONDS = "voting_vote_seconds"
+VOTES_RETRIED = "voting_votes_retried_total"
+TALLY_SECONDS = "voting_tally_seconds"
+CHAIN_HEIGHT = "voting_chain_height"
+SIDE_BLOCKS = "voting_side_blocks"
+MEMPOOL_VOTES = "voting_mempool_votes"
+APPS_CONNECTED = "voting_apps_connected"
+KNOWN_PEERS = "voting_known_peers"
+NETWORK_PEERS = "voting_network_peers"
+MEMBERSHIP_EPOCH = "voting_membership_epoch"
+UPTIME_SECONDS = "voting_uptime_seconds"
+
+#name -> (kind, help) of every metric
+METRICS = {
+    MESSAGES_RECEIVED: ("counter", "messages received, by link and type"),
+    MESSAGES_SENT: ("counter", "messages sent, by link and type"),
+    BYTES_RECEIVED: ("counter", "bytes of the messages received with their length headers, by link and type"),
+    BYTES_SENT: ("counter", "bytes of the messages sent with their length headers, by link and type"),
+    MINING_SECONDS: ("histogram", "seconds to find the nonce of a block"),
+    HASHES: ("counter", "hashes tried while mining blocks"),
+    HASH_RATE: ("gauge", "hashes per second while mining, over every block mined"),
+    QUORUM_SECONDS: ("histogram", "seconds from sending a new block to the other peers until it was accepted or rejected, by outcome"),
+    BLOCK_SECONDS: ("histogram", "seconds the mempool waited for a block to be created, from sealing its votes until the votes were answered"),
+    MEMPOOL_WAIT_SECONDS: ("histogram", "seconds a vote waited in the mempool before its first block was sealed"),
+    VOTE_SECONDS: ("histogram", "seconds from a vote reaching the mempool until its voter was answered, by outcome"),
+    VOTES_RETRIED: ("counter", "votes sealed again after their block lost a race with another block"),
+    TALLY_SECONDS: ("histogram", "seconds to answer a tally query, by query"),
+    CHAIN_HEIGHT: ("gauge", "blocks in the chain"),
+    SIDE_BLOCKS: ("gauge", "blocks in the fork pool, on side branches or orphaned"),
+    MEMPOOL_VOTES: ("gauge", "votes waiting in the mempool"),
+    APPS_CONNECTED: ("gauge", "applications connected"),
+    KNOWN_PEERS: ("gauge", "other peers in our view of the network"),
+    NETWORK_PEERS: ("gauge", "peers in the tracker's membership table"),
+    MEMBERSHIP_EPOCH: ("gauge", "epoch of the tracker's membership table"),
+    UPTIME_SECONDS: ("gauge", "seconds since the process started"),
+}
+
+
+def message_label(message_type):
+    """
+    the type label of a message, any type that isn't in the protocol is counted as OTHER, so a bad message can't add labels
+    """
+    return message_type if message_type in MESSAGE_TYPES else "OTHER"
+
+
+def message_type(data):
+    """
+    the type of an encoded message (str or bytes), read from the start of its json (or of the json header of a block message)
+    without decoding the rest of it
+    """
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        start = MESSAGE_HEAD.size if data[:1] == bytes([BLOCK_MESSAGE]) else 0
+        data = bytes(data[start:start + 64]).decode('utf-8', 'replace')
+    if not data.startswith('["'):
+        return "OTHER"
+    return message_label(data[2:data.find('"', 2)])
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        Initializes a Histogram.
+
+        Parameters:
+        - buckets (tuple of float): The upper bound of every bucket, in increasing order.
+        """
+        self.buckets = buckets
+        self.counts = [0] * len(buckets) #values in each bucket, not cumulative, a value above the last bound is only in count
+        self.count = 0
+        self.sum = 0.0
+
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+    def cumulative(self):
+        """
+        (bound, values up to it) for every bucket, like Prometheus buckets
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics:
+    def __init__(self):
+        """
+        Initializes a Metrics, empty except for the process uptime.
+        """
+        self.lock = threading.Lock()
+        self.values = {} #(name, labels as a sorted tuple of (label, value)) -> count, or Histogram
+        self.gauges = {} #name -> function returning its current value
+        self.started = time.monotonic()
+        self.gauge(UPTIME_SECONDS, lambda: time.monotonic() - self.started)
+
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = Histogram()
+            histogram.observe(value)
+
+
+    def gauge(self, name, read):
+        """
+        report the value read() returns for a gauge, read every time the metrics are
+        """
+        self.gauges[name] = read
+
+
+    def received(self, link, message_type, size):
+        """
+        count a message received on a link, size is its length without the length header
+        """
+        self.count_message(MESSAGES_RECEIVED, BYTES_RECEIVED, link, message_label(message_type), size + HEADER_BYTES)
+
+
+    def sent(self, link, data):
+        """
+        count an encoded message (str or bytes, without its length header) sent on a link
+        """
+        self.count_message(MESSAGES_SENT, BYTES_SENT, link, message_type(data), len(data) + HEADER_BYTES)
+
+
+    def count_message(self, messages, bytes, link, label, size):
+        labels = (("link", link), ("type", label))
+        with self.lock:
+            self.values[(messages, labels)] = self.values.get((messages, labels), 0) + 1
+            self.values[(bytes, labels)] = self.values.get((bytes, labels), 0) + size
+
+
+    def hash_rate(self):
+        """
+        hashes per second over every block mined, for the HASH_RATE gauge of a peer
+        """
+        with self.lock:
+            hashes = self.values.get((HASHES, ()), 0)
+            mining = self.values.get((MINING_SECONDS, ()))
+        return hashes / mining.sum if mining is not None and mining.sum > 0 else 0
+
+
+    def samples(self):
+        """
+        (name, labels, value) of every metric, sorted by name and labels, a histogram's value is a copy of its Histogram
+        """
+        with self.lock:
+            samples = []
+            for (name, labels), value in self.values.items():
+                if isinstance(value, Histogram):
+                    copy = Histogram(value.buckets)
+                    copy.counts, copy.count, copy.sum = list(value.counts), value.count, value.sum
+                    value = copy
+                samples.append((name, labels, value))
+        for name, read in list(self.gauges.items()):
+            samples.append((name, (), read()))
+        samples.sort(key=lambda sample: (sample[0], sample[1]))
+        return samples
+
+
+    def snapshot(self):
+        """
+        every metric as json: name -> list of [labels, value], a histogram's value is its count, sum and cumulative buckets
+        """
+        snapshot = {}
+        for name, labels, value in self.samples():
+            if isinstance(value, Histogram):
+                value = {"count": value.count, "sum": value.sum, "buckets": value.cumulative()}
+            snapshot.setdefault(name, []).append([dict(labels), value])
+        return snapshot
+
+
+    def prometheus_text(self):
+        """
+        every metric in the Prometheus text format
+        """
+        lines = []
+        described = set()
+        for name, labels, value in self.samples():
+            kind, help = METRICS.get(name, ("untyped", name))
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+            if isinstance(value, Histogram):
+                for bound, count in value.cumulative():
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', repr(float(bound))),))} {count}")
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {value.count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value.sum!r}")
+                lines.append(f"{name}_count{format_labels(labels)} {value.count}")
+            else:
+                lines.append(f"{name}{format_labels(labels)} {value!r}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + "}"
+
+
+def serve_metrics(metrics, port, host="127.0.0.1"):
+    """
+    serve the metrics as Prometheus text at http://host:port/metrics on a background thread, returns the server
+    """
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+
+        def log_message(self, format, *args):
+            pass #a scrape every few seconds would flood the log
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"serving metrics at http://{host}:{port}/metrics")
+    return server
+
+
+def request_stats(host, port):
+    """
+    the STATS snapshot of the peer (at its app port) or the tracker (at its port) at host:port
+    """
+    with socket.create_connection((host, port)) as stats_socket:
+        send_wrapper(stats_socket, json.dumps([STATS]))
+        raw_data = recv_wrapper(stats_socket)
+    if raw_data is None:
+        raise ConnectionError("the connection closed before the stats came back")
+    data = json.loads(raw_data)
+    if data[0] != RETURNED_STATS:
+        raise ConnectionError(f"expected {RETURNED_STATS}, got {data[0]}")
+    return data[1]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("USAGE: python3 metrics.py <host> <port>")
+        sys.exit(1)
+    print(json.dumps(request_stats(sys.argv[1], int(sys.argv[2])), indent=2))
@@ -0,0 +1,113 @@
+"""
+parallel nonce search for mining blocks
+
+the nonce space is split across a pool of worker processes, worker i tries
+start + i, start + i + workers, start + i + 2*workers, ...
+as soon as one worker finds a hash that meets DIFFICULTY it sets a shared
+stop event and every other worker returns
+
+"""
+import multiprocessing
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from block import midstate, find_nonce
+
+#how many nonces a worker tries before checking if another worker already won
+CHECK_INTERVAL = 1024
+
+_stop_event = None
+
+
+def init_worker(stop_event=None):
+    """
+    runs once in every worker process, the miner's and the chain verifier's
+    the parent handles Ctrl-C, so the workers ignore it
+    """
+    global _stop_event
+    _stop_event = stop_event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def search_nonces(prefix, start, step, stop_event=None):
+    """
+    tries nonces start, start + step, start + 2*step, ... until a hash meets the difficulty
+    returns (nonce, hash), or None if stop_event was set by someone else first
+    """
+    state = midstate(prefix)
+    while True:
+        result = find_nonce(state, start, step, CHECK_INTERVAL)
+        if result is not None:
+            if stop_event is not None:
+                stop_event.set()
+            return result
+        start += step * CHECK_INTERVAL
+        if stop_event is not None and stop_event.is_set():
+            return None
+
+
+def _search_worker(prefix, start, step):
+    return search_nonces(prefix, start, step, _stop_event)
+
+
+class Miner:
+    def __init__(self, workers=1):
+        """
+        Initializes a Miner.
+
+        Parameters:
+        - workers (int): The number of processes searching the nonce space, 1 mines in the calling thread.
+        """
+        self.workers = max(1, workers)
+        self.executor = None
+        self.stop_event = None
+        self.lock = threading.Lock() #one search at a time shares the stop event
+        if self.workers > 1:
+            self.stop_event = multiprocessing.Event()
+            self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                initializer=init_worker,
+                                                initargs=(self.stop_event,))
+
+
+    def search(self, prefix, start):
+        """
+        finds a nonce >= start whose hash of prefix + nonce meets the difficulty
+        prefix is the encoded block content from Block.hash_prefix()
+        returns (nonce, hash)
+        """
+        if self.executor is None:
+            return search_nonces(prefix, start, 1)
+
+        with self.lock:
+            self.stop_event.clear()
+            pending = set()
+            try:
+                for i in range(self.workers):
+                    pending.add(self.executor.submit(_search_worker, prefix, start + i, self.workers))
+            except RuntimeError as e:
+                #the pool stops taking work once the main thread has exited, e.g. when the caller runs on another thread
+                print(f"mining in this thread instead, the worker processes are not taking work: {e}")
+                self.stop_event.set()
+                wait(pending)
+                return search_nonces(prefix, start, 1)
+            result = None
+            while pending and result is None:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.result() is not None:
+                        result = future.result()
+                        break
+            #make sure every worker has stopped before the event is reused
+            self.stop_event.set()
+            wait(pending)
+            return result
+
+
+    def close(self):
+        """
+        shut down the worker processes
+        """
+        if self.executor is not None:
+            self.stop_event.set()
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
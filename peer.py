@@ -5,10 +5,29 @@ import time
 import argparse
 from protocol import *
 from block import *
+from block_codec import encode_message, decode_message
+from miner import Miner
+from mempool import Mempool
+from connection_pool import ConnectionPool
+from quorum import QuorumRound
+from blockchain import Blockchain
+from chain_store import ChainStore
+from chain_sync import ChainSync
+from chain_verify import ChainVerifier, load_checkpoints
+from fork_pool import ForkPool
+from metrics import *
 import signal
 import sys
 
-#USAGE: python3 peer.py <tracker_ip> <tracker_port> <peer_port> <app_port>
+#how many of the most recent new block ids a peer remembers, to drop copies of a block it already handled
+SEEN_BLOCKS = 1024
+#most blocks in one RECV_CHAIN message, a chain is sent as a stream of these
+#(large enough for the ChainVerifier to split one across its worker processes)
+CHAIN_CHUNK_SIZE = 4000
+#seconds without a part of a chain streamed to us before the rest is synced from the other peers instead
+CHAIN_TIMEOUT = 10
+
+#USAGE: python3 peer.py <tracker_ip> <tracker_port> <peer_port> <app_port> [--workers N] [--block-size N] [--block-interval SECONDS] [--quorum-timeout SECONDS] [--chain-dir DIR] [--fanout K] [--checkpoints FILE] [--voter-bloom N] [--host ADDRESS] [--advertise ADDRESS] [--max-apps N] [--metrics-port PORT] [--async]
 
 """
 Flow:
@@ -17,50 +36,111 @@ Flow:
     a. creates a socket and connects to the tracker node 
 2. join_network()
     a. sends a message indicating that the peer is joining network
-3. request_blockchain()
-    a. calls get_peers() 
-    b. then it gets first peer and it calls send_data() to peer to request blockchain
-4. start_listen_peer()
+3. subscribe()
+    a. gets a MEMBERSHIP snapshot of the other peers from the tracker
+    b. starts a thread with listen_for_tracker(), which applies the PEER_JOINED / PEER_LEFT updates the tracker pushes
+4. request_blockchain()
+    a. calls get_peers(), which reads our view of the network without asking the tracker
+    b. if our chain is empty it sends REQ_CHAIN to one peer and the chain is streamed back, otherwise it sends REQ_SYNC
+       with our block locator to a few peers through self.chain_sync. the blocks created while a chain was streamed,
+       or that a stream that stopped partway did not bring, are synced afterwards
+5. start_listen_peer()
     a. starts a new thread with listen_for_data() 
     b. listen_for_data()
-        1. accepts new connections from other peers, each accepted connection represents 
-           one message from a peer 
-        2. elif iterates over different message types and handles them accordingly
-            a. REQ_CHAIN: send blockchain back to the requester 
-            b. RECV_CHAIN: set the blockchain to the received chain if empty (which should be the first a peer recvs)
-            c. NEW_BLOCK: call validate_block() which checks to see if new_block prev_hash aligns with local chain, sends block_status and updates
-               dictionary
-            d. BLOCK_STATUS: indication from a peer that they have either added or rejected sent block, will update self.block_status_dict
-            e. BLOCK_REJECT: will remove the rejected block from the end of the blockchain (assuming it is at the end)
-5. start_listen_app() 
-    a. create a new thread which calls listen_for_app_messages() 
-        1. recieves new messages coming in from application over the designated socket
+        1. accepts new connections from other peers, each peer keeps one long-lived connection
+           open to us (from its ConnectionPool) and sends all of its messages over it
+        2. handle_peer_connection() reads the messages from each connection in its own thread, the first one a PEER_HELLO
+           with the "host:port" address of the peer that opened it
+        3. handle_peer_message() iterates over different message types and handles them accordingly
+            a. REQ_CHAIN: stream the blockchain back to the requester in RECV_CHAIN messages of CHAIN_CHUNK_SIZE blocks
+            b. RECV_CHAIN: verify and append each part of the chain we asked for as it arrives, up to its first block that fails verification
+            c. REQ_SYNC / SYNC_INFO / REQ_BLOCKS / RECV_BLOCKS: incremental chain sync, handled by ChainSync
+            d. NEW_BLOCK: call validate_block() which checks to see if new_block prev_hash aligns with local chain and none of its voters
+               have voted before, sends block_status and updates dictionary. a NEW_BLOCK sent through the fan-out tree goes to relay_block(), which also forwards it to our subtree
+            e. BLOCK_STATUS: indication from a peer (or a whole subtree) that they have either added or rejected sent block, will update the QuorumRound in self.block_status_dict
+            f. BLOCK_REJECT: will remove the rejected block from the end of the blockchain (assuming it is at the end), forwarding it to our subtree first
+6. start_listen_app() 
+    a. calls listen_for_app_messages() on the main thread 
+        1. accepts applications, up to max_apps at once, and serves each one with handle_application_connection() on its own thread,
+           which recieves new messages coming in from that application
         2. elif iterates over different message types and handles them accordingly
-            a. CAST_VOTE: calls create_new_block()
-                I. create and mine a new block, broadcast it to all peers, wait until all peers have accepted/rejected and act accordingly 
+            a. CAST_VOTE: adds the vote to the mempool, in the application's own queue
+                I. the mempool thread seals pending votes into one block with create_new_block() once enough votes are
+                   waiting or the oldest has waited long enough, taking one vote from each application in turn
+                II. leave out the votes from voters that have already voted, create and mine a new block, broadcast it to all peers,
+                    wait until all peers have accepted/rejected and act accordingly
+                III. sends TRANSACTION_STATUS to the app for every vote in the block
             b. TALLY_VOTE:
-                I. sends the blockchain back to the application using send_message_to_app()
-            c. PEER_LEAVE_NETWORK:
+                I. streams the blockchain back to the application in RETURNED_BLOCKCHAIN messages of CHAIN_CHUNK_SIZE blocks
+            c. TALLY_COUNT:
+                I. sends the number of votes for each candidate back to the application, kept up to date by self.blockchain
+            d. STATS:
+                I. sends a snapshot of the peer's metrics (metrics.py) back to the application
+            e. PEER_LEAVE_NETWORK:
                 I. causes the peer to leave the network
 
 """
 
 
 class Peer:
-    def __init__(self, tracker_ip, tracker_port, peer_port, app_port):
+    def __init__(self, tracker_ip, tracker_port, peer_port, app_port, mining_workers=1, block_size=32, block_interval=0.25, quorum_timeout=10, chain_dir=None, fanout=0, checkpoints=None, voter_bloom=None, host=None, advertise=None, max_apps=64, metrics_port=None):
         self.tracker_ip = tracker_ip
         self.tracker_port = tracker_port
         self.peer_port = peer_port
         self.app_port = app_port
         self.tracker_socket = None
-        self.app_socket = None
-        self.client_socket = None #for the currently-connected application
-        self.my_ip = get_external_ip()
-        self.blockchain = []
+        self.known_peers = {} #peer_address -> None, our view of the other peers in the network, in the order they joined
+        self.membership_epoch = None #epoch of self.known_peers, None while waiting for a MEMBERSHIP snapshot
+        self.membership_lock = threading.Lock()
+        self.app_clients = {} #socket of every connected application -> the lock held while sending to it
+        self.app_clients_lock = threading.Lock()
+        self.max_apps = max_apps
+        self.app_slots = threading.BoundedSemaphore(max_apps) #applications served at once, the rest wait to be accepted
+        self.host = host #the address to listen on, every interface if None
+        #both ports are bound before we join, a peer that can't listen must not be announced to the others
+        try:
+            self.peer_socket = listening_socket(host, peer_port, 5)
+            self.app_socket = listening_socket(host, app_port, 64)
+        except OSError as error:
+            print(f"could not listen on ports {peer_port} and {app_port}: {error}")
+            sys.exit(1)
+        self.my_address = advertised_address(advertise, host, peer_port, (tracker_ip, tracker_port)) #"host:port" other peers know us by
+        self.chain_verifier = ChainVerifier(mining_workers, checkpoints)
+        if chain_dir:
+            self.blockchain = Blockchain(store=ChainStore(chain_dir), voter_bloom=voter_bloom)
+            print(f"opened chain store in {chain_dir} with {len(self.blockchain)} blocks")
+            valid = self.chain_verifier.verify_stored(self.blockchain)
+            if valid < len(self.blockchain):
+                print(f"stored block {valid} fails verification, dropping the {len(self.blockchain) - valid} blocks from it")
+                while len(self.blockchain) > valid:
+                    self.blockchain.pop()
+            self.blockchain.save_vote_counts() #the next restart starts verifying above this height
+        else:
+            self.blockchain = Blockchain(voter_bloom=voter_bloom)
+        self.chain_sync = ChainSync(self)
+        self.miner = Miner(mining_workers)
+        self.metrics = Metrics()
+        self.metrics_port = metrics_port #serve the metrics over http on this port, if given
+        self.mempool = Mempool(self.create_new_block, block_size, block_interval, metrics=self.metrics)
+        self.connection_pool = ConnectionPool(self.my_address)
+        self.peer_message_lock = threading.Lock()
 
-        ## Format: {block_id_1: {peer1: True, peer2: False}}
+        ## Format: {block_id_1: QuorumRound}, only while create_new_block() (or relay_block()) is waiting on that block
         self.block_status_dict = {}
         self.block_status_lock = threading.Lock()
+        self.quorum_timeout = quorum_timeout
+        self.fanout = fanout #0 sends new blocks to every peer directly, otherwise through a tree with this many children per peer
+        self.seen_blocks = {} #ids of the last SEEN_BLOCKS new blocks received, a copy of one is ignored
+        self.fork_pool = ForkPool() #valid blocks that are not on our chain: side branches and orphans
+        self.created_blocks = {} #ids of the last SEEN_BLOCKS blocks we created that went on our chain, their votes are sent again if a reorganization drops them
+        self.chain_source = None #the peer whose chain is being streamed to us
+        self.chain_received = None #when the last part of that chain arrived
+        self.metrics.gauge(HASH_RATE, self.metrics.hash_rate)
+        self.metrics.gauge(CHAIN_HEIGHT, lambda: len(self.blockchain))
+        self.metrics.gauge(SIDE_BLOCKS, lambda: len(self.fork_pool))
+        self.metrics.gauge(MEMPOOL_VOTES, lambda: self.mempool.size)
+        self.metrics.gauge(APPS_CONNECTED, lambda: len(self.app_clients))
+        self.metrics.gauge(KNOWN_PEERS, lambda: len(self.known_peers))
 
         signal.signal(signal.SIGINT, self.signal_handler)
         
@@ -70,9 +150,11 @@ class Peer:
         leave network when interrupted by a Ctrl-C signal.
         """
         print("\nterminating...")
-        if self.client_socket:
-            termination_message = json.dumps([APP_LEAVE_NETWORK])
-            self.send_message_to_app(termination_message)
+        termination_message = json.dumps([APP_LEAVE_NETWORK])
+        with self.app_clients_lock:
+            client_sockets = list(self.app_clients)
+        for client_socket in client_sockets:
+            self.send_message_to_app(termination_message, client_socket)
         self.leave_network()
     
 
@@ -90,8 +172,85 @@ class Peer:
         send a JOIN_NETWORK message to the tracker
         """
         print("joining the network")
-        message = json.dumps([JOIN_NETWORK, self.my_ip])
-        self.tracker_socket.sendall(message.encode('utf-8') + DELIMITER_BYTE)
+        message = json.dumps([JOIN_NETWORK, self.my_address])
+        self.send_to_tracker(message)
+
+
+    def subscribe(self):
+        """
+        send a SUBSCRIBE message to the tracker and wait for the MEMBERSHIP snapshot
+        then start a thread that applies the tracker's PEER_JOINED / PEER_LEFT updates to our view
+        """
+        self.send_to_tracker(json.dumps([SUBSCRIBE, self.my_address]))
+        raw_data = recv_wrapper(self.tracker_socket)
+        self.handle_tracker_message(self.receive_from_tracker(raw_data))
+        tracker_listening_thread = threading.Thread(target=self.listen_for_tracker)
+        tracker_listening_thread.daemon = True
+        tracker_listening_thread.start()
+
+
+    def send_to_tracker(self, data):
+        send_wrapper(self.tracker_socket, data)
+        self.metrics.sent(TRACKER_LINK, data)
+
+
+    def receive_from_tracker(self, raw_data):
+        """
+        decode and count a message from the tracker
+        """
+        data = json.loads(raw_data)
+        self.metrics.received(TRACKER_LINK, data[0], len(raw_data))
+        return data
+
+
+    def listen_for_tracker(self):
+        """
+        receive membership updates from the tracker until the connection is closed
+        """
+        try:
+            while True:
+                raw_data = recv_wrapper(self.tracker_socket)
+                if not raw_data:
+                    break
+                self.handle_tracker_message(self.receive_from_tracker(raw_data))
+        except OSError:
+            pass
+
+
+    def handle_tracker_message(self, data):
+        """
+        apply a MEMBERSHIP snapshot or a PEER_JOINED / PEER_LEFT delta to our view of the network
+        a delta that skips an epoch means we missed one, so we ask for a new snapshot
+        """
+        with self.membership_lock:
+            if data[0] == MEMBERSHIP:
+                self.membership_epoch = data[1]
+                self.known_peers = dict.fromkeys(data[2])
+                print(f"membership epoch {data[1]}: {len(data[2])} other peers")
+                return
+            epoch, peer_address = data[1], data[2]
+            if self.membership_epoch is None or epoch <= self.membership_epoch:
+                return #waiting for a snapshot, or it already has this change
+            if epoch != self.membership_epoch + 1:
+                print("missed a membership update, asking the tracker for a new snapshot")
+                self.membership_epoch = None
+                self.send_to_tracker(json.dumps([SUBSCRIBE, self.my_address]))
+                return
+            self.membership_epoch = epoch
+            if peer_address == self.my_address:
+                return
+            if data[0] == PEER_JOINED:
+                print(f"peer {peer_address} joined the network")
+                self.known_peers[peer_address] = None
+            elif data[0] == PEER_LEFT:
+                print(f"peer {peer_address} left the network")
+                self.known_peers.pop(peer_address, None)
+
+        if data[0] == PEER_LEFT:
+            #blocks waiting on its status don't have to wait for the quorum timeout
+            with self.block_status_lock:
+                for quorum in self.block_status_dict.values():
+                    quorum.remove_peer(peer_address)
 
 
     def leave_network(self):
@@ -99,224 +258,450 @@ class Peer:
         send a LEAVE_NETWORK message to the tracker
         """
         print("leave the network...")
-        message = json.dumps([LEAVE_NETWORK, self.my_ip])
-        self.tracker_socket.sendall(message.encode('utf-8') + DELIMITER_BYTE)
+        message = json.dumps([LEAVE_NETWORK, self.my_address])
+        self.send_to_tracker(message)
         self.tracker_socket.close()
-        if self.app_socket:
-            self.app_socket.close()
+        self.miner.close()
+        self.chain_verifier.close()
+        self.connection_pool.close()
+        self.blockchain.close()
+        self.app_socket.close()
         sys.exit(0)
     
 
     def start_listen_peer(self):
         """
-        start listening for incoming messages from other peers
+        start listening for incoming messages from other peers, and serving the metrics if a metrics port was given
         """
+        if self.metrics_port:
+            serve_metrics(self.metrics, self.metrics_port)
         peer_listening_thread = threading.Thread(target=self.listen_for_data)
         peer_listening_thread.daemon = True
         peer_listening_thread.start()
+        self.connection_pool.start()
 
 
     def start_listen_app(self):
         """
-        start listening for incoming messages from apps
+        start listening for incoming messages from apps, on the calling thread until the peer leaves
+        the main thread has to stay alive, because the process pools used for mining and verification stop
+        taking new work once it exits
         """
-        app_listening_thread = threading.Thread(target=self.listen_for_app_messages)
-        app_listening_thread.start()
+        self.mempool.start()
+        self.listen_for_app_messages()
 
 
     def get_peers(self):
         """
-        send a LIST_PEERS message to the tracker and receive a list of peers
+        returns the list of the other peers in the network from our view of it
+        the view is kept up to date by the tracker, so this does not wait on the tracker
         """
-        message = json.dumps([LIST_PEERS, self.my_ip])
-        self.tracker_socket.sendall(message.encode('utf-8') + DELIMITER_BYTE)
-        peers_raw_data = recv_wrapper(self.tracker_socket)
-        peers = json.loads(peers_raw_data)
-        return peers
+        with self.membership_lock:
+            return list(self.known_peers)
 
 
-    def broadcast_data(self, data):
+    def broadcast_data(self, data, peers=None):
         """
-        send data to all peers in the network
+        send data to all peers in the network, or to the given list of peers
         """
-        peers = self.get_peers()
-        for peer_ip in peers:
-            threading.Thread(target=self.send_data, args=(peer_ip, data)).start()
+        if peers is None:
+            peers = self.get_peers()
+        for peer_address in peers:
+            threading.Thread(target=self.send_data, args=(peer_address, data)).start()
 
 
-    def send_data(self, peer_ip, data):
+    def send_data(self, peer_address, data):
         """
-        send data to a specific peer
+        send data to a specific peer over the pooled connection to it
         """
-        peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        peer_socket.connect((peer_ip, self.peer_port))
-        peer_socket.sendall(data.encode('utf-8'))
-        peer_socket.close()
+        self.connection_pool.send(peer_address, data)
+        self.metrics.sent(PEER_LINK, data)
 
 
-    def listen_for_data(self):
+    def send_data_and_wait(self, peer_address, data):
         """
-        listen for incoming messages from other peers
+        send_data() that only returns once the data has been written to the connection, raises OSError if it couldn't be
+        sends on the pooled connection already wait, AsyncPeer has to wait for its send queue
         """
-        listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        listening_socket.bind(('0.0.0.0', self.peer_port))
-        listening_socket.listen(5)
+        self.send_data(peer_address, data)
 
+
+    def listen_for_data(self):
+        """
+        accept connections from other peers on the peer port bound in __init__
+        each peer keeps one long-lived connection open to us, read by its own thread
+        """
         print("listening for incoming messages from peers...")
 
         while True:
-            peer_socket, peer_address = listening_socket.accept()
-            peer_ip = peer_address[0]
-        
-            raw_data = recv_wrapper(peer_socket)
-            data = json.loads(raw_data)
+            peer_socket, source = self.peer_socket.accept()
+            connection_thread = threading.Thread(target=self.handle_peer_connection, args=(peer_socket, source[0]))
+            connection_thread.daemon = True
+            connection_thread.start()
+
+
+    def handle_peer_connection(self, peer_socket, source_ip):
+        """
+        receive messages from one peer's connection until it is closed
+        the peer's PEER_HELLO says which peer it is, a peer that doesn't send one is taken to listen on our peer port
+        a message that can't be decoded or handled is logged and skipped, only a closed connection ends the loop
+        """
+        peer_address = format_address(source_ip, self.peer_port)
+        try:
+            while True:
+                raw_data = recv_wrapper(peer_socket)
+                if not raw_data:
+                    break
+                try:
+                    data = decode_message(raw_data)
+                    self.metrics.received(PEER_LINK, data[0], len(raw_data))
+                    if data[0] == PEER_HELLO:
+                        peer_address = data[1]
+                        continue
+                except Exception as error:
+                    print(f"could not decode a message from peer {peer_address}: {error!r}")
+                    continue
+                self.handle_peer_message_logged(data, peer_address)
+        except OSError:
+            pass
+        finally:
+            peer_socket.close()
+
 
+    def handle_peer_message_logged(self, data, peer_address):
+        """
+        handle_peer_message(), logging the error instead of raising it if the message is malformed or its handler fails
+        """
+        try:
+            self.handle_peer_message(data, peer_address)
+        except Exception as error:
+            print(f"could not handle a message from peer {peer_address}: {error!r}")
+
+
+    def handle_peer_message(self, data, peer_address):
+        """
+        handle one message from another peer
+        messages from different connections are handled one at a time, like they were on a single accept loop
+        """
+        with self.peer_message_lock:
             if data[0] == REQ_CHAIN:
-                print(f"receiving data from peer {peer_ip}: requesting the blockchain")
-                blockchain_dict = [block.to_dict() for block in self.blockchain]
-                print(f"sending data to peer {peer_ip}: local blockchain")
-                self.send_data(peer_ip, json.dumps([RECV_CHAIN, blockchain_dict]))
+                print(f"receiving data from peer {peer_address}: requesting the blockchain")
+                self.run_in_background(self.send_chain, peer_address)
             elif data[0] == RECV_CHAIN:
-                print(f"receiving data from peer {peer_ip}: receiving the blockchain")
-                if len(self.blockchain) == 0:
-                    blockchain = []
-                    for block_dict in data[1]:
-                        block = from_dict(block_dict)
-                        blockchain.append(block)
-                    self.blockchain = blockchain
+                print(f"receiving data from peer {peer_address}: {len(data[2])} blocks of the blockchain from height {data[1]}")
+                self.receive_chain(peer_address, data[1], data[2])
+            elif data[0] == REQ_SYNC:
+                print(f"receiving data from peer {peer_address}: requesting the blocks after its tip")
+                self.chain_sync.handle_req_sync(peer_address, data[1])
+            elif data[0] == SYNC_INFO:
+                print(f"receiving data from peer {peer_address}: it has blocks up to height {data[2]}")
+                self.chain_sync.handle_sync_info(peer_address, data[1], data[2])
+            elif data[0] == REQ_BLOCKS:
+                print(f"receiving data from peer {peer_address}: requesting blocks {data[1]} to {data[2] - 1}")
+                self.chain_sync.send_blocks(peer_address, data[1], data[2])
+            elif data[0] == RECV_BLOCKS:
+                print(f"receiving data from peer {peer_address}: {len(data[2])} blocks from height {data[1]}")
+                self.chain_sync.handle_recv_blocks(peer_address, data[1], data[2])
             elif data[0] == NEW_BLOCK:
-                print(f"receiving data from peer {peer_ip}: new block")
-                new_block = from_dict(data[1])
-                self.validate_block(new_block, peer_ip)
+                print(f"receiving data from peer {peer_address}: new block")
+                new_block = data[1]
+                if new_block.id in self.seen_blocks:
+                    return #a copy of a block we already handled
+                remember(self.seen_blocks, new_block.id)
+                if len(data) > 3:
+                    self.relay_block(new_block, data[2], data[3], peer_address)
+                else:
+                    self.validate_block(new_block, peer_address)
             elif data[0] == BLOCK_STATUS:
-                print(f"receiving data from peer {peer_ip}: result of new block's verification")
+                print(f"receiving data from peer {peer_address}: result of new block's verification")
                 block_id = data[1]
                 status = data[2]
+                covered = data[3] if len(data) > 3 else [peer_address] #a combined status covers a whole subtree
                 with self.block_status_lock:
-                    if peer_ip not in self.block_status_dict[block_id]:
-                        self.block_status_dict[block_id][peer_ip] = status
+                    quorum = self.block_status_dict.get(block_id)
+                if quorum:
+                    quorum.add_statuses(covered, status)
             elif data[0] == BLOCK_REJECT:
-                print(f"receiving data from peer {peer_ip}: broadcast to reject the block")
+                print(f"receiving data from peer {peer_address}: broadcast to reject the block")
                 block_id_rejected = data[1]
-                if self.blockchain:
-                    if self.blockchain[-1].id == block_id_rejected:
-                        self.blockchain.pop()
-            peer_socket.close()
+                if len(data) > 2:
+                    self.send_down_tree([BLOCK_REJECT, block_id_rejected], data[2])
+                self.reject_block(block_id_rejected)
 
 
 
-    def send_message_to_app(self, data):
+    def send_chain(self, peer_address):
         """
-        send data to the application
+        answers REQ_CHAIN with the chain as a stream of RECV_CHAIN messages of CHAIN_CHUNK_SIZE blocks, the last one shorter
+        each part is read once the part before it has been written, so only one part is held in memory at a time
         """
-        if self.client_socket:
-            self.client_socket.sendall(data.encode('utf-8'))
-        else:
-            print("No application currently connected")
+        print(f"sending data to peer {peer_address}: local blockchain")
+        start = 0
+        try:
+            while True:
+                records = self.blockchain.raw_blocks(start, start + CHAIN_CHUNK_SIZE)
+                self.send_data_and_wait(peer_address, encode_message([RECV_CHAIN, start, records]))
+                start += len(records)
+                if len(records) < CHAIN_CHUNK_SIZE:
+                    return
+        except OSError as e:
+            print(f"could not send the blockchain to peer {peer_address}: {e}")
 
 
-    def listen_for_app_messages(self):
+    def request_chain(self, peer_address):
         """
-        listen for incoming messages from the application
+        asks a peer for its whole chain when ours is empty, it is streamed back in RECV_CHAIN parts
         """
-        self.app_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.app_socket.bind(('0.0.0.0', self.app_port))
-        self.app_socket.listen(5)
+        with self.peer_message_lock:
+            self.chain_source = peer_address
+            self.chain_received = time.monotonic()
+        print(f"sending data to peer {peer_address}: requesting the blockchain")
+        try:
+            self.send_data(peer_address, json.dumps([REQ_CHAIN]))
+        except OSError as e:
+            print(f"could not request the blockchain from peer {peer_address}: {e}")
+        self.run_in_background(self.watch_chain, peer_address)
 
-        print("listening for incoming messages from apps...")
+
+    def watch_chain(self, peer_address):
+        """
+        gives up on a chain stream when no part of it arrived for CHAIN_TIMEOUT seconds, e.g. its sender left partway,
+        and syncs the rest from the other peers
+        """
         while True:
-            try:
-                self.client_socket, client_address = self.app_socket.accept()
-                print("new application connected")
+            with self.peer_message_lock:
+                if self.chain_source != peer_address:
+                    return #the whole chain arrived, or it was dropped
+                waited = time.monotonic() - self.chain_received
+                if waited >= CHAIN_TIMEOUT:
+                    print(f"the chain from peer {peer_address} stopped at height {len(self.blockchain) - 1}, syncing the rest from the other peers")
+                    self.chain_source = None
+                    self.chain_sync.start([peer for peer in self.get_peers() if peer != peer_address])
+                    return
+            time.sleep(CHAIN_TIMEOUT - waited)
+
+
+    def receive_chain(self, peer_address, start, blocks):
+        """
+        one part of the chain we asked a peer for with request_chain()
+        each part is verified and appended as it arrives, and the stream is dropped at its first block that fails verification
+        once it ends, the blocks created while it was streamed are synced from the other peers
+        """
+        if peer_address != self.chain_source or start != len(self.blockchain):
+            return
+        self.chain_received = time.monotonic()
+        prev_hash = self.blockchain.hash_at(-1) if start else GENESIS_PREV_HASH
+        valid = self.chain_verifier.verify(blocks, start, prev_hash)
+        for block in blocks[:valid]:
+            self.blockchain.append(block)
+        if valid < len(blocks):
+            print(f"the chain from peer {peer_address} fails verification at height {start + valid}, keeping the blocks before it")
+            self.chain_source = None
+            self.chain_sync.start([peer for peer in self.get_peers() if peer != peer_address])
+        elif len(blocks) < CHAIN_CHUNK_SIZE:
+            print(f"received the blockchain from peer {peer_address} up to height {len(self.blockchain) - 1}")
+            self.chain_source = None
+            self.chain_sync.start(self.get_peers())
 
-                self.handle_application_connection()
-            except ConnectionResetError:
-                print(f"Connection reset by peer: {client_address}")
-                if self.client_socket:
-                    self.client_socket.close()
-                    self.client_Socket = None
 
-            
-    def handle_application_connection(self):
+    def send_chain_to_app(self, client_socket, request_id=None):
+        """
+        answers TALLY_VOTE with the chain as RETURNED_BLOCKCHAIN messages of CHAIN_CHUNK_SIZE blocks, each saying whether more follow
+        the app counts each part as it arrives (tally.py)
         """
-        handle communication with a connected application
+        started = time.monotonic()
+        height = len(self.blockchain)
+        for start in range(0, max(height, 1), CHAIN_CHUNK_SIZE):
+            blocks = [block.to_dict() for block in self.blockchain[start:start + CHAIN_CHUNK_SIZE]]
+            more = start + CHAIN_CHUNK_SIZE < height
+            self.send_message_to_app(json.dumps(app_reply([RETURNED_BLOCKCHAIN, blocks, more], request_id)), client_socket)
+        self.metrics.observe(TALLY_SECONDS, time.monotonic() - started, query=TALLY_VOTE)
+
+
+    def send_message_to_app(self, data, client_socket):
         """
+        send data to an application, safe to call from any thread
+        """
+        send_lock = self.app_clients.get(client_socket)
+        try:
+            if send_lock is None:
+                raise OSError("not connected")
+            with send_lock:
+                send_wrapper(client_socket, data)
+            self.metrics.sent(APP_LINK, data)
+        except OSError:
+            print("application disconnected before it got a reply")
+
+
+    def listen_for_app_messages(self):
+        """
+        accept applications on the app port bound in __init__ and serve each one on its own thread, up to max_apps at once
+        """
+        print("listening for incoming messages from apps...")
         while True:
-            raw_data = recv_wrapper(self.client_socket)
-            if not raw_data:
-                print("application has disconnected")
-                self.client_socket.close()
-                self.client_socket = None
+            self.app_slots.acquire()
+            client_socket, client_address = self.app_socket.accept()
+            with self.app_clients_lock:
+                self.app_clients[client_socket] = threading.Lock()
+                print(f"new application connected, {len(self.app_clients)} connected")
+            app_thread = threading.Thread(target=self.handle_application_connection, args=(client_socket, client_address))
+            app_thread.daemon = True
+            app_thread.start()
+
+
+    def handle_application_connection(self, client_socket, client_address):
+        """
+        handle communication with a connected application until it disconnects
+        """
+        try:
+            while True:
+                raw_data = recv_wrapper(client_socket)
+                if not raw_data:
+                    break
+                data = json.loads(raw_data)
+                self.metrics.received(APP_LINK, data[0], len(raw_data))
+                self.handle_app_message(data, client_socket)
+        except ConnectionResetError:
+            print(f"Connection reset by peer: {client_address}")
+        finally:
+            with self.app_clients_lock:
+                del self.app_clients[client_socket]
+            client_socket.close()
+            self.app_slots.release()
+            print("application has disconnected")
+
+
+    def handle_app_message(self, data, client_socket):
+        """
+        handle one message from a connected application
+        a vote is answered once its block is accepted or rejected, so with request ids an app can have many votes in flight
+        """
+        request_id = app_request_id(data)
+        if data[0] == CAST_VOTE:
+            if not is_vote(data[1]):
+                print("REJECTED VOTE: it has no vote string to count")
+                self.transaction_status_reply(client_socket, request_id)(False)
                 return
+            self.mempool.add(data[1], data[2], self.transaction_status_reply(client_socket, request_id), client_socket)
+        elif data[0] == TALLY_VOTE:
+            if request_id is None:
+                self.send_chain_to_app(client_socket)
+            else:
+                #the reply can't be mistaken for another one, so the requests after it are read while the chain is sent
+                self.run_in_background(self.send_chain_to_app, client_socket, request_id)
+        elif data[0] == TALLY_COUNT:
+            started = time.monotonic()
+            tally = self.blockchain.tally()
+            self.metrics.observe(TALLY_SECONDS, time.monotonic() - started, query=TALLY_COUNT)
+            self.send_message_to_app(json.dumps(app_reply([RETURNED_TALLY, tally], request_id)), client_socket)
+        elif data[0] == STATS:
+            self.send_message_to_app(json.dumps(app_reply([RETURNED_STATS, self.metrics.snapshot()], request_id)), client_socket)
 
-            data = json.loads(raw_data)
 
-            if data[0] == CAST_VOTE:
-                self.create_new_block(data[1], data[2])
-                print_blockchain(self.blockchain)
-            elif data[0] == TALLY_VOTE:
-                blockchain_dict = [block.to_dict() for block in self.blockchain]
-                self.send_message_to_app(json.dumps([RETURNED_BLOCKCHAIN, blockchain_dict]))
-                print_blockchain(self.blockchain)
+    def transaction_status_reply(self, client_socket, request_id=None):
+        """
+        returns the function the mempool calls once a vote from this application is in an accepted or rejected block
+        """
+        def reply(accepted):
+            self.send_message_to_app(json.dumps(app_reply([TRANSACTION_STATUS, accepted], request_id)), client_socket)
+        return reply
 
 
     def request_blockchain(self):
         """
-        requests the blockchain from a peer when joining the network
+        requests the blocks we are missing from a few peers when joining the network
         """
         peers = self.get_peers()
         if len(peers) == 0:
-            # create the genesis block
-            gen_block = Block(data=None, blockchain=self.blockchain)
-            gen_block.mine()
-            self.blockchain.append(gen_block)
+            if len(self.blockchain) == 0:
+                self.create_genesis_block()
             return
-            
-        peer_to_req = peers[0]
-        data = json.dumps([REQ_CHAIN])
-        print(f"sending data to peer {peer_to_req}: requesting their blockchain")
-        self.send_data(peer_to_req, data)
+
+        if len(self.blockchain) == 0:
+            self.request_chain(peers[0])
+        else:
+            self.chain_sync.start(peers)
 
     
-    def create_new_block(self, data, attack):
+    def create_genesis_block(self):
         """
-        creates a new block, mines for the nonce
+        creates the first block of the chain when no other peers are in the network
+        """
+        gen_block = Block(data=None, blockchain=self.blockchain)
+        self.mine_block(gen_block)
+        self.blockchain.append(gen_block)
+
+
+    def mine_block(self, block):
+        """
+        mine a block with our miner, recording how long the nonce took to find and how many hashes were tried for it
+        """
+        first_nonce = block.nonce + 1
+        started = time.monotonic()
+        block.mine(self.miner)
+        self.metrics.observe(MINING_SECONDS, time.monotonic() - started)
+        self.metrics.count(HASHES, max(0, block.nonce - first_nonce + 1))
+
+
+    def create_new_block(self, votes, attack):
+        """
+        creates a new block holding a batch of votes from the mempool, mines for the nonce
         has an option to mess up the new block's previous hash, making it invalid
         broadcasts the block to all peers
-        wait until all peers have accepted or rejected the block
+        waits until all peers have accepted, any peer has rejected, or the quorum timeout has passed
         will either add the block to a local blockchain or broadcast a message for all peers to reject it
-        sends message to user to indicate the result
+        a vote from a voter that is already in the chain, or earlier in the batch, is left out of the block
+        (a staged attack is sent as it is, for the other peers to reject)
+        returns whether each vote was accepted, the mempool passes that on to its voter
         """
-        new_block = Block(data=data, blockchain=self.blockchain)
-        new_block.mine()
+        first_votes = [True] * len(votes) if attack else self.blockchain.first_votes(votes)
+        #a vote tried again after its block lost a race can be in the chain already, if that block won in the end
+        in_chain = [not first and self.blockchain.holds_vote(vote) for vote, first in zip(votes, first_votes)]
+        if not all(first_votes):
+            if first_votes.count(False) > sum(in_chain):
+                print(f"REJECTED {first_votes.count(False) - sum(in_chain)} VOTES: their voters have already voted")
+            votes = [vote for vote, first in zip(votes, first_votes) if first]
+            if not votes:
+                return in_chain
+        new_block = Block(data={"votes": votes}, blockchain=self.blockchain)
+        self.mine_block(new_block)
         if attack:
             new_block.prev_hash = self.attack_new_block(new_block)
 
-        data = json.dumps([NEW_BLOCK, new_block.to_dict()])
-        print("broadcasting to peers: new block")
-        self.broadcast_data(data)
         peers = self.get_peers()
+        quorum = QuorumRound(peers)
         with self.block_status_lock:
-            self.block_status_dict[new_block.id] = {}
-        
-        while True:
-            with self.block_status_lock:
-                peer_statuses = self.block_status_dict[new_block.id]
-                if len(peer_statuses) == len(peers):
-                    break
-        all_accepted = all(peer_statuses.values())
+            self.block_status_dict[new_block.id] = quorum
+        print("broadcasting to peers: new block")
+        sent = time.monotonic()
+        self.send_down_tree([NEW_BLOCK, new_block, self.quorum_timeout / 2], peers)
+
+        all_accepted = quorum.wait(self.quorum_timeout)
+        self.metrics.observe(QUORUM_SECONDS, time.monotonic() - sent, outcome="accepted" if all_accepted else "rejected")
+        with self.block_status_lock:
+            del self.block_status_dict[new_block.id]
+        on_chain = False
         if all_accepted:
-            print("all peers have received and accepted the new block")
-            self.blockchain.append(new_block)
+            with self.peer_message_lock:
+                self.check_block(new_block, self.my_address)
+                on_chain = self.blockchain.height_of(new_block.hash) is not None
+            if on_chain:
+                print("all peers have received and accepted the new block")
+                remember(self.created_blocks, new_block.id)
+            else:
+                print("all peers have accepted the new block, but another block won the race for our tip")
         else:
             #some peers have rejected
             print("peers have REJECTED the new block")
-            data = json.dumps([BLOCK_REJECT, new_block.id])
             print(f"broadcasting to peers: all should drop the new block if added")
-            self.broadcast_data(data)
+            self.send_down_tree([BLOCK_REJECT, new_block.id], peers)
 
-        result = json.dumps([TRANSACTION_STATUS, all_accepted])
-        self.send_message_to_app(result)
+        print_tip(self.blockchain)
+        if attack:
+            return [all_accepted] * len(first_votes)
+        #the votes of a block that didn't make it onto the chain are tried again in the next one
+        status = True if on_chain else None
+        return [held or (status if first else False) for first, held in zip(first_votes, in_chain)]
 
 
     def attack_new_block(self, new_block):
@@ -327,42 +712,277 @@ class Peer:
         return hashlib.sha256(attacked_block_content.encode()).hexdigest()
 
 
-    def validate_block(self, new_block, creator_ip):
+    def validate_block(self, new_block, creator_address):
         """
         validates a received block from another peer over the network
         if the hashes line up, it will add it to the local blockchain
         sends a message to the peer to indicate if it accepted or rejected it
         """
+        status = self.check_block(new_block, creator_address)
+        data = json.dumps([BLOCK_STATUS, new_block.id, status])
+        print(f"sending data to peer {creator_address}: result of new block verification")
+        self.send_data(creator_address, data)
+
+
+    def check_block(self, new_block, sender_address):
+        """
+        adds the block to the local blockchain if it builds on our tip, passes verification, and has no repeat voters
+        a valid block that builds on another block we have is kept in the fork pool instead, and we reorganize onto
+        its branch once that is longer than our chain
+        returns whether the block is valid, on our chain or on a side branch
+        a block that builds on blocks we don't have is kept as an orphan, and starts a chain sync with the sender
+        """
         if not self.blockchain:
             last_block_hash = None
         else:
             last_block_hash = self.blockchain[-1].hash
 
         if new_block.prev_hash == last_block_hash:
-            status = True
-            self.blockchain.append(new_block)
-        else:
-            print("REJECTED BLOCK")
-            status = False
+            status = self.chain_verifier.verify([new_block], len(self.blockchain), last_block_hash) == 1
+            if not status:
+                print("REJECTED BLOCK: its hash is wrong or does not meet the difficulty")
+            elif self.blockchain.repeats_voter(new_block):
+                print("REJECTED BLOCK: it has a vote from a voter that has already voted")
+                status = False
+            else:
+                self.blockchain.append(new_block)
+                #orphans that were waiting for this block
+                self.adopt_branch(self.fork_pool.longest_after(new_block.hash))
+            return status
 
-        data = json.dumps([BLOCK_STATUS, new_block.id, status])
-        print(f"sending data to peer {creator_ip}: result of new block verification")
-        self.send_data(creator_ip, data)
+        if self.blockchain and new_block.prev_hash == GENESIS_PREV_HASH:
+            print("REJECTED BLOCK: a second genesis block")
+            return False
+        if new_block.hash in self.fork_pool or self.blockchain.height_of(new_block.hash) is not None:
+            return True #a block we already have
+
+        branch = self.fork_pool.root_of(new_block)
+        fork_height = self.blockchain.height_of(branch[0].prev_hash)
+        if fork_height is None:
+            #its height is unknown, so only its own hash and proof of work can be checked before it is kept
+            if self.chain_verifier.verify_blocks([new_block], new_block.prev_hash) is not None:
+                print("REJECTED BLOCK: its hash is wrong or does not meet the difficulty")
+                return False
+            print("REJECTED BLOCK: it builds on blocks we don't have, keeping it as an orphan")
+            self.fork_pool.add(new_block)
+            if self.chain_source is None: #a chain being streamed to us brings the blocks it builds on
+                self.chain_sync.start([sender_address])
+            return False
+
+        height = fork_height + len(branch)
+        if self.chain_verifier.verify([new_block], height, new_block.prev_hash) != 1:
+            print("REJECTED BLOCK: its hash is wrong or does not meet the difficulty")
+            return False
+        print(f"SIDE BLOCK: it builds on a block below our tip, keeping it on a side branch at height {height}")
+        self.fork_pool.add(new_block)
+        self.adopt_branch(self.fork_pool.branch_through(new_block))
+        return True
+
+
+    def adopt_branch(self, branch):
+        """
+        reorganize onto a branch of the fork pool (its blocks in chain order) if it is longer than our chain
+        every block takes the same work to mine, so the longest chain is the heaviest, and a tie keeps our chain
+        returns whether we did
+        """
+        if not branch:
+            return False
+        fork_height = self.blockchain.height_of(branch[0].prev_hash)
+        if fork_height is None or fork_height + len(branch) < len(self.blockchain):
+            return False
+        return self.reorganize(fork_height, branch)
+
+
+    def adopt_longest_branch(self):
+        """
+        reorganize onto the longest branch in the fork pool, if it is longer than our chain
+        """
+        longest = []
+        longest_tip = -1
+        for root in self.fork_pool.roots():
+            fork_height = self.blockchain.height_of(root.prev_hash)
+            if fork_height is not None:
+                branch = self.fork_pool.branch_through(root)
+                if fork_height + len(branch) > longest_tip:
+                    longest, longest_tip = branch, fork_height + len(branch)
+        return self.adopt_branch(longest)
+
+
+    def reorganize(self, fork_height, branch, verified=False):
+        """
+        swap the blocks of our chain after fork_height for a longer branch from the fork pool (or fetched by a chain sync)
+        the branch is verified (unless it already was) and checked for repeat voters as it goes on the chain, and is cut
+        at the first block that fails, putting our chain back if what is left is no longer longer
+        the blocks taken off the chain go into the fork pool, and the votes of the ones we created are sent again
+        """
+        valid = len(branch) if verified else self.chain_verifier.verify(branch, fork_height + 1, branch[0].prev_hash)
+        with self.blockchain.lock: #readers (e.g. a TALLY_COUNT) see the chain before or after, never halfway
+            if fork_height >= len(self.blockchain) or (fork_height >= 0 and self.blockchain.hash_at(fork_height) != branch[0].prev_hash):
+                print(f"not switching to a branch from height {fork_height}, our chain no longer has the block it builds on")
+                return False
+            displaced = []
+            while len(self.blockchain) > fork_height + 1:
+                displaced.append(self.blockchain.pop())
+            displaced.reverse()
+
+            applied = 0
+            for block in branch[:valid]:
+                if self.blockchain.repeats_voter(block):
+                    break
+                self.blockchain.append(block)
+                applied += 1
+            if applied < len(branch):
+                print(f"REJECTED BLOCK: block {fork_height + 1 + applied} of a side branch is invalid or has a repeat voter")
+                self.fork_pool.remove_branch(branch[applied].hash)
+
+            if applied <= len(displaced):
+                for _ in range(applied):
+                    self.blockchain.pop()
+                for block in displaced:
+                    self.blockchain.append(block)
+                return False
+        for block in branch[:applied]:
+            self.fork_pool.discard(block.hash)
+        for block in displaced:
+            self.fork_pool.add(block)
+        print(f"REORGANIZED: replaced {len(displaced)} blocks after height {fork_height} with {applied} blocks from a side branch")
+        self.resubmit_votes(displaced)
+        return True
 
 
-def print_blockchain(blockchain):
+    def resubmit_votes(self, blocks):
+        """
+        send the votes of the blocks we created that a reorganization took off the chain back to the mempool
+        their voters were already told the votes went through, so only the votes the new chain doesn't have go into a later block
+        """
+        votes = []
+        for block in blocks:
+            if block.id in self.created_blocks:
+                del self.created_blocks[block.id]
+                votes.extend(block_votes(block.data))
+        votes = [vote for vote, first in zip(votes, self.blockchain.first_votes(votes)) if first]
+        if votes:
+            print(f"sending {len(votes)} votes of the blocks we lost to a side branch again")
+        for vote in votes:
+            self.mempool.add(vote, False, None)
+
+
+    def reject_block(self, block_id):
+        """
+        drop a block its creator rejected, from the fork pool or the tip of our chain, and the side blocks that build on it
+        a side branch may then be longer than our chain
+        """
+        hash = self.fork_pool.hash_of(block_id)
+        if hash is not None:
+            self.fork_pool.remove_branch(hash)
+        elif self.blockchain and self.blockchain[-1].id == block_id:
+            rejected = self.blockchain.pop()
+            self.fork_pool.remove_branch(rejected.hash)
+            self.adopt_longest_branch()
+
+
+    def relay_block(self, new_block, timeout, subtree, parent_address):
+        """
+        handles a NEW_BLOCK sent through the fan-out tree
+        validates the block, forwards it to our subtree, and sends the parent one BLOCK_STATUS for us and the whole subtree
+        the subtree gets timeout / 2 seconds to answer, so our reply reaches the parent before its own deadline
+        """
+        covered = [self.my_address] + subtree
+        status = self.check_block(new_block, parent_address)
+        if not status or not subtree:
+            #a rejection already decides the round, there is no need to ask the subtree
+            print(f"sending data to peer {parent_address}: result of new block verification for {len(covered)} peers")
+            self.send_data(parent_address, json.dumps([BLOCK_STATUS, new_block.id, status, covered]))
+            return
+
+        quorum = QuorumRound(subtree)
+        with self.block_status_lock:
+            self.block_status_dict[new_block.id] = quorum
+        self.send_down_tree([NEW_BLOCK, new_block, timeout / 2], subtree)
+        self.run_in_background(self.finish_relay, new_block.id, quorum, timeout, covered, parent_address)
+
+
+    def finish_relay(self, block_id, quorum, timeout, covered, parent_address):
+        """
+        waits for the subtree's statuses, then passes them on to the parent combined into one
+        """
+        all_accepted = quorum.wait(timeout)
+        with self.block_status_lock:
+            del self.block_status_dict[block_id]
+        print(f"sending data to peer {parent_address}: result of new block verification for {len(covered)} peers")
+        self.send_data(parent_address, json.dumps([BLOCK_STATUS, block_id, all_accepted, covered]))
+
+
+    def send_down_tree(self, parts, peers):
+        """
+        splits the peers into at most self.fanout subtrees and sends the message (parts + [subtree]) to the first peer
+        of each, which forwards it to the rest of its subtree
+        with a fanout of 0 the message (parts) is sent to every peer directly
+        """
+        if not self.fanout:
+            self.broadcast_data(encode_message(parts), peers)
+            return
+        for head, subtree in fanout_subtrees(peers, self.fanout):
+            self.broadcast_data(encode_message(parts + [subtree]), [head])
+
+
+    def run_in_background(self, function, *args):
+        threading.Thread(target=function, args=args, daemon=True).start()
+
+
+def remember(recent, block_id):
+    """
+    adds a block id to a dict of the last SEEN_BLOCKS ids, dropping the oldest
+    """
+    recent[block_id] = None
+    if len(recent) > SEEN_BLOCKS:
+        del recent[next(iter(recent))]
+
+
+def advertised_address(advertise, host, peer_port, tracker):
     """
-    prints the blockchain
+    the "host:port" address other peers reach us at: the one given with --advertise (with our peer port if it has no port),
+    our external ip for "external", otherwise the --host we listen on, or the address of the local interface that reaches the tracker
+    nothing is looked up over the network unless "external" is asked for, so a peer starts without internet
+    """
+    if advertise == "external":
+        return format_address(get_external_ip(), peer_port)
+    if advertise:
+        return advertise if ':' in advertise else format_address(advertise, peer_port)
+    if host and host != '0.0.0.0':
+        return format_address(host, peer_port)
+    return format_address(local_ip(tracker), peer_port)
+
+
+def fanout_subtrees(peers, fanout):
+    """
+    splits peers into at most fanout nearly equal parts, returns (first peer, rest of the part) for each
+    """
+    subtrees = []
+    part_size, extra = divmod(len(peers), fanout)
+    start = 0
+    for i in range(min(fanout, len(peers))):
+        end = start + part_size + (1 if i < extra else 0)
+        subtrees.append((peers[start], peers[start + 1:end]))
+        start = end
+    return subtrees
+
+
+def print_tip(blockchain):
+    """
+    prints the last block of the blockchain and its height
+    only the tip is printed, printing the whole chain after every block takes longer the longer the chain gets
     """
     print("----------------------")
-    if blockchain:
-        for index, block in enumerate(blockchain):
-            print(f"Block {index}:")
-            print(block)
-            print("----------------------")   
+    with blockchain.lock: #another thread can pop the tip while we read it
+        height = len(blockchain) - 1
+        tip = blockchain[-1] if height >= 0 else None
+    if tip is not None:
+        print(f"Block {height}:")
+        print(tip)
     else:
         print("   empty blockchain   ")
-        print("----------------------")   
+    print("----------------------")
         
 
 if __name__ == "__main__":
@@ -371,17 +991,37 @@ if __name__ == "__main__":
     parser.add_argument('tracker_port', type=int, help='tracker port')
     parser.add_argument('peer_port', type=int, help='peer port')
     parser.add_argument('app_port', type=int, help='app port')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes used to mine new blocks')
+    parser.add_argument('--block-size', type=int, default=32, help='most votes sealed into one block')
+    parser.add_argument('--block-interval', type=float, default=0.25, help='longest a vote waits in seconds before its block is sealed')
+    parser.add_argument('--quorum-timeout', type=float, default=10, help='seconds to wait for every peer to accept a new block')
+    parser.add_argument('--chain-dir', type=str, default=None, help='directory to keep the blockchain in, so it survives restarts')
+    parser.add_argument('--fanout', type=int, default=0, help='send new blocks through a tree where each peer forwards to at most this many others, 0 sends to every peer directly')
+    parser.add_argument('--checkpoints', type=str, default=None, help='json file of trusted {"height": "hash"} checkpoints, blocks from other peers that contradict one are rejected')
+    parser.add_argument('--voter-bloom', type=int, default=0, help='check for repeat voters with a bloom filter sized for this many voters instead of a set of every voter')
+    parser.add_argument('--host', type=str, default=None, help='address to listen on, instead of every interface')
+    parser.add_argument('--advertise', type=str, default=None, help='host or host:port other peers reach this peer at, "external" to look up the external ip online (default: --host, or the local interface that reaches the tracker)')
+    parser.add_argument('--max-apps', type=int, default=64, help='most applications served at once, the rest wait to be accepted')
+    parser.add_argument('--metrics-port', type=int, default=None, help='serve the metrics as Prometheus text at http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--async', dest='async_mode', action='store_true', help='serve peer, app, and tracker traffic on one asyncio event loop')
 
     args = parser.parse_args()
 
+    checkpoints = load_checkpoints(args.checkpoints) if args.checkpoints else None
     tracker_ip = args.tracker_ip
     tracker_port = args.tracker_port
     peer_port = args.peer_port
     app_port = args.app_port
 
-    peer = Peer(tracker_ip, tracker_port, peer_port, app_port)
+    if args.async_mode:
+        from async_peer import AsyncPeer
+        peer = AsyncPeer(tracker_ip, tracker_port, peer_port, app_port, args.workers, args.block_size, args.block_interval, args.quorum_timeout, args.chain_dir, args.fanout, checkpoints, args.voter_bloom, args.host, args.advertise, args.max_apps, args.metrics_port)
+        peer.run()
+
+    peer = Peer(tracker_ip, tracker_port, peer_port, app_port, args.workers, args.block_size, args.block_interval, args.quorum_timeout, args.chain_dir, args.fanout, checkpoints, args.voter_bloom, args.host, args.advertise, args.max_apps, args.metrics_port)
     peer.connect_to_tracker()
     peer.join_network()
+    peer.subscribe()
     peer.start_listen_peer()
     peer.request_blockchain()
     peer.start_listen_app()
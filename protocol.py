@@ -1,10 +1,18 @@
+import asyncio
+import json
+import socket
+import struct
+
+
 #Message types from app -> peer
 CAST_VOTE = "CAST_VOTE"
 TALLY_VOTE = "TALLY_VOTE"
+TALLY_COUNT = "TALLY_COUNT"
 
 
 #Message types from peer -> app
 RETURNED_BLOCKCHAIN = "RETURNED_BLOCKCHAIN"
+RETURNED_TALLY = "RETURNED_TALLY"
 TRANSACTION_STATUS = "TRANSACTION_STATUS"
 APP_LEAVE_NETWORK = "APP_LEAVE_NETWORK"
 
@@ -15,43 +23,201 @@ RECV_CHAIN = "RECV_CHAIN"
 NEW_BLOCK = "NEW_BLOCK"
 BLOCK_STATUS= "BLOCK_STATUS"
 BLOCK_REJECT = "BLOCK_REJECT"
+REQ_SYNC = "REQ_SYNC"
+SYNC_INFO = "SYNC_INFO"
+REQ_BLOCKS = "REQ_BLOCKS"
+RECV_BLOCKS = "RECV_BLOCKS"
+PEER_HELLO = "PEER_HELLO"
 
 
 #Message types from peer -> tracker
 JOIN_NETWORK = "JOIN_NETWORK"
 LEAVE_NETWORK = "LEAVE_NETWORK"
 LIST_PEERS = "LIST_PEERS"
+SUBSCRIBE = "SUBSCRIBE"
+
+
+#Message types from tracker -> peer
+MEMBERSHIP = "MEMBERSHIP"
+PEER_JOINED = "PEER_JOINED"
+PEER_LEFT = "PEER_LEFT"
+
+
+#Message types from an app or a monitoring tool -> peer (on its app port) or tracker, and the reply (see metrics.py)
+STATS = "STATS"
+RETURNED_STATS = "RETURNED_STATS"
+
+
+#every message type, a message of any other type is counted as OTHER in the metrics
+MESSAGE_TYPES = {
+    CAST_VOTE, TALLY_VOTE, TALLY_COUNT,
+    RETURNED_BLOCKCHAIN, RETURNED_TALLY, TRANSACTION_STATUS, APP_LEAVE_NETWORK,
+    REQ_CHAIN, RECV_CHAIN, NEW_BLOCK, BLOCK_STATUS, BLOCK_REJECT, REQ_SYNC, SYNC_INFO, REQ_BLOCKS, RECV_BLOCKS, PEER_HELLO,
+    JOIN_NETWORK, LEAVE_NETWORK, LIST_PEERS, SUBSCRIBE,
+    MEMBERSHIP, PEER_JOINED, PEER_LEFT,
+    STATS, RETURNED_STATS,
+}
+
+
+#Every message on every socket (peer-tracker, peer-peer, and app-peer) is framed as a
+#4-byte big-endian length header followed by that many bytes of utf-8 encoded json,
+#or of a binary block message between peers (see block_codec.py)
+HEADER = struct.Struct('!I')
+HEADER_BYTES = HEADER.size
+#a frame longer than this is not read and its connection is treated as closed, so a header from an
+#unframed or hostile client (e.g. the start of an old unframed json message) can't make us allocate gigabytes
+MAX_FRAME_BYTES = 256 * 1024 * 1024
+#bytes of a frame allocated before any of it arrives, a longer frame's buffer grows as its bytes do
+PREALLOCATE_BYTES = 1024 * 1024
+
+
+def frame(data):
+    """
+    adds the length header to a message (str or bytes)
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return HEADER.pack(len(data)) + data
 
 
-#Delimiters in between messages for tracker-peer communication
-DELIMITER_BYTE = b'\n'
-DELIMITER_STR = "\n"
+def send_wrapper(socket, data):
+    """
+    frames data (str or bytes) with its length and sends all of it
+    """
+    socket.sendall(frame(data))
 
 
-SOCKET_MAX_BYTES = 1024
+def recv_exactly(socket, num_bytes):
+    """
+    reads exactly num_bytes from the socket into one buffer, preallocated up to PREALLOCATE_BYTES and doubled
+    as more bytes arrive, so the memory a frame takes is never much more than what was actually received
+    returns None if the socket closes first
+    """
+    buffer = bytearray(min(num_bytes, PREALLOCATE_BYTES))
+    received = 0
+    while received < num_bytes:
+        if received == len(buffer):
+            buffer.extend(bytes(min(len(buffer), num_bytes - len(buffer))))
+        with memoryview(buffer) as view: #released before the buffer grows again
+            chunk_bytes = socket.recv_into(view[received:])
+        if chunk_bytes == 0:
+            return None
+        received += chunk_bytes
+    return buffer
+
 
 def recv_wrapper(socket):
     """
-    wrapper for recv that will ensure it reads the entire data sent at that time,
-    not just enough to fill up 1 buffer
+    wrapper for recv that reads exactly one framed message, no matter how
+    it was split up or merged with other messages by TCP
+    returns the message's bytes (json.loads() takes them as they are), or None if the socket was closed
+    or the frame is longer than MAX_FRAME_BYTES (the caller closes the connection either way)
+    """
+    header = recv_exactly(socket, HEADER_BYTES)
+    if header is None:
+        return None
+    (message_bytes,) = HEADER.unpack(header)
+    if message_bytes > MAX_FRAME_BYTES:
+        print(f"closing a connection that sent a {message_bytes} byte frame, more than {MAX_FRAME_BYTES}")
+        return None
+    return recv_exactly(socket, message_bytes)
+
+
+async def recv_wrapper_async(reader):
+    """
+    recv_wrapper() for an asyncio StreamReader
+    returns None if the connection was closed or the frame is longer than MAX_FRAME_BYTES
     """
-    message_data = b''
-    while True:
-        chunk = socket.recv(SOCKET_MAX_BYTES)
-        if not chunk:
+    try:
+        header = await reader.readexactly(HEADER_BYTES)
+        (message_bytes,) = HEADER.unpack(header)
+        if message_bytes > MAX_FRAME_BYTES:
+            print(f"closing a connection that sent a {message_bytes} byte frame, more than {MAX_FRAME_BYTES}")
             return None
-        message_data += chunk
-        if len(chunk) < SOCKET_MAX_BYTES: #received the full message
-            break
-    return message_data.decode('utf-8')
+        return await reader.readexactly(message_bytes)
+    except asyncio.IncompleteReadError:
+        return None
+
+
+#An app can end CAST_VOTE, TALLY_VOTE, TALLY_COUNT and STATS with a request id (any json value but null),
+#and the peer then ends its reply (every part of a RETURNED_BLOCKCHAIN) with the same id. an app
+#can have many requests in flight on one connection this way, and match each reply to its
+#request, since replies come back in the order the requests finish (see app_client.py)
+APP_REQUEST_FIELDS = {CAST_VOTE: 3, TALLY_VOTE: 1, TALLY_COUNT: 1, STATS: 1}
+
+
+def app_request_id(data):
+    """
+    the request id at the end of a message from an app, or None if it has none
+    """
+    fields = APP_REQUEST_FIELDS.get(data[0])
+    if fields is None or len(data) <= fields:
+        return None
+    return data[fields]
+
+
+def app_reply(reply, request_id):
+    """
+    a reply to an app, ended with the request id of the request it answers if it had one
+    """
+    return reply if request_id is None else reply + [request_id]
+
+
+#Peers are known by their address, "host:port" of the port they listen for other peers on,
+#so several peers can run on one machine. a peer's first message on every connection it
+#opens to another peer is [PEER_HELLO, its address], because the port a connection comes
+#from is not the port the peer listens on
+
+
+def format_address(host, port):
+    return f"{host}:{port}"
+
+
+def parse_address(address):
+    """
+    the (host, port) of a "host:port" address
+    """
+    host, _, port = address.rpartition(':')
+    return host, int(port)
+
+
+def local_ip(toward=None):
+    """
+    the address of the local interface that traffic to toward (host, port) would leave from, found without sending anything
+    returns 127.0.0.1 if there is no route there (e.g. no network at all)
+    """
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.connect(toward or ('10.255.255.255', 1))
+        return probe.getsockname()[0]
+    except OSError:
+        return '127.0.0.1'
+    finally:
+        probe.close()
+
+
+def listening_socket(host, port, backlog):
+    """
+    a TCP socket bound to (host, port), every interface if host is None, and listening
+    SO_REUSEADDR lets a restarted peer bind its ports again while connections from its last run are in TIME_WAIT
+    raises OSError if the port can't be bound
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((host or '0.0.0.0', port))
+        listener.listen(backlog)
+    except OSError:
+        listener.close()
+        raise
+    return listener
 
 
 import urllib.request
-import json
 
 def get_external_ip():
     """
-    get the external ip for the vm
+    get the external ip for the vm, only used by peers started with --advertise external
     """
     with urllib.request.urlopen('https://httpbin.org/ip') as url:
         data = json.loads(url.read().decode())
@@ -0,0 +1,80 @@
+"""
+collects the BLOCK_STATUS replies for one new block
+
+create_new_block() waits on a QuorumRound instead of spinning on the status
+dictionary. the wait ends as soon as the outcome is certain: every peer has
+accepted, any one peer has rejected, or the round's deadline has passed (peers
+that have not answered by then count as rejecting the block)
+
+"""
+import threading
+import time
+
+
+class QuorumRound:
+    def __init__(self, peers):
+        """
+        Initializes a QuorumRound.
+
+        Parameters:
+        - peers (list of str): The peers the new block was sent to, directly or through the fan-out tree.
+        """
+        self.peers = set(peers)
+        self.statuses = {} #peer -> True if it accepted the block
+        self.condition = threading.Condition()
+
+
+    def add_status(self, peer, status):
+        """
+        record a peer's BLOCK_STATUS, only the first status from each peer in the round counts
+        """
+        self.add_statuses([peer], status)
+
+
+    def add_statuses(self, peers, status):
+        """
+        record one combined BLOCK_STATUS for several peers, e.g. a whole subtree of the fan-out tree
+        """
+        with self.condition:
+            for peer in peers:
+                if peer in self.peers and peer not in self.statuses:
+                    self.statuses[peer] = status
+            self.condition.notify_all()
+
+
+    def remove_peer(self, peer):
+        """
+        a peer left the network during the round, its status is no longer waited for
+        """
+        with self.condition:
+            self.peers.discard(peer)
+            self.statuses.pop(peer, None)
+            self.condition.notify_all()
+
+
+    def outcome(self):
+        """
+        True once every peer has accepted, False once any peer has rejected, None while undecided
+        """
+        if not all(self.statuses.values()):
+            return False
+        if len(self.statuses) == len(self.peers):
+            return True
+        return None
+
+
+    def wait(self, timeout):
+        """
+        wait until the outcome is certain or timeout seconds have passed
+        returns whether every peer accepted the block
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.outcome() is None:
+                time_left = deadline - time.monotonic()
+                if time_left <= 0:
+                    missing = ", ".join(sorted(self.peers - self.statuses.keys()))
+                    print(f"no block status from {missing} before the deadline")
+                    return False
+                self.condition.wait(time_left)
+            return self.outcome()
@@ -0,0 +1,72 @@
+"""
+counting votes straight from the chain's raw blocks, without building Blocks
+
+a tally only needs the vote of every vote in the chain, so a VoteTally is fed
+the chain a part at a time as it arrives: block dicts from the json an app
+receives (RETURNED_BLOCKCHAIN), or block records (block_codec.py) from a chain
+store. the votes in a version 2 record are scanned for their vote strings
+without decoding the rest of them (vote_fields.py), and the candidates of a
+whole part are counted with one Counter.update(), which loops in C
+
+a peer streams the chain to an app in parts of CHAIN_CHUNK_SIZE blocks, each
+saying whether more follow, and tally_chain_reply() counts every part as soon as
+it is read, so an app never holds more than one part of the chain
+
+"""
+import json
+from collections import Counter
+from block import block_votes
+from protocol import recv_wrapper
+from vote_fields import CANDIDATES, votes_field, record_field
+
+
+def leaders(counts):
+    """
+    the candidates with the most votes, in the order they are in counts, more than one if they are tied
+    """
+    if not counts:
+        return []
+    most_votes = max(counts.values())
+    return [candidate for candidate, votes in counts.items() if votes == most_votes]
+
+
+class VoteTally:
+    def __init__(self):
+        """
+        Initializes a VoteTally.
+        """
+        self.counts = Counter() #candidate -> number of votes counted, in the order the candidates were first seen
+
+
+    def add_blocks(self, block_dicts):
+        """
+        count the votes in a part of the chain given as Block.to_dict() dicts
+        """
+        self.counts.update([candidate for block_dict in block_dicts for candidate in votes_field(block_votes(block_dict.get('data')), CANDIDATES)])
+
+
+    def add_records(self, records):
+        """
+        count the votes in a part of the chain given as block records
+        """
+        self.counts.update([candidate for record in records for candidate in record_field(record, CANDIDATES)])
+
+
+    def leaders(self):
+        return leaders(self.counts)
+
+
+def tally_chain_reply(data, socket):
+    """
+    counts the votes in a RETURNED_BLOCKCHAIN message, reading the rest of the parts from the socket if the peer streamed the chain
+    returns the VoteTally
+    """
+    tally = VoteTally()
+    tally.add_blocks(data[1])
+    while len(data) > 2 and data[2]:
+        raw_data = recv_wrapper(socket)
+        if raw_data is None:
+            raise ConnectionError("the peer closed the connection before it sent the whole chain")
+        data = json.loads(raw_data)
+        tally.add_blocks(data[1])
+    return tally
@@ -0,0 +1,221 @@
+"""
+tests for the chain a peer keeps: block encodings round-tripping, running vote
+counts, reorganizing onto a longer branch, and refusing votes that can't be counted
+
+run from the repo root with: python3 -m pytest
+
+"""
+import json
+import signal
+import uuid
+import pytest
+from block import Block, GENESIS_PREV_HASH, LEGACY_VERSION, from_dict
+from block_codec import encode_block, decode_block, encode_message, decode_message
+from blockchain import Blockchain
+from chain_store import ChainStore
+from chain_verify import ChainVerifier
+from encoding import encode_value, decode_value
+from peer import Peer
+from protocol import CAST_VOTE, NEW_BLOCK, RECV_BLOCKS, TRANSACTION_STATUS
+
+
+def vote(candidate, user_id=None):
+    return {"user_id": user_id or str(uuid.uuid4()), "vote": candidate, "name": "voter", "timestamp": 1715000000.5}
+
+
+def mined(prev_hash, data, version=None):
+    """
+    a block with this data after prev_hash, mined so it meets the difficulty
+    """
+    block = Block(data=data, prev_hash=prev_hash) if version is None else Block(data=data, prev_hash=prev_hash, version=version)
+    block.mine()
+    return block
+
+
+def same_block(a, b):
+    return a.to_dict() == b.to_dict()
+
+
+@pytest.fixture
+def genesis():
+    return mined(GENESIS_PREV_HASH, None)
+
+
+@pytest.fixture
+def peer(genesis):
+    """
+    a peer on ephemeral ports that is never joined to a network, with a chain holding only the genesis block
+    """
+    interrupt_handler = signal.getsignal(signal.SIGINT)
+    peer = Peer('127.0.0.1', 1, 0, 0, host='127.0.0.1')
+    peer.blockchain.append(genesis)
+    yield peer
+    peer.peer_socket.close()
+    peer.app_socket.close()
+    peer.miner.close()
+    peer.chain_verifier.close()
+    signal.signal(signal.SIGINT, interrupt_handler)
+
+
+#encoding round trips
+
+@pytest.mark.parametrize("value", [
+    None, True, False, 0, -1, 2**63 - 1, 2**70, -2**70, 1.5, "", "x" * 300, "héllo",
+    [1, "a", None, [2.5]], {"b": 1, "a": {"c": [True]}}, vote("alice"), {"votes": [vote("alice"), vote("bob")]},
+])
+def test_value_round_trip(value):
+    assert decode_value(encode_value(value)) == value
+
+
+def test_encoding_does_not_depend_on_key_order():
+    assert encode_value({"a": 1, "b": 2}) == encode_value({"b": 2, "a": 1})
+
+
+def test_truncated_value_is_rejected():
+    with pytest.raises(ValueError):
+        decode_value(encode_value({"votes": [vote("alice")]})[:-1])
+
+
+@pytest.mark.parametrize("data", [None, {"votes": [vote("alice"), vote("bob", user_id="not a uuid")]}])
+def test_block_record_round_trip(genesis, data):
+    block = mined(genesis.hash, data)
+    decoded = decode_block(encode_block(block))
+    assert same_block(decoded, block)
+    assert decoded.calculate_hash() == block.hash
+
+
+def test_legacy_block_round_trip(genesis):
+    block = mined(genesis.hash, vote("alice"), version=LEGACY_VERSION)
+    decoded = decode_block(encode_block(block))
+    assert decoded.version == LEGACY_VERSION
+    assert same_block(decoded, block)
+    assert decoded.calculate_hash() == block.hash
+
+
+def test_dict_round_trip(genesis):
+    block = mined(genesis.hash, {"votes": [vote("alice")]})
+    assert same_block(from_dict(json.loads(json.dumps(block.to_dict()))), block)
+
+
+def test_block_messages_round_trip(genesis):
+    block = mined(genesis.hash, {"votes": [vote("alice")]})
+    message = decode_message(encode_message([NEW_BLOCK, block, 5.0]))
+    assert message[0] == NEW_BLOCK and message[2] == 5.0
+    assert same_block(message[1], block)
+
+    chain = [genesis, block]
+    message = decode_message(encode_message([RECV_BLOCKS, 0, [encode_block(b) for b in chain]]))
+    assert message[:2] == [RECV_BLOCKS, 0]
+    assert all(same_block(a, b) for a, b in zip(message[2], chain))
+
+
+def test_truncated_block_message_is_rejected(genesis):
+    with pytest.raises(ValueError):
+        decode_message(encode_message([NEW_BLOCK, genesis, 5.0])[:-1])
+
+
+#running vote counts
+
+def test_counts_follow_appends_and_pops(genesis):
+    chain = Blockchain([genesis])
+    chain.append(mined(genesis.hash, {"votes": [vote("alice"), vote("bob")]}))
+    chain.append(mined(chain[-1].hash, {"votes": [vote("alice")]}))
+    assert chain.tally() == {"alice": 2, "bob": 1}
+    chain.pop()
+    assert chain.tally() == {"alice": 1, "bob": 1}
+    chain.pop()
+    assert chain.tally() == {}
+
+
+def test_stored_chain_keeps_its_counts_and_voters(tmp_path, genesis):
+    chain = Blockchain([genesis], store=ChainStore(str(tmp_path)))
+    voter = str(uuid.uuid4())
+    chain.append(mined(genesis.hash, {"votes": [vote("alice", voter), vote("bob")]}))
+    chain.close()
+
+    reopened = Blockchain(store=ChainStore(str(tmp_path)))
+    assert len(reopened) == 2
+    assert reopened.tally() == {"alice": 1, "bob": 1}
+    assert reopened.first_votes([vote("carol", voter), vote("carol")]) == [False, True]
+    assert ChainVerifier().verify_stored(reopened) == 2
+    reopened.close()
+
+
+#reorganization
+
+def test_longer_side_branch_replaces_the_chain(peer, genesis):
+    a1 = mined(genesis.hash, {"votes": [vote("alice")]})
+    assert peer.check_block(a1, peer.my_address)
+    assert peer.blockchain.tally() == {"alice": 1}
+
+    #a branch as long as ours is kept on the side
+    b1 = mined(genesis.hash, {"votes": [vote("bob")]})
+    assert peer.check_block(b1, peer.my_address)
+    assert peer.blockchain[-1].hash == a1.hash
+    assert b1.hash in peer.fork_pool
+
+    #a longer one replaces it
+    b2 = mined(b1.hash, {"votes": [vote("bob")]})
+    assert peer.check_block(b2, peer.my_address)
+    assert [block.hash for block in peer.blockchain] == [genesis.hash, b1.hash, b2.hash]
+    assert peer.blockchain.tally() == {"bob": 2}
+    assert a1.hash in peer.fork_pool and b1.hash not in peer.fork_pool
+
+
+def test_reorganize_keeps_the_chain_if_the_branch_has_a_repeat_voter(peer, genesis):
+    voter = str(uuid.uuid4())
+    a1 = mined(genesis.hash, {"votes": [vote("alice")]})
+    peer.check_block(a1, peer.my_address)
+
+    b1 = mined(genesis.hash, {"votes": [vote("bob", voter)]})
+    b2 = mined(b1.hash, {"votes": [vote("bob", voter)]})
+    assert not peer.reorganize(0, [b1, b2])
+    assert [block.hash for block in peer.blockchain] == [genesis.hash, a1.hash]
+    assert peer.blockchain.tally() == {"alice": 1}
+
+
+def test_reorganize_refuses_a_branch_that_fails_verification(peer, genesis):
+    a1 = mined(genesis.hash, {"votes": [vote("alice")]})
+    peer.check_block(a1, peer.my_address)
+
+    b1 = mined(genesis.hash, {"votes": [vote("bob")]})
+    b2 = mined(b1.hash, {"votes": [vote("bob")]})
+    b2.nonce += 1 #its hash no longer matches
+    assert not peer.reorganize(0, [b1, b2])
+    assert peer.blockchain[-1].hash == a1.hash
+
+
+#malformed votes
+
+@pytest.mark.parametrize("data", [
+    {"votes": ["hello"]}, {"votes": [{"user_id": str(uuid.uuid4())}]}, {"votes": [{"vote": 5}]}, {"votes": 5}, "hello", [1, 2],
+])
+def test_block_with_a_malformed_vote_is_rejected(peer, genesis, data):
+    block = mined(genesis.hash, data)
+    assert ChainVerifier().verify([block], 1, genesis.hash) == 0
+    assert not peer.check_block(block, peer.my_address)
+    assert len(peer.blockchain) == 1
+    assert peer.blockchain.tally() == {}
+
+
+@pytest.mark.parametrize("store", [False, True])
+def test_append_of_a_malformed_vote_leaves_the_chain_unchanged(tmp_path, genesis, store):
+    chain = Blockchain([genesis], store=ChainStore(str(tmp_path)) if store else None)
+    with pytest.raises((TypeError, KeyError)):
+        chain.append(mined(genesis.hash, {"votes": [{"user_id": str(uuid.uuid4())}]}))
+    assert len(chain) == 1
+    assert chain[-1].hash == genesis.hash
+    good = mined(genesis.hash, {"votes": [vote("alice")]})
+    chain.append(good)
+    assert chain.tally() == {"alice": 1}
+    assert chain.height_of(good.hash) == 1
+    chain.close()
+
+
+@pytest.mark.parametrize("bad_vote", ["hello", {"user_id": str(uuid.uuid4())}, {"vote": ["alice"]}, None])
+def test_malformed_cast_vote_is_answered_false(peer, bad_vote):
+    replies = []
+    peer.send_message_to_app = lambda data, client_socket: replies.append(json.loads(data))
+    peer.handle_app_message([CAST_VOTE, bad_vote, False, 7], "app")
+    assert replies == [[TRANSACTION_STATUS, False, 7]]
+    assert peer.mempool.size == 0
@@ -1,96 +1,197 @@
-import socket
-import threading
+import asyncio
 import json
 import argparse
 from protocol import *
+from metrics import *
 
 
-#USAGE: python3 tracker.py <tracker_port>
+#USAGE: python3 tracker.py <tracker_port> [--host ADDRESS] [--metrics-port PORT]
+
+"""
+the tracker keeps the membership table of the network: the peers that have
+joined, indexed by "host:port" address, and an epoch that goes up by one on every join or leave
+
+peers send SUBSCRIBE after joining. the tracker answers with a MEMBERSHIP
+snapshot (the epoch and the other peers), then pushes a PEER_JOINED or
+PEER_LEFT delta carrying the new epoch to every subscriber whenever the table
+changes. subscribers keep their own view of the network from these, so they
+never have to ask the tracker for the peer list while handling votes
+
+a peer whose tracker connection closes without a LEAVE_NETWORK is removed from
+the table like it had left
+
+every connection is served on one asyncio event loop, so thousands of peers
+don't need a thread each. each connection's StreamReader buffers whatever part
+of a frame has arrived until the rest of it does, and everything is sent from
+the loop's thread, so deltas reach every subscriber in epoch order without a lock
+
+every message in and out is counted in the tracker's metrics (metrics.py), which
+a STATS message is answered with, and which are served over http with --metrics-port
+
+"""
+
+#a connection with more than this many bytes waiting to be sent to it has stopped reading and is closed
+MAX_WRITE_BUFFER = 4 * 1024 * 1024
+
 
 class Tracker:
-    def __init__(self, port):
-        self.peers = []
+    def __init__(self, port, host=None, metrics_port=None):
+        self.peers = {} #peer_address -> the connection (StreamWriter) the peer joined on, in the order peers joined
+        self.connection_peers = {} #connection -> set of peer_addresses that joined on it
+        self.subscribers = set() #connections that get membership deltas
+        self.epoch = 0
         self.port = port
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind(('0.0.0.0', port))
-        self.server_socket.listen(5)
-        self.my_ip = get_external_ip()
-        print(f"tracker is listening on port {port}, peers should join to ip address: {self.my_ip}")
+        self.host = host #the address to listen on, every interface if None
+        self.metrics = Metrics()
+        self.metrics_port = metrics_port #serve the metrics over http on this port, if given
+        self.metrics.gauge(NETWORK_PEERS, lambda: len(self.peers))
+        self.metrics.gauge(MEMBERSHIP_EPOCH, lambda: self.epoch)
 
 
     def start(self):
         """
         start accepting incoming peers
         """
-        while True:
-            peer_sock, addr = self.server_socket.accept()
-            peer_handler = threading.Thread(target=self.peer_handler, args=(peer_sock,))
-            peer_handler.start()
+        asyncio.run(self.serve())
+
 
+    async def serve(self):
+        server = await asyncio.start_server(self.peer_handler, self.host or '0.0.0.0', self.port, backlog=1024)
+        self.my_ip = self.host or local_ip()
+        print(f"tracker is listening on port {self.port}, peers should join to ip address: {self.my_ip}")
+        if self.metrics_port:
+            serve_metrics(self.metrics, self.metrics_port)
+        async with server:
+            await server.serve_forever()
 
-    def peer_handler(self, peer_sock):
+
+    async def peer_handler(self, reader, writer):
         """
         handle connections from peers
+        a message that isn't a json list with the fields its type needs closes the connection like a disconnect,
+        so the peers that joined on it are removed and the subscribers are told they left
         """
-        while True:
-            raw_data = peer_sock.recv(1024).decode('utf-8')
-            if not raw_data:
-                break
-
-            packets = raw_data.split(DELIMITER_STR)
-            packets = packets[:-1]
-            for packet in packets:
-                data = json.loads(packet)
+        try:
+            while True:
+                raw_data = await recv_wrapper_async(reader)
+                if not raw_data:
+                    break
+
+                data = json.loads(raw_data)
+                self.metrics.received(PEER_LINK, data[0], len(raw_data))
                 if data[0] == 'JOIN_NETWORK':
-                    peer_ip = data[1]
-                    self.add_peer(peer_ip)
+                    peer_address = data[1]
+                    self.add_peer(peer_address, writer)
                 elif data[0] == 'LEAVE_NETWORK':
-                    peer_ip = data[1]
-                    self.remove_peer(peer_ip)
+                    peer_address = data[1]
+                    self.remove_peer(peer_address)
                 elif data[0] == 'LIST_PEERS':
-                    peer_ip = data[1]
-                    self.list_peers(peer_sock, peer_ip)
+                    peer_address = data[1]
+                    self.list_peers(writer, peer_address)
+                elif data[0] == 'SUBSCRIBE':
+                    peer_address = data[1]
+                    self.subscribe(writer, peer_address)
+                elif data[0] == STATS:
+                    self.send(writer, json.dumps([RETURNED_STATS, self.metrics.snapshot()]))
                 else:
                     print("invalid message from a peer")
+        except (ValueError, IndexError, TypeError, KeyError):
+            print("malformed message from a peer, closing its connection")
+        except (OSError, asyncio.CancelledError):
+            pass
+        finally:
+            self.drop_connection(writer)
+            writer.close()
+
 
-        peer_sock.close()
+    def add_peer(self, peer_address, writer=None):
+        """
+        add a new peer to the tracker's table and tell the subscribers
+        """
+        if peer_address not in self.peers:
+            self.peers[peer_address] = writer
+            self.connection_peers.setdefault(writer, set()).add(peer_address)
+            self.epoch += 1
+            print(f"peer {peer_address} joined, epoch {self.epoch}")
+            self.push(json.dumps([PEER_JOINED, self.epoch, peer_address]))
+
+
+    def remove_peer(self, peer_address):
+        """
+        remove a peer from the tracker's table when it's leaving and tell the subscribers
+        """
+        if peer_address in self.peers:
+            writer = self.peers.pop(peer_address)
+            self.connection_peers.get(writer, set()).discard(peer_address)
+            self.epoch += 1
+            print(f"peer {peer_address} left, epoch {self.epoch}")
+            self.push(json.dumps([PEER_LEFT, self.epoch, peer_address]))
 
 
-    def add_peer(self, peer_ip):
+    def drop_connection(self, writer):
         """
-        add a new peer to the tracker's list
+        a tracker connection closed, peers that joined on it and never left are removed
         """
-        if peer_ip not in self.peers:
-            self.peers.append(peer_ip)
-            print(f"peer {peer_ip} joined")
+        self.subscribers.discard(writer)
+        for peer_address in self.connection_peers.pop(writer, set()):
+            self.remove_peer(peer_address)
 
 
-    def remove_peer(self, peer_ip):
+    def subscribe(self, writer, peer_address):
         """
-        remove a peer from the tracker's list when it's leaving
+        send a MEMBERSHIP snapshot over the connection and push every later change of the table over it
         """
-        if peer_ip in self.peers:
-            self.peers.remove(peer_ip)
-            print(f"peer {peer_ip} left")
+        peer_addresses = [ip for ip in self.peers if ip != peer_address]
+        self.subscribers.add(writer)
+        self.send(writer, json.dumps([MEMBERSHIP, self.epoch, peer_addresses]))
 
 
-    def list_peers(self, peer_sock, requester_ip):
+    def push(self, data):
+        """
+        send a membership delta to every subscriber, so each one sees every epoch
+        """
+        message = frame(data)
+        for writer in list(self.subscribers):
+            self.send(writer, message)
+
+
+    def send(self, writer, data):
+        """
+        queue a message (or an already framed one) on a connection without waiting for it to be sent
+        """
+        if writer.is_closing():
+            self.subscribers.discard(writer)
+            return
+        message = data if isinstance(data, bytes) else frame(data)
+        writer.write(message)
+        self.metrics.sent(PEER_LINK, memoryview(message)[HEADER_BYTES:])
+        if writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+            print(f"closing tracker connection to {writer.get_extra_info('peername')}, it is not reading")
+            self.subscribers.discard(writer)
+            writer.close()
+
+
+    def list_peers(self, writer, requester_address):
         """
-        send a list of all peers in the network back over the socket to the peer in an array
+        send a list of all peers in the network back over the connection to the peer in an array
         do not include the ip of the requester peer in what is sent
         """
-        peer_ips = [ip for ip in self.peers if ip != requester_ip]
-        peers = json.dumps(peer_ips).encode('utf-8')
-        peer_sock.sendall(peers)
+        peer_addresses = [ip for ip in self.peers if ip != requester_address]
+        self.send(writer, json.dumps(peer_addresses))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='tracker script')
     parser.add_argument('tracker_port', type=int, help='tracker port')
+    parser.add_argument('--host', type=str, default=None, help='address to listen on, instead of every interface')
+    parser.add_argument('--metrics-port', type=int, default=None, help='serve the metrics as Prometheus text at http://127.0.0.1:PORT/metrics')
 
     args = parser.parse_args()
 
     tracker_port = args.tracker_port
 
-    tracker = Tracker(tracker_port)
-    tracker.start()
\ No newline at end of file
+    tracker = Tracker(tracker_port, args.host, args.metrics_port)
+    try:
+        tracker.start()
+    except KeyboardInterrupt:
+        pass
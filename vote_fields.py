@@ -0,0 +1,71 @@
+"""
+one field of every vote in a block, read straight from its stored bytes
+
+counting votes (tally.py) only needs the vote of every vote, and the voter
+index (voter_index.py) only needs the voter, so both read them the same way:
+the votes of a version 2 block are scanned for both fields without decoding the
+rest of them (encoding.scan_votes), and any other block's votes are decoded
+
+"""
+import hashlib
+import json
+from block import BLOCK_HEAD, LEGACY_VERSION, block_votes
+from block_codec import JSON_RECORD
+from encoding import decode_value, scan_votes, uuid_bytes
+
+KEY_SIZE = 16
+
+#the fields of a vote, in the order scan_votes() returns them
+VOTERS = 0 #the 16-byte voter key, votes without a user_id have none and are left out
+CANDIDATES = 1 #the vote string
+
+
+def voter_key(vote):
+    """
+    the 16-byte key of the voter of a vote, or None if the vote has no user_id
+    """
+    user_id = vote.get('user_id') if isinstance(vote, dict) else None
+    if not isinstance(user_id, str):
+        return None
+    return uuid_bytes(user_id) or hashlib.blake2b(user_id.encode('utf-8'), digest_size=KEY_SIZE).digest()
+
+
+def votes_field(votes, field):
+    """
+    a field of every vote in a list of vote dicts
+    """
+    if field == CANDIDATES:
+        return [vote['vote'] for vote in votes]
+    return [key for key in map(voter_key, votes) if key is not None]
+
+
+def data_field(version, data, field):
+    """
+    a field of every vote in a block's stored data (compact json for a version 1 block, the canonical encoding otherwise)
+    """
+    if version == LEGACY_VERSION:
+        return votes_field(block_votes(json.loads(bytes(data)) if data else None), field)
+    scanned = scan_votes(data)
+    if scanned is not None:
+        return scanned[field]
+    return votes_field(block_votes(decode_value(data)), field)
+
+
+def block_field(block, field):
+    """
+    a field of every vote in a Block, read from its stored data
+    """
+    version, _, _, _, data, _ = block.raw_fields()
+    if not isinstance(data, bytes):
+        return votes_field(block_votes(data), field)
+    return data_field(version, data, field)
+
+
+def record_field(record, field):
+    """
+    a field of every vote in a block record
+    """
+    if record[0] == JSON_RECORD:
+        return votes_field(block_votes(json.loads(bytes(record[1:])).get('data')), field)
+    version, _, _, data_length = BLOCK_HEAD.unpack_from(record, 0)
+    return data_field(version, record[BLOCK_HEAD.size:BLOCK_HEAD.size + data_length], field)
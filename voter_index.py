@@ -0,0 +1,208 @@
+"""
+an index of the voters in a chain, so a peer can refuse a second vote from the same user_id
+
+every vote's user_id is kept as a 16-byte key (vote_fields.voter_key: its raw uuid bytes, or a hash of
+it if it isn't a uuid) in one flat column, in chain order, with the number of
+keys up to each block, so the keys of the last block can be dropped when it is
+popped (a BLOCK_REJECT or a chain sync rolling back)
+
+whether a key is in the chain is answered by one of two front ends:
+- by default a set of every key, one hash lookup
+- with a bloom_capacity, a BloomFilter sized for that many voters instead of the
+  set. a key the filter has never seen is answered with a few bit reads, and
+  only a key it might have seen (a voter that already voted, or a false
+  positive) is looked up by scanning the column, so a million voters cost about
+  20 MB (the column and the filter) instead of about 100 MB with the set
+
+a chain store keeps the key column on disk too (chain_store.py), so a reopened
+chain restores its index from it with restore() instead of reading every
+block's votes again. the set is rebuilt from the keys, and the bloom filter is
+read back as it was saved when the store was closed (hashing every key into a
+new one takes about 9 s for a million voters)
+
+"""
+import hashlib
+import math
+import struct
+from array import array
+from bisect import bisect_right
+from vote_fields import KEY_SIZE
+#a saved bloom filter starts with (keys in the column when it was saved, capacity, bits, hashes, keys added)
+BLOOM_HEADER = struct.Struct('!QQQIQ')
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        Initializes a BloomFilter.
+
+        Parameters:
+        - capacity (int): The number of keys the filter is sized for.
+        - error_rate (float): The chance that a key never added is reported as added, once capacity keys are in it.
+        """
+        self.capacity = max(1, capacity)
+        self.num_bits = max(8, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / self.capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0 #keys added, a key added twice counts twice
+
+
+    def positions(self, key):
+        """
+        the bits of a key, from two 64-bit halves of its hash (h1 + i * h2 for the i-th bit)
+        """
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+
+class VoterIndex:
+    def __init__(self, bloom_capacity=None):
+        """
+        Initializes a VoterIndex.
+
+        Parameters:
+        - bloom_capacity (int): Put a BloomFilter sized for this many voters in front of the key column instead of a set.
+        """
+        self.keys = bytearray() #the key of every vote in the chain, in order
+        self.ends = array('Q') #the length of self.keys after each block
+        self.bloom = BloomFilter(bloom_capacity) if bloom_capacity else None
+        self.voters = None if self.bloom else set()
+        self.repeats = {} #key -> times it is in the chain after the first, for a chain from before voters were checked
+
+
+    def append(self, keys):
+        """
+        add the voter keys of the next block
+        """
+        for key in keys:
+            self.keys += key
+            if self.bloom is not None:
+                self.bloom.add(key)
+        self.ends.append(len(self.keys))
+        if self.voters is not None:
+            self.add_voters(keys)
+        elif self.bloom.count > self.bloom.capacity:
+            self.rebuild_bloom(2 * self.bloom.capacity)
+
+
+    def add_voters(self, keys):
+        for key in keys:
+            if key in self.voters:
+                self.repeats[key] = self.repeats.get(key, 0) + 1
+            else:
+                self.voters.add(key)
+
+
+    def restore(self, keys, ends, saved_bloom=None):
+        """
+        start from a stored key column (every key in one bytes) and the length of it after each block
+        the set is rebuilt from the keys, a bloom filter is read from saved_bloom if that was saved with exactly these keys
+        """
+        self.keys = bytearray(keys)
+        self.ends = ends
+        if self.voters is not None:
+            self.add_voters([keys[position:position + KEY_SIZE] for position in range(0, len(keys), KEY_SIZE)])
+        elif not self.load_bloom(saved_bloom):
+            capacity = self.bloom.capacity
+            while capacity < len(self):
+                capacity *= 2
+            self.rebuild_bloom(capacity)
+
+
+    def saved_bloom(self):
+        """
+        the bloom filter as bytes for load_bloom(), with the number of keys it was saved with
+        """
+        bloom = self.bloom
+        return BLOOM_HEADER.pack(len(self), bloom.capacity, bloom.num_bits, bloom.num_hashes, bloom.count) + bloom.bits
+
+
+    def load_bloom(self, saved):
+        """
+        use a bloom filter from saved_bloom(), if it covers every key in the column and is at least as large as ours
+        returns whether it was used
+        """
+        if not saved or len(saved) < BLOOM_HEADER.size:
+            return False
+        covered, capacity, num_bits, num_hashes, count = BLOOM_HEADER.unpack_from(saved, 0)
+        if covered != len(self) or capacity < self.bloom.capacity:
+            return False
+        bloom = BloomFilter(capacity)
+        if (bloom.num_bits, bloom.num_hashes) != (num_bits, num_hashes) or len(saved) - BLOOM_HEADER.size != len(bloom.bits):
+            return False
+        bloom.bits = bytearray(saved[BLOOM_HEADER.size:])
+        bloom.count = count
+        self.bloom = bloom
+        return True
+
+
+    def pop(self):
+        """
+        drop the voter keys of the last block
+        the bloom filter keeps their bits, so it only answers "might have voted" more often until it is rebuilt
+        """
+        self.ends.pop()
+        start = self.ends[-1] if self.ends else 0
+        removed = [bytes(self.keys[position:position + KEY_SIZE]) for position in range(start, len(self.keys), KEY_SIZE)]
+        del self.keys[start:]
+        if self.voters is not None:
+            for key in reversed(removed):
+                if key in self.repeats:
+                    self.repeats[key] -= 1
+                    if self.repeats[key] == 0:
+                        del self.repeats[key]
+                else:
+                    self.voters.discard(key)
+
+
+    def rebuild_bloom(self, capacity):
+        self.bloom = BloomFilter(capacity)
+        for position in range(0, len(self.keys), KEY_SIZE):
+            self.bloom.add(bytes(self.keys[position:position + KEY_SIZE]))
+
+
+    def in_column(self, key):
+        """
+        scans the key column for a key, only at the start of a key
+        """
+        position = self.keys.find(key)
+        while position != -1:
+            if position % KEY_SIZE == 0:
+                return True
+            position = self.keys.find(key, position + 1)
+        return False
+
+
+    def block_of(self, key):
+        """
+        the index of the block that holds the first vote of a key, or None if it is not in the chain
+        """
+        if key not in self:
+            return None
+        position = self.keys.find(key)
+        while position % KEY_SIZE != 0:
+            position = self.keys.find(key, position + 1)
+        return bisect_right(self.ends, position)
+
+
+    def __contains__(self, key):
+        if self.voters is not None:
+            return key in self.voters
+        return key in self.bloom and self.in_column(key)
+
+
+    def __len__(self):
+        return len(self.keys) // KEY_SIZE